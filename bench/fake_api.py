@@ -0,0 +1,91 @@
+import asyncio
+import json
+import random
+import time
+from collections import Counter
+from aiohttp import web
+
+class FakeBotAPI:
+    """Local stand-in for the Telegram Bot API.
+
+    Serves /bot<token>/<method> like api.telegram.org, records every call,
+    waits `latency` seconds per request and answers a `rate_limit_ratio`
+    share of sends with a 429 and retry_after.
+    """
+
+    RATE_LIMITED_METHODS = {
+        'sendMessage', 'sendPhoto', 'sendVideo', 'sendDocument', 'sendAudio',
+        'sendMediaGroup', 'copyMessage', 'forwardMessage', 'forwardMessages'
+    }
+
+    def __init__(self, latency: float = 0.0, rate_limit_ratio: float = 0.0, retry_after: int = 1):
+        self.latency = latency
+        self.rate_limit_ratio = rate_limit_ratio
+        self.retry_after = retry_after
+        self.calls = Counter()
+        self.rate_limited = 0
+        self.message_id = 1000
+        self.runner = None
+        self.url = None
+
+    async def start(self, host: str = '127.0.0.1', port: int = 0):
+        app = web.Application()
+        app.router.add_route('*', '/bot{token}/{method}', self.handle)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, host, port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = f'http://{host}:{port}'
+
+    async def close(self):
+        if self.runner:
+            await self.runner.cleanup()
+
+    def reset(self):
+        self.calls.clear()
+        self.rate_limited = 0
+
+    async def handle(self, request):
+        method = request.match_info['method']
+        payload = dict(await request.post()) if request.body_exists else {}
+        self.calls[method] += 1
+
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        if method in self.RATE_LIMITED_METHODS and random.random() < self.rate_limit_ratio:
+            self.rate_limited += 1
+            return web.json_response({
+                'ok': False,
+                'error_code': 429,
+                'description': f'Too Many Requests: retry after {self.retry_after}',
+                'parameters': {'retry_after': self.retry_after}
+            }, status=429)
+        return web.json_response({'ok': True, 'result': self.result(method, payload)})
+
+    def result(self, method: str, payload: dict):
+        if method == 'getMe':
+            return {'id': 100000, 'is_bot': True, 'first_name': 'Bench', 'username': 'bench_bot'}
+        if method == 'sendMediaGroup':
+            return [self.message(payload) for _ in json.loads(payload.get('media', '[]'))]
+        if method == 'forwardMessages':
+            return [{'message_id': self.next_message_id()} for _ in json.loads(payload.get('message_ids', '[]'))]
+        if method == 'copyMessage':
+            return {'message_id': self.next_message_id()}
+        if method.startswith(('send', 'forward', 'edit')):
+            return self.message(payload)
+        return True
+
+    def message(self, payload: dict) -> dict:
+        chat_id = int(payload.get('chat_id', 0) or 0)
+        return {
+            'message_id': self.next_message_id(),
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            'text': payload.get('text', '')
+        }
+
+    def next_message_id(self) -> int:
+        self.message_id += 1
+        return self.message_id
@@ -0,0 +1,288 @@
+"""Offline end-to-end benchmark.
+
+Feeds synthetic Telegram updates through the real webhook handler, update
+queue, handlers and database while a local FakeBotAPI answers the Bot API
+calls, then reports throughput, latency and calls per update:
+
+    python bench/run.py
+    python bench/run.py --scenario deeplink --updates 500 --api-latency 30
+    DATABASE_URL=postgresql://localhost/bench python bench/run.py --backend postgres
+
+The memory backend leaves the database out of the picture, compare both
+to see what the database costs. With Postgres use a throwaway database,
+the run creates users, sessions and broadcast jobs.
+"""
+import argparse
+import asyncio
+import os
+import random
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from fake_api import FakeBotAPI
+
+OWNER_ID = 1
+SCENARIOS = ('start', 'deeplink', 'upload', 'broadcast')
+
+def percentile(values: list, pct: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+class Bench:
+    """Drives one bot instance in this process against a FakeBotAPI"""
+
+    def __init__(self, args, api: FakeBotAPI):
+        self.args = args
+        self.api = api
+        self.update_id = random.randint(1, 10 ** 9)
+        self.message_id = 0
+        self.sent_at = {}
+        self.latencies = []
+        self.done = 0
+        self.run_id = int(time.time())
+
+    async def setup(self):
+        from aiohttp.test_utils import TestClient, TestServer
+        import bot as bot_module
+
+        self.bot_module = bot_module
+        self.db = bot_module.db
+
+        # Harness instrumentation: latency runs from the webhook POST to the end of dp.process_update
+        process_update = bot_module.dp.process_update
+
+        async def timed_process_update(update):
+            try:
+                return await process_update(update)
+            finally:
+                started = self.sent_at.pop(update.update_id, None)
+                if started is not None:
+                    self.latencies.append(time.perf_counter() - started)
+                self.done += 1
+
+        bot_module.dp.process_update = timed_process_update
+
+        self.client = TestClient(TestServer(bot_module.create_web_app()))
+        await self.client.start_server()
+
+    async def close(self):
+        await self.client.close()
+
+    # Synthetic updates
+
+    def next_update_id(self) -> int:
+        self.update_id += 1
+        return self.update_id
+
+    def message(self, user_id: int, text: str = None, **fields) -> dict:
+        self.message_id += 1
+        message = {
+            'message_id': self.message_id,
+            'date': int(time.time()),
+            'chat': {'id': user_id, 'type': 'private'},
+            'from': {'id': user_id, 'is_bot': False, 'first_name': f'User {user_id}'},
+            **fields
+        }
+        if text is not None:
+            message['text'] = text
+            if text.startswith('/'):
+                message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+        return {'update_id': self.next_update_id(), 'message': message}
+
+    def photo(self, user_id: int, index: int, media_group_id: str = None) -> dict:
+        file_id = f'AgACAgQAAxkBAAIBench{self.run_id}{index}'
+        fields = {'media_group_id': media_group_id} if media_group_id else {}
+        return self.message(user_id, caption=f'File {index}', photo=[
+            {'file_id': file_id, 'file_unique_id': f'u{self.run_id}{index}', 'width': 1280, 'height': 720}
+        ], **fields)
+
+    def callback(self, user_id: int, data: str) -> dict:
+        return {'update_id': self.next_update_id(), 'callback_query': {
+            'id': str(self.next_update_id()),
+            'from': {'id': user_id, 'is_bot': False, 'first_name': f'User {user_id}'},
+            'message': {
+                'message_id': self.message_id,
+                'date': int(time.time()),
+                'chat': {'id': user_id, 'type': 'private'},
+                'text': 'options'
+            },
+            'chat_instance': '1',
+            'data': data
+        }}
+
+    def user_id(self, index: int) -> int:
+        # Distinct users per run, so /start floods register new users every time
+        return self.run_id * 100000 + index
+
+    # Running
+
+    async def post(self, update: dict, semaphore: asyncio.Semaphore):
+        async with semaphore:
+            self.sent_at[update['update_id']] = time.perf_counter()
+            headers = {}
+            if self.bot_module.config.WEBHOOK_SECRET:
+                headers['X-Telegram-Bot-Api-Secret-Token'] = self.bot_module.config.WEBHOOK_SECRET
+            response = await self.client.post(self.bot_module.config.WEBHOOK_PATH, json=update, headers=headers)
+            if response.status != 200:
+                self.sent_at.pop(update['update_id'], None)
+                self.done += 1
+
+    async def feed(self, updates: list, ordered: bool = False):
+        """Post updates concurrently (or one by one when order matters) and wait until all are processed"""
+        semaphore = asyncio.Semaphore(1 if ordered else self.args.concurrency)
+        target = self.done + len(updates)
+        if ordered:
+            for update in updates:
+                await self.post(update, semaphore)
+        else:
+            await asyncio.gather(*(self.post(update, semaphore) for update in updates))
+        while self.done < target:
+            await asyncio.sleep(0.005)
+
+    def snapshot(self) -> tuple:
+        calls = sum(stats['calls'] for stats in self.db.timings.stats().values())
+        return calls, self.bot_module.updates.shed_count
+
+    async def measure(self, name: str, run) -> dict:
+        self.api.reset()
+        self.latencies = []
+        db_calls, shed = self.snapshot()
+
+        started = time.perf_counter()
+        count = await run()
+        elapsed = time.perf_counter() - started
+
+        db_calls_after, shed_after = self.snapshot()
+        api_calls = sum(self.api.calls.values())
+        return {
+            'scenario': name,
+            'updates': count,
+            'seconds': elapsed,
+            'updates_per_sec': count / elapsed if elapsed else 0.0,
+            'p50_ms': percentile(self.latencies, 50) * 1000,
+            'p99_ms': percentile(self.latencies, 99) * 1000,
+            'api_per_update': api_calls / count if count else 0.0,
+            'db_per_update': (db_calls_after - db_calls) / count if count else 0.0,
+            'shed': shed_after - shed,
+            'rate_limited': self.api.rate_limited,
+            'api_calls': dict(self.api.calls.most_common())
+        }
+
+    # Scenarios
+
+    async def run_start(self) -> int:
+        """/start flood from distinct users"""
+        updates = [self.message(self.user_id(i), '/start') for i in range(self.args.updates)]
+        await self.feed(updates)
+        return len(updates)
+
+    async def run_deeplink(self) -> int:
+        """Many users opening the same hot session link, timed until every first page is sent"""
+        from utils import SessionTokens
+        session_id = SessionTokens.issue(await self.db.next_upload_session_number())
+        await self.db.create_upload_session(
+            session_id=session_id,
+            owner_id=OWNER_ID,
+            files=[
+                {'file_id': f'AgACAgQAAxkBAAIHot{i}', 'file_unique_id': f'hot{i}', 'file_type': 'photo', 'caption': ''}
+                for i in range(self.args.files)
+            ],
+            protect_content=True,
+            auto_delete_minutes=60,
+            delivery_mode=self.args.delivery_mode
+        )
+        updates = [self.message(self.user_id(i), f'/start {session_id}') for i in range(self.args.updates)]
+        await self.feed(updates)
+        # Files go out in background delivery tasks after the handlers return
+        while self.bot_module.delivery.tasks:
+            await asyncio.sleep(0.01)
+        return len(updates)
+
+    async def run_upload(self) -> int:
+        """Owner uploads files (as albums of 10 or one by one) and walks through the session options"""
+        updates = [self.message(OWNER_ID, '/upload')]
+        if self.args.upload_mode == 'album':
+            updates += [self.photo(OWNER_ID, i, f'{self.run_id}{i // 10}') for i in range(self.args.files)]
+        else:
+            updates += [self.photo(OWNER_ID, i) for i in range(self.args.files)]
+        updates.append(self.message(OWNER_ID, '/d'))
+        updates += [self.callback(OWNER_ID, data) for data in ('protect_yes', f'mode_{self.args.delivery_mode}', 'delete_0', 'expire_0')]
+        await self.feed(updates, ordered=True)
+        return len(updates)
+
+    async def run_broadcast(self) -> int:
+        """Broadcast to --recipients users, timed until the background job finishes"""
+        for i in range(self.args.recipients):
+            self.db.register_user(self.user_id(i), f'user{i}', f'User {i}', None)
+        await self.db.flush_activity()
+
+        updates = [self.message(OWNER_ID, '/broadcast'), self.message(OWNER_ID, 'Benchmark broadcast')]
+        await self.feed(updates, ordered=True)
+        while self.bot_module.broadcaster.tasks:
+            await asyncio.sleep(0.01)
+        return len(updates)
+
+def report(results: list):
+    header = f"{'scenario':<10} {'updates':>8} {'upd/s':>9} {'p50 ms':>9} {'p99 ms':>9} {'api/upd':>8} {'db/upd':>8} {'shed':>5} {'429':>5}"
+    print(header)
+    print('-' * len(header))
+    for r in results:
+        print(f"{r['scenario']:<10} {r['updates']:>8} {r['updates_per_sec']:>9.1f} {r['p50_ms']:>9.1f} "
+              f"{r['p99_ms']:>9.1f} {r['api_per_update']:>8.2f} {r['db_per_update']:>8.2f} "
+              f"{r['shed']:>5} {r['rate_limited']:>5}")
+    print()
+    for r in results:
+        calls = ', '.join(f'{method}={count}' for method, count in r['api_calls'].items())
+        print(f"{r['scenario']:<10} {r['seconds']:.2f}s  {calls}")
+
+async def main(args):
+    api = FakeBotAPI(latency=args.api_latency / 1000, rate_limit_ratio=args.rate_limit_ratio)
+    await api.start()
+
+    # Configure the bot before it is imported, config is read at import time
+    os.environ['TELEGRAM_API_URL'] = api.url
+    os.environ.setdefault('BOT_TOKEN', '123456:BENCHMARK')
+    os.environ['OWNER_ID'] = str(OWNER_ID)
+    os.environ['SEND_GLOBAL_RATE'] = str(args.send_rate)
+    os.environ['SEND_GLOBAL_BURST'] = str(max(int(args.send_rate), 1))
+    os.environ['SEND_CHAT_RATE'] = str(args.chat_rate)
+    os.environ['DATABASE_BACKEND'] = args.backend
+    os.environ.pop('RENDER_EXTERNAL_URL', None)
+    os.environ.pop('UPLOAD_CHANNEL_ID', None)
+
+    bench = Bench(args, api)
+    await bench.setup()
+    results = []
+    try:
+        scenarios = SCENARIOS if args.scenario == 'all' else (args.scenario,)
+        for name in scenarios:
+            results.append(await bench.measure(name, getattr(bench, f'run_{name}')))
+    finally:
+        await bench.close()
+        await api.close()
+    report(results)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scenario', choices=('all',) + SCENARIOS, default='all')
+    parser.add_argument('--backend', choices=('memory', 'postgres'), default='memory', help='DATABASE_BACKEND used during the run')
+    parser.add_argument('--updates', type=int, default=1000, help='updates per /start and deep-link scenario')
+    parser.add_argument('--files', type=int, default=10, help='files per uploaded or delivered session')
+    parser.add_argument('--recipients', type=int, default=1000, help='users created for the broadcast scenario')
+    parser.add_argument('--upload-mode', choices=('single', 'album'), default='album', help='how the upload scenario sends files')
+    parser.add_argument('--delivery-mode', choices=('single', 'album'), default='album')
+    parser.add_argument('--concurrency', type=int, default=50, help='webhook requests in flight')
+    parser.add_argument('--api-latency', type=float, default=20, help='fake Bot API latency in ms')
+    parser.add_argument('--rate-limit-ratio', type=float, default=0.0, help='share of sends answered with 429')
+    parser.add_argument('--send-rate', type=float, default=1000, help='SEND_GLOBAL_RATE used during the run')
+    parser.add_argument('--chat-rate', type=float, default=1000, help='SEND_CHAT_RATE used during the run')
+    args = parser.parse_args()
+
+    if args.backend == 'postgres' and not os.getenv('DATABASE_URL'):
+        parser.error('DATABASE_URL must point to a throwaway Postgres database')
+    asyncio.run(main(args))
@@ -1,27 +1,116 @@
+import time
+
+# Startup timings count from here, before the heavier imports
+PROCESS_STARTED = time.perf_counter()
+
 import asyncio
 import logging
-from aiogram import Bot, Dispatcher, types
-from aiogram.contrib.fsm_storage.memory import MemoryStorage
+import os
+import tempfile
+from datetime import datetime, timedelta
+from aiogram import Dispatcher, types
+from aiogram.bot.api import TELEGRAM_PRODUCTION, TelegramAPIServer
 from aiogram.dispatcher import FSMContext
+from aiogram.dispatcher.filters import BoundFilter
 from aiogram.dispatcher.filters.state import State, StatesGroup
-from aiogram.utils import executor
+from aiogram.dispatcher.middlewares import BaseMiddleware
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 import aiohttp
 from aiohttp import web
 import json
 
 from config import config
-from database import db
-from utils import BotUtils, FileHandler, Validation
+from database import create_database
+from fsm_storage import PostgresStorage
+from broadcast import BroadcastManager
+from delivery import SessionDelivery
+from scheduler import DeletionScheduler
+from sweeper import SessionSweeper
+from transfer import EXPORT_TABLES, export_table, import_file
+from ingest import MediaGroupCollector, UpdateQueue
+from outbound import ScheduledBot
+from metrics import Gauge, HandlerMetricsMiddleware, StartupTimer, HANDLER_ERRORS
+import metrics
+from profiler import HandlerProfiler, parse_duration
+from utils import BotUtils, FileHandler, SessionTokens, Validation
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+startup = StartupTimer(PROCESS_STARTED)
+startup.mark('imports')
+
 # Initialize bot and dispatcher
-bot = Bot(token=config.BOT_TOKEN)
-storage = MemoryStorage()
+bot = ScheduledBot(
+    token=config.BOT_TOKEN,
+    server=TelegramAPIServer.from_base(config.TELEGRAM_API_URL) if config.TELEGRAM_API_URL else TELEGRAM_PRODUCTION
+)
+db = create_database()
+storage = PostgresStorage(db)
 dp = Dispatcher(bot, storage=storage)
+broadcaster = BroadcastManager(bot, db)
+deleter = DeletionScheduler(bot, db)
+delivery = SessionDelivery(bot, db, deleter)
+sweeper = SessionSweeper(db)
+updates = UpdateQueue(dp)
+profiler = HandlerProfiler(bot, dp)
+dp.middleware.setup(HandlerMetricsMiddleware())
+
+# Gauges read when /metrics is scraped
+Gauge('bot_update_queue_depth', 'Updates waiting to be processed', lambda: {(): updates.size})
+Gauge('bot_updates_total', 'Webhook updates by outcome', lambda: {
+    ('accepted',): updates.received_count,
+    ('duplicate',): updates.duplicate_count,
+    ('shed',): updates.shed_count
+}, ('outcome',), metric_type='counter')
+Gauge('bot_db_pool_connections', 'Database pool connections', lambda: {
+    ('total',): db.pool.get_size(),
+    ('idle',): db.pool.get_idle_size()
+} if db.pool else {}, ('state',))
+Gauge('bot_activity_pending_users', 'Users with buffered activity not yet flushed', lambda: {(): len(db.activity.pending)})
+Gauge('bot_activity_buffered_total', 'User activity touches buffered', lambda: {(): db.activity.buffered_count},
+      metric_type='counter')
+Gauge('bot_activity_flushed_users_total', 'Users written by activity flushes', lambda: {(): db.activity.flushed_count},
+      metric_type='counter')
+Gauge('bot_activity_flushes_total', 'Activity flushes written to the database', lambda: {(): db.activity.flush_count},
+      metric_type='counter')
+Gauge('bot_session_cache_requests_total', 'Upload session cache lookups', lambda: {
+    ('hit',): db.sessions.hits,
+    ('miss',): db.sessions.misses
+}, ('result',), metric_type='counter')
+Gauge('bot_session_page_cache_requests_total', 'Session file page cache lookups', lambda: {
+    ('hit',): db.session_pages.hits,
+    ('miss',): db.session_pages.misses
+}, ('result',), metric_type='counter')
+Gauge('bot_session_cache_evictions_total', 'Entries evicted from the session caches', lambda: {
+    ('sessions',): db.sessions.evictions,
+    ('pages',): db.session_pages.evictions
+}, ('cache',), metric_type='counter')
+Gauge('bot_access_counts_pending', 'Sessions with deep-link hits not yet added to access_count',
+      lambda: {(): len(db.access_counts)})
+Gauge('bot_access_count_flushed_sessions_total', 'Sessions updated by access count flushes',
+      lambda: {(): db.access_flushed_count}, metric_type='counter')
+Gauge('bot_access_count_flushes_total', 'Access count flushes written to the database',
+      lambda: {(): db.access_flush_count}, metric_type='counter')
+Gauge('bot_broadcasts_running', 'Broadcast jobs running in this process', lambda: {(): len(broadcaster.tasks)})
+Gauge('bot_send_queue_depth', 'Bot API sends waiting for a rate limit slot', lambda: {
+    (priority,): depth for priority, depth in bot.outbound.depth().items()
+}, ('priority',))
+Gauge('bot_startup_seconds', 'Time spent in each startup step', lambda: {
+    (step,): seconds for step, seconds in startup.steps
+}, ('step',))
+Gauge('bot_deliveries_running', 'Session pages being sent in this process', lambda: {(): len(delivery.tasks)})
+Gauge('bot_access_events_pending', 'Session access events buffered and not yet written', lambda: {(): len(db.access_events)})
+Gauge('bot_access_events_total', 'Session access events by outcome', lambda: {
+    ('flushed',): db.access_events_flushed,
+    ('dropped',): db.access_events_dropped
+}, ('outcome',), metric_type='counter')
+
+async def collect_pending_deletions():
+    return {(): await db.count_pending_deletions()} if db.pool else {}
+
+Gauge('bot_pending_deletions', 'Auto-deletions waiting in the database', collect_pending_deletions)
 
 # States for conversation handlers
 class UploadStates(StatesGroup):
@@ -35,13 +124,31 @@ class MessageStates(StatesGroup):
 class BroadcastStates(StatesGroup):
     waiting_for_broadcast = State()
 
+class ImportStates(StatesGroup):
+    waiting_for_file = State()
+
 # Middleware to track user activity
-@dp.middleware()
-async def user_activity_middleware(handler, event, data):
-    if hasattr(event, 'from_user') and event.from_user:
-        user_id = event.from_user.id
-        await db.update_user_activity(user_id)
-    return await handler(event, data)
+class UserActivityMiddleware(BaseMiddleware):
+    async def on_pre_process_message(self, message: types.Message, data: dict):
+        if message.from_user:
+            db.touch_user(message.from_user.id)
+
+    async def on_pre_process_callback_query(self, callback_query: types.CallbackQuery, data: dict):
+        db.touch_user(callback_query.from_user.id)
+
+dp.middleware.setup(UserActivityMiddleware())
+
+# Owner-only filter, used as is_owner=True on handlers
+class IsOwnerFilter(BoundFilter):
+    key = 'is_owner'
+
+    def __init__(self, is_owner: bool):
+        self.is_owner = is_owner
+
+    async def check(self, obj) -> bool:
+        return Validation.is_owner(obj.from_user.id) == self.is_owner
+
+dp.filters_factory.bind(IsOwnerFilter)
 
 # Start command handler
 @dp.message_handler(commands=['start'])
@@ -49,8 +156,8 @@ async def cmd_start(message: types.Message):
     user_id = message.from_user.id
     args = message.get_args()
     
-    # Add user to database
-    await db.add_user(
+    # Add user to database (buffered, merged with the activity touch)
+    db.register_user(
         user_id=user_id,
         username=message.from_user.username,
         first_name=message.from_user.first_name,
@@ -188,84 +295,153 @@ async def process_help_text(message: types.Message, state: FSMContext):
 # Stats command (Owner only)
 @dp.message_handler(commands=['stats'], is_owner=True)
 async def cmd_stats(message: types.Message):
-    await db.update_statistics()
     stats = await db.get_statistics()
-    active_users = await db.get_active_users_count(48)
+    active = await db.get_active_users_counts()
+    daily = await db.get_daily_active_users(1)
+    retention = await db.get_retention([1, 7, 30])
+    
+    active_today = daily[0]['active_users'] if daily else 0
+    retention_text = ' / '.join(
+        f"D{row['offset_days']} {row['retained'] * 100 // row['cohort']}%" if row['cohort'] else f"D{row['offset_days']} -"
+        for row in retention
+    )
     
     stats_text = f"""
 📊 **Bot Statistics**
 
 👥 Total Users: `{stats['total_users']}`
-✅ Active Users (48h): `{active_users}`
+✅ Active Users: 1h `{active['1h']}` · 24h `{active['24h']}` · 48h `{active['48h']}` · 7d `{active['7d']}` · 30d `{active['30d']}`
+📆 Active Today: `{active_today}`
+📈 Retention: `{retention_text}`
 📁 Total Upload Sessions: `{stats['total_sessions']}`
 📄 Total Files Uploaded: `{stats['total_uploads']}`
 🕒 Last Updated: `{stats['last_updated'].strftime('%Y-%m-%d %H:%M')}`
+🔄 Last Reconciled: `{stats['reconciled_at'].strftime('%Y-%m-%d %H:%M')}`
     """
     
     await message.answer(stats_text)
 
+# Top sessions command (Owner only): /top, /top 7d
+@dp.message_handler(commands=['top'], is_owner=True)
+async def cmd_top(message: types.Message):
+    window = message.get_args().strip() or '24h'
+    try:
+        hours = max(1, round(parse_duration(window) / 3600))
+    except ValueError:
+        await message.answer("❌ Invalid window. Use e.g. `/top 24h` or `/top 7d`.")
+        return
+    
+    rows = await db.get_top_sessions(hours, config.TOP_SESSIONS_LIMIT)
+    if not rows:
+        await message.answer(f"No session was opened in the last {window}.")
+        return
+    
+    lines = [
+        f"{i}. `{row['session_id']}` · {row['opens']} opens · {row['files']} files sent"
+        + (f" · {row['avg_latency_ms']} ms per page" if row['avg_latency_ms'] is not None else "")
+        for i, row in enumerate(rows, 1)
+    ]
+    await message.answer(f"🔥 **Top sessions, last {window}**\n\n" + "\n".join(lines))
+
+# Reconcile command (Owner only)
+@dp.message_handler(commands=['reconcile'], is_owner=True)
+async def cmd_reconcile(message: types.Message):
+    await message.answer("🔄 Recounting statistics...")
+    await db.reconcile_statistics()
+    await message.answer("✅ Statistics reconciled! Use /stats to view them.")
+
+# Export command (Owner only): /export users, /export sessions
+@dp.message_handler(commands=['export'], is_owner=True)
+async def cmd_export(message: types.Message):
+    table = message.get_args().strip()
+    if table not in EXPORT_TABLES:
+        await message.answer("Usage: `/export users` or `/export sessions`")
+        return
+    
+    await message.answer(f"📤 Exporting {table}...")
+    file, count = await export_table(db, table)
+    with file:
+        await message.answer_document(
+            types.InputFile(file, filename=f"{table}-{time.strftime('%Y%m%d-%H%M%S')}.csv.gz"),
+            caption=f"📤 {count} {table} exported"
+        )
+
+# Import command (Owner only), loads a file made by /export
+@dp.message_handler(commands=['import'], is_owner=True)
+async def cmd_import(message: types.Message):
+    await ImportStates.waiting_for_file.set()
+    await message.answer("📥 Send a file made by /export (users or sessions, up to 20 MB), or /cancel:")
+
+@dp.message_handler(state=ImportStates.waiting_for_file, content_types=types.ContentType.DOCUMENT)
+async def process_import(message: types.Message, state: FSMContext):
+    await state.finish()
+    await message.answer("📥 Importing...")
+    
+    with tempfile.TemporaryFile() as file:
+        await message.document.download(destination_file=file)
+        try:
+            table, read, added = await import_file(db, file)
+        except ValueError as e:
+            await message.answer(f"❌ Import failed: {e}")
+            return
+    
+    await message.answer(f"✅ Imported {added} of {read} {table}, the others already existed.")
+
+# Profile command (Owner only): /profile on 60s, /profile off
+@dp.message_handler(commands=['profile'], is_owner=True)
+async def cmd_profile(message: types.Message):
+    args = message.get_args().split()
+    
+    if args and args[0] == 'on':
+        if profiler.running:
+            await message.answer("🔬 Profiler is already running, use /profile off to stop it.")
+            return
+        try:
+            seconds = parse_duration(args[1]) if len(args) > 1 else 60
+        except ValueError:
+            await message.answer("❌ Invalid duration. Use e.g. `/profile on 60s` or `/profile on 5m`.")
+            return
+        seconds = max(1, min(seconds, config.PROFILE_MAX_SECONDS))
+        profiler.start(seconds, message.chat.id)
+        await message.answer(f"🔬 Profiling handlers for {seconds}s, the report will be sent here.")
+    elif args and args[0] == 'off':
+        if not profiler.running:
+            await message.answer("Profiler is not running.")
+            return
+        await profiler.stop()
+    else:
+        await message.answer("Usage: `/profile on 60s` to profile handlers for a while, `/profile off` to stop early.")
+
+# Cancel command (Owner only)
+@dp.message_handler(commands=['cancel'], state='*', is_owner=True)
+async def cmd_cancel(message: types.Message, state: FSMContext):
+    if await state.get_state() is not None:
+        albums.discard_chat(message.chat.id)
+        await state.finish()
+        await message.answer("❌ Cancelled.")
+        return
+    
+    job_ids = await broadcaster.cancel()
+    if job_ids:
+        await message.answer(f"🛑 Broadcast cancelled: {', '.join(f'#{job_id}' for job_id in job_ids)}")
+    else:
+        await message.answer("Nothing to cancel.")
+
 # Broadcast command (Owner only)
 @dp.message_handler(commands=['broadcast'], is_owner=True)
 async def cmd_broadcast(message: types.Message, state: FSMContext):
     await BroadcastStates.waiting_for_broadcast.set()
-    await message.answer("Please send the broadcast message (text, photo, video, or document):")
+    await message.answer("Please send the broadcast message (text, photo, video, or document), or /cancel:")
 
 # Handle broadcast message
 @dp.message_handler(state=BroadcastStates.waiting_for_broadcast, content_types=types.ContentType.ANY)
 async def process_broadcast(message: types.Message, state: FSMContext):
-    users = await db.get_all_users()
-    success_count = 0
-    fail_count = 0
-    
-    await message.answer(f"📢 Starting broadcast to {len(users)} users...")
-    
-    for user in users:
-        try:
-            if message.photo:
-                await bot.send_photo(
-                    chat_id=user['id'],
-                    photo=message.photo[-1].file_id,
-                    caption=message.caption,
-                    caption_entities=message.caption_entities,
-                    reply_markup=message.reply_markup
-                )
-            elif message.video:
-                await bot.send_video(
-                    chat_id=user['id'],
-                    video=message.video.file_id,
-                    caption=message.caption,
-                    caption_entities=message.caption_entities,
-                    reply_markup=message.reply_markup
-                )
-            elif message.document:
-                await bot.send_document(
-                    chat_id=user['id'],
-                    document=message.document.file_id,
-                    caption=message.caption,
-                    caption_entities=message.caption_entities,
-                    reply_markup=message.reply_markup
-                )
-            else:
-                await bot.send_message(
-                    chat_id=user['id'],
-                    text=message.text,
-                    entities=message.entities,
-                    reply_markup=message.reply_markup
-                )
-            success_count += 1
-        except Exception as e:
-            logger.error(f"Failed to send broadcast to {user['id']}: {e}")
-            fail_count += 1
-        
-        await asyncio.sleep(0.1)
-    
-    await message.answer(f"""
-📊 Broadcast Completed:
-✅ Success: {success_count}
-❌ Failed: {fail_count}
-📊 Total: {len(users)}
-    """)
-    
+    # The job copies this message to every user in the background
+    await broadcaster.start(
+        owner_id=message.from_user.id,
+        from_chat_id=message.chat.id,
+        message_id=message.message_id
+    )
     await state.finish()
 
 # Upload command (Owner only)
@@ -273,6 +449,7 @@ async def process_broadcast(message: types.Message, state: FSMContext):
 async def cmd_upload(message: types.Message, state: FSMContext):
     await state.update_data(
         file_ids=[],
+        file_unique_ids=[],
         captions=[],
         file_types=[],
         messages_to_delete=[]
@@ -295,31 +472,68 @@ Supported formats: Images, Videos, Documents, Audio
 async def process_file_upload(message: types.Message, state: FSMContext):
     if message.text and message.text.startswith('/'):
         if message.text == '/d':
+            # Albums still inside their debounce window belong to this session
+            await albums.flush_chat(message.chat.id)
             await process_upload_complete(message, state)
             return
         elif message.text == '/c':
+            albums.discard_chat(message.chat.id)
             await state.finish()
             await message.answer("❌ Upload session cancelled.")
             return
     
-    file_id, file_type = FileHandler.get_file_id(message)
+    # Single files go through the collector too, behind any album of the chat still pending
+    if message.media_group_id:
+        albums.add(message)
+    else:
+        await albums.submit([message])
+
+async def add_uploaded_files(messages: list):
+    """Add a batch of uploaded messages with one state update, one forward and one reply"""
+    first = messages[0]
+    files = []
+    for message in messages:
+        file_id, file_unique_id, file_type = FileHandler.get_file(message)
+        if file_id and file_type != 'unknown':
+            files.append((message, file_id, file_unique_id, file_type))
+    
+    if not files:
+        await first.answer("❌ Unsupported file type. Please send photos, videos, or documents.")
+        return
+    
+    # An album flushed after the window may arrive when the session was already cancelled
+    current_state = await storage.get_state(chat=first.chat.id, user=first.from_user.id)
+    if current_state != UploadStates.waiting_for_files.state:
+        return
     
-    if file_id and file_type != 'unknown':
-        async with state.proxy() as data:
-            data['file_ids'].append(file_id)
-            data['file_types'].append(file_type)
-            data['captions'].append(message.caption or "")
-            data['messages_to_delete'].append(message.message_id)
-        
-        if config.UPLOAD_CHANNEL_ID:
-            try:
-                await message.forward(config.UPLOAD_CHANNEL_ID)
-            except Exception as e:
-                logger.error(f"Failed to forward to upload channel: {e}")
-        
-        await message.answer(f"✅ {file_type.capitalize()} added! ({len(data['file_ids'])} files)")
+    # Append only the new items instead of rewriting the whole upload state
+    data = await storage.append_data(
+        chat=first.chat.id,
+        user=first.from_user.id,
+        file_ids=[file_id for _, file_id, _, _ in files],
+        file_unique_ids=[file_unique_id for _, _, file_unique_id, _ in files],
+        file_types=[file_type for _, _, _, file_type in files],
+        captions=[message.caption or "" for message, _, _, _ in files],
+        messages_to_delete=[message.message_id for message, _, _, _ in files]
+    )
+    
+    if config.UPLOAD_CHANNEL_ID:
+        try:
+            # One call for the whole batch, keeps the album grouped in the channel
+            await bot.request('forwardMessages', {
+                'chat_id': config.UPLOAD_CHANNEL_ID,
+                'from_chat_id': first.chat.id,
+                'message_ids': json.dumps(sorted(message.message_id for message, _, _, _ in files))
+            })
+        except Exception as e:
+            logger.error(f"Failed to forward to upload channel: {e}")
+    
+    if len(files) == 1:
+        await first.answer(f"✅ {files[0][3].capitalize()} added! ({len(data['file_ids'])} files)")
     else:
-        await message.answer("❌ Unsupported file type. Please send photos, videos, or documents.")
+        await first.answer(f"✅ {len(files)} files added! ({len(data['file_ids'])} files)")
+
+albums = MediaGroupCollector(config.UPLOAD_ALBUM_WINDOW, FileHandler.ALBUM_SIZE, add_uploaded_files)
 
 async def process_upload_complete(message: types.Message, state: FSMContext):
     data = await state.get_data()
@@ -354,6 +568,28 @@ async def protect_content_callback(callback_query: types.CallbackQuery, state: F
     
     await state.update_data(protect_content=protect_content)
     
+    keyboard = InlineKeyboardMarkup(row_width=2)
+    keyboard.add(
+        InlineKeyboardButton("🖼 Albums", callback_data="mode_album"),
+        InlineKeyboardButton("📄 One by one", callback_data="mode_single")
+    )
+    
+    await callback_query.message.edit_text(f"""
+🔒 Content Protection: {'✅ ON' if protect_content else '❌ OFF'}
+
+📦 **Delivery Mode?**
+Albums send up to 10 files per message, one by one sends each file separately
+    """, reply_markup=keyboard)
+    
+    await callback_query.answer()
+
+# Delivery mode callback
+@dp.callback_query_handler(lambda c: c.data.startswith('mode_'), state=UploadStates.waiting_for_options)
+async def delivery_mode_callback(callback_query: types.CallbackQuery, state: FSMContext):
+    delivery_mode = callback_query.data.split('_')[1]
+    
+    await state.update_data(delivery_mode=delivery_mode)
+    
     keyboard = InlineKeyboardMarkup(row_width=3)
     keyboard.row(
         InlineKeyboardButton("5 min", callback_data="delete_5"),
@@ -366,7 +602,7 @@ async def protect_content_callback(callback_query: types.CallbackQuery, state: F
     )
     
     await callback_query.message.edit_text(f"""
-🔒 Content Protection: {'✅ ON' if protect_content else '❌ OFF'}
+📦 Delivery Mode: {'🖼 Albums' if delivery_mode == 'album' else '📄 One by one'}
 
 ⏰ **Auto-delete Timer?**
 Files will be automatically deleted from user's chat after specified time
@@ -378,18 +614,55 @@ Files will be automatically deleted from user's chat after specified time
 @dp.callback_query_handler(lambda c: c.data.startswith('delete_'), state=UploadStates.waiting_for_options)
 async def auto_delete_callback(callback_query: types.CallbackQuery, state: FSMContext):
     auto_delete_minutes = int(callback_query.data.split('_')[1])
+    
+    await state.update_data(auto_delete_minutes=auto_delete_minutes)
+    
+    keyboard = InlineKeyboardMarkup(row_width=2)
+    keyboard.row(
+        InlineKeyboardButton("1 day", callback_data="expire_1440"),
+        InlineKeyboardButton("1 week", callback_data="expire_10080")
+    )
+    keyboard.row(
+        InlineKeyboardButton("30 days", callback_data="expire_43200"),
+        InlineKeyboardButton("Never", callback_data="expire_0")
+    )
+    
+    await callback_query.message.edit_text(f"""
+⏰ Auto-delete: {BotUtils.format_time(auto_delete_minutes)}
+
+⌛ **Link Expiry?**
+The deep link stops working and the session is deleted after specified time
+    """, reply_markup=keyboard)
+    
+    await callback_query.answer()
+
+# Link expiry callback, creates the session
+@dp.callback_query_handler(lambda c: c.data.startswith('expire_'), state=UploadStates.waiting_for_options)
+async def expiry_callback(callback_query: types.CallbackQuery, state: FSMContext):
+    expire_minutes = int(callback_query.data.split('_')[1])
     data = await state.get_data()
+    auto_delete_minutes = data.get('auto_delete_minutes', 0)
     
-    # Generate random session ID
-    session_id = BotUtils.generate_session_id()
+    # Signed token over a sequence number, unique and checkable without the database
+    session_id = SessionTokens.issue(await db.next_upload_session_number())
+    
+    # Sessions started before file_unique_ids was tracked have none
+    file_unique_ids = data.get('file_unique_ids', [])
+    files = [{
+        'file_id': file_id,
+        'file_unique_id': file_unique_ids[i] if i < len(file_unique_ids) else None,
+        'file_type': data['file_types'][i],
+        'caption': data['captions'][i]
+    } for i, file_id in enumerate(data['file_ids'])]
     
     await db.create_upload_session(
         session_id=session_id,
         owner_id=callback_query.from_user.id,
-        file_ids=data['file_ids'],
-        captions=data['captions'],
+        files=files,
         protect_content=data.get('protect_content', True),
-        auto_delete_minutes=auto_delete_minutes
+        auto_delete_minutes=auto_delete_minutes,
+        delivery_mode=data.get('delivery_mode', 'single'),
+        expires_at=datetime.now() + timedelta(minutes=expire_minutes) if expire_minutes else None
     )
     
     # Generate deep link with random session ID
@@ -402,7 +675,9 @@ async def auto_delete_callback(callback_query: types.CallbackQuery, state: FSMCo
 📊 Summary:
 • Files: {len(data['file_ids'])}
 • Protect Content: {'✅ Yes' if data.get('protect_content', True) else '❌ No'}
+• Delivery: {'🖼 Albums' if data.get('delivery_mode') == 'album' else '📄 One by one'}
 • Auto-delete: {BotUtils.format_time(auto_delete_minutes)}
+• Link expires: {BotUtils.format_time(expire_minutes)}
 
 🔗 **Deep Link:**
 `{deep_link}`
@@ -416,85 +691,51 @@ async def auto_delete_callback(callback_query: types.CallbackQuery, state: FSMCo
 
 # Deep link access handler
 async def handle_deep_link_access(message: types.Message, session_id: str):
+    # Malformed and forged links are rejected without a database lookup
+    if not SessionTokens.verify(session_id) and not db.has_legacy_session(session_id):
+        await message.answer("❌ Invalid or expired session link.")
+        return
+    
     session = await db.get_upload_session(session_id)
     
     if not session:
         await message.answer("❌ Invalid or expired session link.")
         return
     
-    user_id = message.from_user.id
-    is_owner = Validation.is_owner(user_id)
-    
-    file_ids = json.loads(session['file_ids'])
-    captions = json.loads(session['captions'])
+    is_owner = Validation.is_owner(message.from_user.id)
     
-    await message.answer(f"📁 Downloading {len(file_ids)} file(s)...")
+    await message.answer(f"📁 Downloading {session['file_count']} file(s)...")
     
-    sent_messages = []
-    for i, file_id in enumerate(file_ids):
-        try:
-            caption = captions[i] if i < len(captions) else ""
-            protect_content = session['protect_content'] and not is_owner
-            
-            # Try different file types
-            try:
-                msg = await message.answer_document(
-                    document=file_id,
-                    caption=caption,
-                    protect_content=protect_content
-                )
-                sent_messages.append(msg.message_id)
-            except:
-                try:
-                    msg = await message.answer_photo(
-                        photo=file_id,
-                        caption=caption,
-                        protect_content=protect_content
-                    )
-                    sent_messages.append(msg.message_id)
-                except:
-                    try:
-                        msg = await message.answer_video(
-                            video=file_id,
-                            caption=caption,
-                            protect_content=protect_content
-                        )
-                        sent_messages.append(msg.message_id)
-                    except:
-                        await message.answer(f"❌ Error sending file {i+1}")
-            
-            await asyncio.sleep(0.5)
-            
-        except Exception as e:
-            logger.error(f"Error sending file {i}: {e}")
-            await message.answer(f"❌ Error sending file {i+1}")
-    
-    # Handle auto-delete for non-owners
-    if not is_owner and session['auto_delete_minutes'] > 0:
-        delete_notice = f"\n\n⚠️ These files will be automatically deleted in {BotUtils.format_time(session['auto_delete_minutes'])}."
-        await message.answer(delete_notice)
-        
-        # Schedule deletion
-        asyncio.create_task(
-            delete_files_after_delay(message.chat.id, sent_messages, session['auto_delete_minutes'])
-        )
+    # Files are sent by a background task, page by page
+    delivery.start(message.chat.id, message.from_user.id, session, 0, is_owner)
 
-async def delete_files_after_delay(chat_id: int, message_ids: list, delay_minutes: int):
-    """Delete files after specified delay"""
-    await asyncio.sleep(delay_minutes * 60)
+# Next page of a deep link session
+@dp.callback_query_handler(lambda c: c.data.startswith('next:'), state='*')
+async def next_page_callback(callback_query: types.CallbackQuery):
+    _, session_id, offset = callback_query.data.split(':')
     
-    try:
-        for msg_id in message_ids:
-            try:
-                await bot.delete_message(chat_id, msg_id)
-            except Exception as e:
-                logger.error(f"Error deleting message {msg_id}: {e}")
-    except Exception as e:
-        logger.error(f"Error in auto-delete: {e}")
+    if not SessionTokens.verify(session_id) and not db.has_legacy_session(session_id):
+        await callback_query.answer("❌ Invalid or expired session link.", show_alert=True)
+        return
+    
+    # The access was counted when the link was opened
+    session = await db.get_upload_session(session_id, count_access=False)
+    if not session:
+        await callback_query.answer("❌ Invalid or expired session link.", show_alert=True)
+        return
+    
+    started = delivery.start(
+        callback_query.message.chat.id, callback_query.from_user.id, session, int(offset),
+        Validation.is_owner(callback_query.from_user.id)
+    )
+    if started:
+        await callback_query.message.edit_reply_markup()
+    await callback_query.answer()
 
 # Error handler
 @dp.errors_handler()
 async def errors_handler(update, exception):
+    HANDLER_ERRORS.inc(type(exception).__name__)
     logger.error(f"Update {update} caused error {exception}")
     return True
 
@@ -502,31 +743,102 @@ async def errors_handler(update, exception):
 async def health_check(request):
     return web.Response(text="ok")
 
+# Readiness check, fails while the database is unreachable
+async def readiness_check(request):
+    try:
+        await asyncio.wait_for(db.ping(), timeout=2)
+    except Exception as e:
+        return web.Response(status=503, text=f"database unavailable: {e}")
+    return web.Response(text="ready")
+
+# Prometheus metrics endpoint
+async def metrics_handler(request):
+    return web.Response(text=await metrics.render(), content_type='text/plain')
+
 # Webhook handler
 async def webhook_handler(request):
-    if request.method == "POST":
+    if config.WEBHOOK_SECRET and request.headers.get('X-Telegram-Bot-Api-Secret-Token') != config.WEBHOOK_SECRET:
+        return web.Response(status=403)
+    
+    try:
         update = types.Update(**await request.json())
-        await dp.process_update(update)
+    except Exception as e:
+        logger.warning(f"Rejected malformed webhook update: {e}")
+        return web.Response(status=400)
+    if update.update_id is None:
+        return web.Response(status=400)
+    
+    if not updates.received_count:
+        elapsed = startup.elapsed()
+        log = logger.warning if elapsed > config.STARTUP_BUDGET else logger.info
+        log(f"First update received {elapsed:.2f}s after start (budget {config.STARTUP_BUDGET:g}s)")
+    
+    # Acknowledge right away, the update is processed by the update queue workers
+    if not updates.put(update):
+        return web.Response(status=503, headers={'Retry-After': '1'})
     return web.Response()
 
 # Initialize application
+deferred_startup_task = None
+
 async def on_startup(app):
-    await db.init()
-    await db.update_statistics()
+    startup.mark('app setup')
+    await db.init(timer=startup)
+    storage.start()
+    deleter.start()
+    sweeper.start()
+    updates.start()
+    startup.mark('workers')
+    
+    # Everything else waits until updates are being served
+    global deferred_startup_task
+    deferred_startup_task = asyncio.create_task(deferred_startup())
+    
+    elapsed = startup.elapsed()
+    log = logger.warning if elapsed > config.STARTUP_BUDGET else logger.info
+    log(f"Ready to serve {elapsed * 1000:.0f} ms after start: {startup.summary()}")
+
+async def deferred_startup():
+    """Startup work no update depends on"""
+    # With several web workers only one of them owns broadcasts and the webhook
+    if not config.IS_OWNER_WORKER:
+        return
+    
+    try:
+        await broadcaster.resume()
+    except Exception as e:
+        logger.error(f"Failed to resume broadcasts: {e}")
     
+    # Telegram keeps the webhook between restarts, so cold starts are served before it is set again
     if config.WEBHOOK_HOST:
-        await bot.set_webhook(config.WEBHOOK_URL)
-        logger.info(f"Webhook set to {config.WEBHOOK_URL}")
+        try:
+            await bot.set_webhook(config.WEBHOOK_URL, secret_token=config.WEBHOOK_SECRET)
+            logger.info(f"Webhook set to {config.WEBHOOK_URL}")
+        except Exception as e:
+            logger.error(f"Failed to set webhook: {e}")
 
 async def on_shutdown(app):
-    await bot.delete_webhook()
+    # The webhook stays set, Telegram holds the updates that arrive until the next start takes them
+    if deferred_startup_task:
+        await deferred_startup_task
+    await updates.close()
+    await albums.close()
     await dp.storage.close()
+    await broadcaster.close()
+    await delivery.close()
+    await deleter.close()
+    await sweeper.close()
+    await profiler.close()
+    await bot.outbound.close()
+    await db.close()
     await bot.session.close()
 
 # Create aiohttp web application
 def create_web_app():
     app = web.Application()
     app.router.add_get('/health', health_check)
+    app.router.add_get('/ready', readiness_check)
+    app.router.add_get('/metrics', metrics_handler)
     app.router.add_post(config.WEBHOOK_PATH, webhook_handler)
     app.on_startup.append(on_startup)
     app.on_shutdown.append(on_shutdown)
@@ -534,7 +846,11 @@ def create_web_app():
 
 # Main function
 if __name__ == '__main__':
-    if config.WEBHOOK_HOST:
+    if config.WEBHOOK_HOST and config.WEB_WORKERS > 1 and config.WORKER_INDEX is None:
+        # Front process: runs the workers (copies of this script) and routes updates to them by chat
+        from router import run_router
+        run_router(os.path.abspath(__file__))
+    elif config.WEBHOOK_HOST:
         web_app = create_web_app()
         web.run_app(
             web_app,
@@ -542,4 +858,5 @@ if __name__ == '__main__':
             port=config.WEBAPP_PORT
         )
     else:
-        executor.start_polling(dp, skip_updates=True)
+        from aiogram.utils import executor
+        executor.start_polling(dp, skip_updates=True, on_startup=on_startup, on_shutdown=on_shutdown)
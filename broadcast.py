@@ -0,0 +1,187 @@
+import asyncio
+import logging
+from aiogram.utils import exceptions
+
+from config import config
+from outbound import send_priority
+
+logger = logging.getLogger(__name__)
+
+class BroadcastManager:
+    """Run persisted broadcast jobs in the background with a bounded worker pool"""
+
+    def __init__(self, bot, db):
+        self.bot = bot
+        self.db = db
+        # job_id -> asyncio.Task for jobs running in this process
+        self.tasks = {}
+        self.cancelled = set()
+
+    async def start(self, owner_id: int, from_chat_id: int, message_id: int):
+        """Create a job copying message_id from from_chat_id to every recipient and start it"""
+        total = await self.db.count_broadcast_recipients()
+        progress = await self.bot.send_message(from_chat_id, f"📢 Starting broadcast to {total} users...")
+        job = await self.db.create_broadcast_job(
+            owner_id=owner_id,
+            from_chat_id=from_chat_id,
+            message_id=message_id,
+            progress_chat_id=progress.chat.id,
+            progress_message_id=progress.message_id,
+            total_count=total
+        )
+        self._spawn(job)
+        return job
+
+    async def resume(self):
+        """Pick up jobs that were still running when the process stopped"""
+        for job in await self.db.get_running_broadcast_jobs():
+            if job['id'] not in self.tasks:
+                logger.info(f"Resuming broadcast #{job['id']} after user {job['last_user_id']}")
+                self._spawn(job)
+
+    async def cancel(self) -> list:
+        """Cancel all running jobs, including ones owned by other instances"""
+        job_ids = await self.db.cancel_broadcast_jobs()
+        self.cancelled.update(job_id for job_id in job_ids if job_id in self.tasks)
+        return job_ids
+
+    async def close(self):
+        """Stop local workers, leaving jobs marked running so they resume on next start"""
+        tasks = list(self.tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def _spawn(self, job):
+        task = asyncio.create_task(self._run(job))
+        self.tasks[job['id']] = task
+        task.add_done_callback(lambda t: self.tasks.pop(job['id'], None))
+
+    async def _run(self, job):
+        # Rate limits and RetryAfter are handled by the bot's outbound scheduler
+        send_priority.set('broadcast')
+        job_id = job['id']
+        counts = {
+            'sent': job['sent_count'],
+            'failed': job['failed_count'],
+            'blocked': job['blocked_count']
+        }
+        last_user_id = job['last_user_id']
+        loop = asyncio.get_running_loop()
+        last_edit = loop.time()
+        status = 'done'
+
+        try:
+            while True:
+                if job_id in self.cancelled:
+                    status = 'cancelled'
+                    break
+
+                recipients = await self.db.get_broadcast_recipients(last_user_id, config.BROADCAST_PAGE_SIZE)
+                if not recipients:
+                    break
+
+                db_status = await self._send_page(job, recipients, counts, last_user_id)
+                last_user_id = recipients[-1]
+                if db_status != 'running':
+                    status = db_status
+                    break
+
+                if loop.time() - last_edit >= config.BROADCAST_PROGRESS_INTERVAL:
+                    await self._edit_progress(job, counts, 'in progress')
+                    last_edit = loop.time()
+        except Exception as e:
+            logger.error(f"Broadcast #{job_id} failed: {e}")
+            status = 'failed'
+
+        self.cancelled.discard(job_id)
+        try:
+            await self.db.finish_broadcast_job(job_id, status)
+        except Exception as e:
+            logger.error(f"Failed to finish broadcast #{job_id}: {e}")
+        await self._edit_progress(job, counts, status)
+
+    async def _send_page(self, job, recipients: list, counts: dict, last_user_id: int) -> str:
+        """Send to one page of recipients with BROADCAST_WORKERS concurrent workers.
+
+        Progress is saved every BROADCAST_CHECKPOINT_INTERVAL seconds and when
+        the page is done, up to the last recipient all earlier sends finished
+        for, so a restart resends only what went out since the last save.
+        Returns the job status read back with the last save.
+        """
+        pending = iter(enumerate(recipients))
+        finished = [False] * len(recipients)
+        blocked_ids = []
+        saved = 0
+        status = 'running'
+
+        async def worker():
+            for i, user_id in pending:
+                if job['id'] in self.cancelled or status != 'running':
+                    return
+                result = await self._send(job, user_id)
+                counts[result] += 1
+                if result == 'blocked':
+                    blocked_ids.append(user_id)
+                finished[i] = True
+
+        async def save():
+            nonlocal saved, status
+            while saved < len(recipients) and finished[saved]:
+                saved += 1
+            if blocked_ids:
+                user_ids = blocked_ids[:]
+                blocked_ids.clear()
+                await self.db.mark_users_blocked(user_ids)
+            status = await self.db.update_broadcast_progress(
+                job['id'], recipients[saved - 1] if saved else last_user_id,
+                counts['sent'], counts['failed'], counts['blocked']
+            )
+
+        workers = asyncio.ensure_future(asyncio.gather(*(worker() for _ in range(config.BROADCAST_WORKERS))))
+        try:
+            while not workers.done():
+                await asyncio.wait({workers}, timeout=config.BROADCAST_CHECKPOINT_INTERVAL)
+                if not workers.done():
+                    await save()
+            workers.result()
+        except BaseException:
+            workers.cancel()
+            await asyncio.gather(workers, return_exceptions=True)
+            raise
+        await save()
+        return status
+
+    async def _send(self, job, user_id: int) -> str:
+        try:
+            await self.bot.copy_message(
+                chat_id=user_id,
+                from_chat_id=job['from_chat_id'],
+                message_id=job['message_id']
+            )
+            return 'sent'
+        except (exceptions.BotBlocked, exceptions.UserDeactivated, exceptions.ChatNotFound):
+            return 'blocked'
+        except Exception as e:
+            logger.error(f"Failed to send broadcast to {user_id}: {e}")
+            return 'failed'
+
+    async def _edit_progress(self, job, counts: dict, status: str):
+        done = counts['sent'] + counts['failed'] + counts['blocked']
+        text = f"""
+📢 Broadcast #{job['id']} {status}:
+✅ Success: {counts['sent']}
+❌ Failed: {counts['failed']}
+🚫 Blocked: {counts['blocked']}
+📊 Progress: {done}/{job['total_count']}
+        """
+        try:
+            await self.bot.edit_message_text(
+                text,
+                chat_id=job['progress_chat_id'],
+                message_id=job['progress_message_id']
+            )
+        except exceptions.MessageNotModified:
+            pass
+        except Exception as e:
+            logger.error(f"Failed to update broadcast #{job['id']} progress: {e}")
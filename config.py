@@ -7,13 +7,117 @@ class Config:
     BOT_TOKEN = os.getenv('BOT_TOKEN')
     OWNER_ID = int(os.getenv('OWNER_ID', 0))
     DATABASE_URL = os.getenv('DATABASE_URL')
+    # 'postgres', or 'memory' to keep everything in process memory (benchmarks, local runs)
+    DATABASE_BACKEND = os.getenv('DATABASE_BACKEND', 'postgres')
+    DB_POOL_MIN_SIZE = int(os.getenv('DB_POOL_MIN_SIZE', 2))
+    DB_POOL_MAX_SIZE = int(os.getenv('DB_POOL_MAX_SIZE', 10))
+    # Set to 0 behind a transaction-mode pgbouncer
+    DB_STATEMENT_CACHE_SIZE = int(os.getenv('DB_STATEMENT_CACHE_SIZE', 100))
+    DB_COMMAND_TIMEOUT = float(os.getenv('DB_COMMAND_TIMEOUT', 30))
+    DB_MAX_QUERIES = int(os.getenv('DB_MAX_QUERIES', 50000))
+    DB_MAX_INACTIVE_LIFETIME = float(os.getenv('DB_MAX_INACTIVE_LIFETIME', 300))
     UPLOAD_CHANNEL_ID = os.getenv('UPLOAD_CHANNEL_ID')
+    # Local Bot API server or the benchmark's fake one, api.telegram.org when unset
+    TELEGRAM_API_URL = os.getenv('TELEGRAM_API_URL')
     
     WEBHOOK_HOST = os.getenv('RENDER_EXTERNAL_URL')
     WEBHOOK_PATH = '/webhook'
     WEBHOOK_URL = f"{WEBHOOK_HOST}{WEBHOOK_PATH}" if WEBHOOK_HOST else None
+    WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')
     
     WEBAPP_HOST = '0.0.0.0'
     WEBAPP_PORT = int(os.getenv('PORT', 5000))
+    
+    # Webhook worker processes. Above 1 the process started on PORT only routes each update,
+    # by chat, to one of the workers, each a full bot listening on WORKER_BASE_PORT + its index
+    WEB_WORKERS = max(1, int(os.getenv('WEB_WORKERS', 1)))
+    WORKER_BASE_PORT = int(os.getenv('WORKER_BASE_PORT', 8100))
+    # Set by the router for the workers it starts, None in a single process
+    WORKER_INDEX = int(os.environ['WORKER_INDEX']) if os.getenv('WORKER_INDEX') else None
+    if WORKER_INDEX is not None:
+        WEBAPP_HOST = '127.0.0.1'
+        WEBAPP_PORT = WORKER_BASE_PORT + WORKER_INDEX
+    # Jobs only one process may run (resuming broadcasts, setting the webhook) belong to the
+    # worker that receives the owner's chat, which is where /broadcast starts them as well
+    IS_OWNER_WORKER = WORKER_INDEX is None or WORKER_INDEX == OWNER_ID % WEB_WORKERS
+    
+    UPDATE_WORKERS = int(os.getenv('UPDATE_WORKERS', 8))
+    UPDATE_QUEUE_SIZE = int(os.getenv('UPDATE_QUEUE_SIZE', 1000))
+    UPDATE_DEDUP_SIZE = int(os.getenv('UPDATE_DEDUP_SIZE', 10000))
+    UPDATE_DRAIN_TIMEOUT = float(os.getenv('UPDATE_DRAIN_TIMEOUT', 10))
+    
+    ACTIVITY_FLUSH_INTERVAL = float(os.getenv('ACTIVITY_FLUSH_INTERVAL', 5))
+    ACTIVITY_FLUSH_SIZE = int(os.getenv('ACTIVITY_FLUSH_SIZE', 500))
+    
+    FSM_CACHE_SIZE = int(os.getenv('FSM_CACHE_SIZE', 10000))
+    FSM_CACHE_TTL = float(os.getenv('FSM_CACHE_TTL', 60))
+    FSM_STATE_TTL = int(os.getenv('FSM_STATE_TTL', 86400))
+    FSM_SWEEP_INTERVAL = float(os.getenv('FSM_SWEEP_INTERVAL', 600))
+    
+    # Seconds from process start to the first update, slower cold starts are logged as warnings
+    STARTUP_BUDGET = float(os.getenv('STARTUP_BUDGET', 5))
+    
+    # Quiet period after the last item of an album before it is added as one batch
+    UPLOAD_ALBUM_WINDOW = float(os.getenv('UPLOAD_ALBUM_WINDOW', 1.0))
+    
+    # Files sent per page of a deep link, the rest waits behind a "Next" button
+    DELIVERY_PAGE_SIZE = int(os.getenv('DELIVERY_PAGE_SIZE', 20))
+    
+    # Deep-link page deliveries are logged as access events, buffered and written in batches.
+    # Events beyond ACCESS_LOG_MAX_PENDING (database unreachable for long) are dropped
+    ACCESS_LOG_FLUSH_SIZE = int(os.getenv('ACCESS_LOG_FLUSH_SIZE', 1000))
+    ACCESS_LOG_MAX_PENDING = int(os.getenv('ACCESS_LOG_MAX_PENDING', 100000))
+    # Raw access events older than this are deleted by the session sweeper, 0 keeps them.
+    # /top reads the hourly rollup, which is kept
+    ACCESS_EVENT_RETENTION_DAYS = int(os.getenv('ACCESS_EVENT_RETENTION_DAYS', 30))
+    # Sessions listed by /top
+    TOP_SESSIONS_LIMIT = int(os.getenv('TOP_SESSIONS_LIMIT', 10))
+    
+    # Signs deep-link session tokens, falls back to BOT_TOKEN (links then break when the token is rotated)
+    SESSION_SECRET = os.getenv('SESSION_SECRET')
+    SESSION_CACHE_SIZE = int(os.getenv('SESSION_CACHE_SIZE', 1000))
+    # Cached pages of session files, a page holds up to DELIVERY_PAGE_SIZE file ids
+    SESSION_PAGE_CACHE_SIZE = int(os.getenv('SESSION_PAGE_CACHE_SIZE', 1000))
+    SESSION_CACHE_TTL = float(os.getenv('SESSION_CACHE_TTL', 300))
+    # Expired sessions are deleted every SESSION_SWEEP_INTERVAL seconds, SESSION_SWEEP_BATCH_SIZE at a time.
+    # Above 0, sessions nobody opened within SESSION_UNUSED_DAYS of their creation are deleted as well
+    SESSION_SWEEP_INTERVAL = float(os.getenv('SESSION_SWEEP_INTERVAL', 600))
+    SESSION_SWEEP_BATCH_SIZE = int(os.getenv('SESSION_SWEEP_BATCH_SIZE', 500))
+    SESSION_UNUSED_DAYS = int(os.getenv('SESSION_UNUSED_DAYS', 0))
+    
+    # Outbound sends, Telegram allows roughly 30 messages per second overall,
+    # one per second in a private chat and 20 per minute in a group or channel.
+    # The global limit is for the whole bot. With several web workers the owner's worker,
+    # which runs the broadcasts, gets SEND_BROADCAST_SHARE of it and all workers split the rest evenly
+    SEND_GLOBAL_RATE = float(os.getenv('SEND_GLOBAL_RATE', 25))
+    SEND_GLOBAL_BURST = int(os.getenv('SEND_GLOBAL_BURST', 30))
+    SEND_BROADCAST_SHARE = float(os.getenv('SEND_BROADCAST_SHARE', 0.5))
+    SEND_CHAT_RATE = float(os.getenv('SEND_CHAT_RATE', 1))
+    SEND_GROUP_RATE = float(os.getenv('SEND_GROUP_RATE', 20 / 60))
+    SEND_CHAT_BURST = int(os.getenv('SEND_CHAT_BURST', 3))
+    # RetryAfter pauses only the chat it came from, all sends are paused once
+    # SEND_GLOBAL_PAUSE_CHATS different chats were rate limited within SEND_GLOBAL_PAUSE_WINDOW seconds
+    SEND_GLOBAL_PAUSE_CHATS = int(os.getenv('SEND_GLOBAL_PAUSE_CHATS', 3))
+    SEND_GLOBAL_PAUSE_WINDOW = float(os.getenv('SEND_GLOBAL_PAUSE_WINDOW', 10))
+    SEND_MAX_RETRIES = int(os.getenv('SEND_MAX_RETRIES', 3))
+    # First network error backoff in seconds, doubled on every further attempt
+    SEND_BACKOFF = float(os.getenv('SEND_BACKOFF', 1.0))
+    
+    BROADCAST_WORKERS = int(os.getenv('BROADCAST_WORKERS', 10))
+    BROADCAST_PAGE_SIZE = int(os.getenv('BROADCAST_PAGE_SIZE', 500))
+    BROADCAST_PROGRESS_INTERVAL = float(os.getenv('BROADCAST_PROGRESS_INTERVAL', 5))
+    # Seconds between saves of a running broadcast's position, bounds what a restart resends
+    BROADCAST_CHECKPOINT_INTERVAL = float(os.getenv('BROADCAST_CHECKPOINT_INTERVAL', 2))
+    
+    # Rows per bulk load of /import
+    IMPORT_BATCH_SIZE = int(os.getenv('IMPORT_BATCH_SIZE', 1000))
+    
+    DELETION_POLL_INTERVAL = float(os.getenv('DELETION_POLL_INTERVAL', 60))
+    DELETION_BATCH_SIZE = int(os.getenv('DELETION_BATCH_SIZE', 500))
+    DELETION_CLAIM_SECONDS = int(os.getenv('DELETION_CLAIM_SECONDS', 300))
+    
+    PROFILE_SAMPLE_INTERVAL = float(os.getenv('PROFILE_SAMPLE_INTERVAL', 0.005))
+    PROFILE_MAX_SECONDS = int(os.getenv('PROFILE_MAX_SECONDS', 600))
+    PROFILE_TOP_STACKS = int(os.getenv('PROFILE_TOP_STACKS', 25))
 
 config = Config()
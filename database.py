@@ -1,72 +1,1060 @@
+import asyncio
+import logging
+import re
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict, defaultdict
+from contextlib import asynccontextmanager
 import asyncpg
-from datetime import datetime
+from datetime import datetime, timedelta
 import json
 from config import config
+from metrics import DB_POOL_WAIT_SECONDS, DB_QUERY_SECONDS
+from profiler import record_await
+from utils import FileHandler, SessionTokens
+
+logger = logging.getLogger(__name__)
+
+# Random ids of sessions created before signed tokens
+LEGACY_SESSION_ID = re.compile(r'[A-Za-z0-9]{12}')
+
+# Columns of /export files and /import records, in order
+USER_COLUMNS = ('id', 'username', 'first_name', 'last_name', 'join_date', 'last_active', 'is_banned', 'is_blocked')
+SESSION_COLUMNS = (
+    'session_id', 'owner_id', 'file_count', 'protect_content', 'auto_delete_minutes',
+    'delivery_mode', 'created_at', 'access_count', 'expires_at'
+)
+SESSION_FILE_COLUMNS = ('session_id', 'position', 'file_id', 'file_unique_id', 'file_type', 'caption')
+
+# Columns of session_access_events, in the order of the buffered event tuples
+ACCESS_EVENT_COLUMNS = ('session_id', 'user_id', 'accessed_at', 'first_file', 'files_delivered', 'latency_ms')
+
+EXPORT_QUERIES = {
+    'users': f"SELECT {', '.join(USER_COLUMNS)} FROM users ORDER BY id",
+    # One row per session, its files as a JSON array in delivery order
+    'sessions': f'''
+        SELECT {', '.join('s.' + column for column in SESSION_COLUMNS)},
+            (SELECT COALESCE(json_agg(json_build_object(
+                'file_id', f.file_id, 'file_unique_id', f.file_unique_id,
+                'file_type', f.file_type, 'caption', f.caption
+            ) ORDER BY f.position), '[]') FROM session_files f WHERE f.session_id = s.session_id) AS files
+        FROM upload_sessions s
+        ORDER BY s.created_at, s.session_id
+    '''
+}
+
+# pg_advisory_lock key held while migrations run
+MIGRATION_LOCK_ID = 727_001
+
+class QueryTimings:
+    """Per-method pool wait and query time, to tell pool exhaustion from slow queries"""
+
+    def __init__(self):
+        # name -> [calls, wait_total, wait_max, query_total, query_max]
+        self.methods = defaultdict(lambda: [0, 0.0, 0.0, 0.0, 0.0])
+
+    def record(self, name: str, wait: float, query: float):
+        entry = self.methods[name]
+        entry[0] += 1
+        entry[1] += wait
+        entry[2] = max(entry[2], wait)
+        entry[3] += query
+        entry[4] = max(entry[4], query)
+
+    def stats(self) -> dict:
+        return {
+            name: {
+                'calls': calls,
+                'wait_avg': wait_total / calls,
+                'wait_max': wait_max,
+                'query_avg': query_total / calls,
+                'query_max': query_max
+            }
+            for name, (calls, wait_total, wait_max, query_total, query_max) in self.methods.items()
+        }
+
+class ActivityBuffer:
+    """Collect user activity in memory and hand it out in merged batches"""
+
+    def __init__(self, flush_interval: float, flush_size: int):
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        # user_id -> (username, first_name, last_name) for /start, None for a plain touch
+        self.pending = {}
+        self.buffered_count = 0
+        self.flushed_count = 0
+        self.flush_count = 0
+        self.stopping = False
+        self.wakeup = asyncio.Event()
+
+    def touch(self, user_id: int, profile: tuple = None):
+        # A profile upsert always wins over a bare last_active touch
+        if profile is not None or user_id not in self.pending:
+            self.pending[user_id] = profile
+        self.buffered_count += 1
+        if len(self.pending) >= self.flush_size:
+            self.wakeup.set()
+
+    def drain(self) -> dict:
+        pending, self.pending = self.pending, {}
+        return pending
+
+    def requeue(self, pending: dict):
+        """Put back a batch that failed to flush without clobbering newer touches"""
+        for user_id, profile in pending.items():
+            if self.pending.get(user_id) is None:
+                self.pending[user_id] = profile
+
+class SessionCache:
+    """Bounded LRU cache with a TTL, of decoded upload sessions or of session file pages"""
+
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        # key -> (expires_at, value)
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                del self.entries[key]
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, key, value):
+        self.entries[key] = (time.monotonic() + self.ttl, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, key):
+        self.entries.pop(key, None)
+
+# Rows created on first start, existing messages are never overwritten
+DEFAULT_MESSAGES = [
+    ('start_message', '👋 Welcome to File Sharing Bot!\n\nUse /help to learn how to use this bot.', None),
+    ('help_message', '📖 **Help Guide**\n\n• Use deep links to access files\n• Contact owner for support', None)
+]
+
+class BaseDatabase(ABC):
+    """Backend-independent part of the storage layer.
+
+    Buffers user activity and deep-link hits, caches messages and decoded
+    upload sessions and runs the background flush. Subclasses implement the
+    storage itself with the same methods and return values: Database on
+    Postgres, MemoryDatabase (memory_database.py) in process memory for
+    benchmarks and local runs without a server.
+    """
 
-class Database:
     def __init__(self):
         self.pool = None
+        self.timings = QueryTimings()
+        self.activity = ActivityBuffer(config.ACTIVITY_FLUSH_INTERVAL, config.ACTIVITY_FLUSH_SIZE)
+        self._flush_task = None
+        self.sessions = SessionCache(config.SESSION_CACHE_SIZE, config.SESSION_CACHE_TTL)
+        # Pages of session files, (session_id, offset, limit) -> files, bounded apart from the sessions
+        self.session_pages = SessionCache(config.SESSION_PAGE_CACHE_SIZE, config.SESSION_CACHE_TTL)
+        # session_id -> deep-link hits not yet added to the stored access_count
+        self.access_counts = {}
+        self.access_flushed_count = 0
+        self.access_flush_count = 0
+        # Access event tuples (ACCESS_EVENT_COLUMNS) not yet written, see record_access
+        self.access_events = []
+        self.access_events_flushed = 0
+        self.access_events_dropped = 0
+        # message_type -> row, kept in sync by set_message
+        self.messages = {}
+        # NOTIFY channel -> (listener callback, coroutine resyncing after a reconnect)
+        self.invalidation_handlers = {}
+        # Ids of sessions created before signed tokens, the only unsigned links still accepted,
+        # None while they are loaded in the background after startup
+        self.legacy_session_ids = None
+
+    def _start_flush_loop(self):
+        self._flush_task = asyncio.create_task(self._flush_loop())
+
+    async def _stop_flush_loop(self):
+        if self._flush_task:
+            self.activity.stopping = True
+            self.activity.wakeup.set()
+            await self._flush_task
+            self._flush_task = None
+
+    def touch_user(self, user_id: int):
+        """Buffer a last_active update, written by the next activity flush"""
+        self.activity.touch(user_id)
+
+    def register_user(self, user_id: int, username: str, first_name: str, last_name: str = None):
+        """Buffer an add_user upsert, written by the next activity flush"""
+        self.activity.touch(user_id, (username, first_name, last_name))
+
+    @abstractmethod
+    async def flush_activity(self) -> int:
+        """Write the buffered activity, returns the number of users written"""
+
+    @abstractmethod
+    async def flush_access_counts(self) -> int:
+        """Write the buffered deep-link hit counts, returns the number of sessions written"""
+
+    def record_access(self, session_id: str, user_id: int, first_file: int, files_delivered: int, latency: float):
+        """Buffer an access event for a delivered page, written by the next flush"""
+        if len(self.access_events) >= config.ACCESS_LOG_MAX_PENDING:
+            self.access_events_dropped += 1
+            return
+        self.access_events.append(
+            (session_id, user_id, datetime.now(), first_file, files_delivered, round(latency * 1000))
+        )
+        if len(self.access_events) >= config.ACCESS_LOG_FLUSH_SIZE:
+            self.activity.wakeup.set()
+
+    @abstractmethod
+    async def flush_access_events(self) -> int:
+        """Write the buffered access events, returns the number written"""
+
+    def _requeue_access_events(self, events: list):
+        """Put back a batch that failed to flush ahead of newer events"""
+        self.access_events = (events + self.access_events)[:config.ACCESS_LOG_MAX_PENDING]
+
+    @staticmethod
+    def _access_rollups(events: list) -> dict:
+        """(hour, session_id) -> [opens, pages, files, latency_ms] for a batch of access events"""
+        rollups = defaultdict(lambda: [0, 0, 0, 0])
+        for session_id, user_id, accessed_at, first_file, files_delivered, latency_ms in events:
+            totals = rollups[(accessed_at.replace(minute=0, second=0, microsecond=0), session_id)]
+            # A deep link opens a session, later pages come from its "Next" button
+            if first_file == 0:
+                totals[0] += 1
+            totals[1] += 1
+            totals[2] += files_delivered
+            totals[3] += latency_ms
+        return rollups
+
+    @staticmethod
+    def _hours_ago(hours: int) -> datetime:
+        """Start of the hour bucket that begins a window of the last `hours` hours, the current one included"""
+        return datetime.now().replace(minute=0, second=0, microsecond=0) - timedelta(hours=hours - 1)
+
+    async def _flush_loop(self):
+        """Background writer for buffered user activity, session access counts and access events"""
+        while not self.activity.stopping:
+            try:
+                await asyncio.wait_for(self.activity.wakeup.wait(), self.activity.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self.activity.wakeup.clear()
+            
+            try:
+                await self.flush_activity()
+            except Exception as e:
+                logger.error(f"Failed to flush user activity: {e}")
+            
+            try:
+                await self.flush_access_counts()
+            except Exception as e:
+                logger.error(f"Failed to flush session access counts: {e}")
+            
+            try:
+                await self.flush_access_events()
+            except Exception as e:
+                logger.error(f"Failed to flush session access events: {e}")
+
+    async def get_message(self, message_type: str):
+        """Return a start/help message, served from the in-memory cache"""
+        if message_type in self.messages:
+            return self.messages[message_type]
+        row = await self._load_message(message_type)
+        self.messages[message_type] = row
+        return row
+
+    @abstractmethod
+    async def _load_message(self, message_type: str):
+        """Message row or None, bypassing the cache"""
+
+    async def get_upload_session(self, session_id: str, count_access: bool = True):
+        """Return the decoded session and count the access, served from the session cache when possible"""
+        session = self.sessions.get(session_id)
+        if session is None:
+            session = await self._load_upload_session(session_id)
+            if not session:
+                return None
+            self.sessions.put(session_id, session)
+        
+        # Expired sessions are gone for users before the sweeper deletes them
+        if session['expires_at'] and session['expires_at'] <= datetime.now():
+            return None
+        
+        if count_access:
+            self.access_counts[session_id] = self.access_counts.get(session_id, 0) + 1
+        return session
+
+    @abstractmethod
+    async def _load_upload_session(self, session_id: str):
+        """Decoded session (see Database._decode_session) or None"""
+
+    async def get_session_files(self, session_id: str, offset: int, limit: int) -> list:
+        """Files at positions offset..offset+limit-1 as dicts of file_id, file_type and caption, cached per page"""
+        key = (session_id, offset, limit)
+        files = self.session_pages.get(key)
+        if files is None:
+            files = await self._load_session_files(session_id, offset, limit)
+            self.session_pages.put(key, files)
+        return files
+
+    @abstractmethod
+    async def _load_session_files(self, session_id: str, offset: int, limit: int) -> list:
+        """One page of a session's files, bypassing the cache"""
+
+    def _remember_imported_sessions(self, session_ids: list):
+        if self.legacy_session_ids is not None:
+            self.legacy_session_ids.update(
+                session_id for session_id in session_ids if LEGACY_SESSION_ID.fullmatch(session_id)
+            )
+
+    def has_legacy_session(self, session_id: str) -> bool:
+        if self.legacy_session_ids is None:
+            # Not loaded yet, let the session lookup decide
+            return LEGACY_SESSION_ID.fullmatch(session_id) is not None
+        return session_id in self.legacy_session_ids
+
+    # The storage interface, implemented by Database and MemoryDatabase with the same return values
+
+    @abstractmethod
+    async def init(self, timer=None):
+        """Connect, prepare the schema and caches and start the background flush"""
+
+    @abstractmethod
+    async def close(self):
+        """Stop background writers, flush what is buffered and release the storage"""
+
+    @abstractmethod
+    async def ping(self):
+        """Round-trip to the storage, used by the readiness check"""
+
+    # Users and broadcasts
+
+    @abstractmethod
+    async def add_user(self, user_id: int, username: str, first_name: str, last_name: str = None):
+        """Insert or update a user right away, register_user buffers the same upsert"""
+
+    @abstractmethod
+    async def get_all_users(self):
+        """Users that are neither banned nor blocked"""
+
+    @abstractmethod
+    async def count_broadcast_recipients(self):
+        """How many users get_all_users returns, the audience of a broadcast"""
+
+    @abstractmethod
+    async def get_broadcast_recipients(self, after_user_id: int, limit: int):
+        """Next page of recipient ids after after_user_id, in id order"""
+
+    @abstractmethod
+    async def mark_users_blocked(self, user_ids: list):
+        """Leave these users out of later broadcasts"""
+
+    @abstractmethod
+    async def create_broadcast_job(self, owner_id: int, from_chat_id: int, message_id: int,
+                                   progress_chat_id: int, progress_message_id: int, total_count: int):
+        """Record a running broadcast job, returns its row"""
+
+    @abstractmethod
+    async def get_running_broadcast_jobs(self):
+        """Jobs to resume after a restart"""
+
+    @abstractmethod
+    async def update_broadcast_progress(self, job_id: int, last_user_id: int, sent_count: int,
+                                        failed_count: int, blocked_count: int):
+        """Advance the job cursor and return the job status, which may have been cancelled meanwhile"""
 
-    async def init(self):
-        self.pool = await asyncpg.create_pool(config.DATABASE_URL)
-        await self.create_tables()
+    @abstractmethod
+    async def finish_broadcast_job(self, job_id: int, status: str):
+        """Close a job with its final status"""
 
-    async def create_tables(self):
+    @abstractmethod
+    async def cancel_broadcast_jobs(self):
+        """Cancel every running broadcast job and return their ids"""
+
+    # Activity statistics
+
+    @abstractmethod
+    async def get_active_users_counts(self):
+        """Active users over the last 1h/24h/48h/7d/30d"""
+
+    @abstractmethod
+    async def get_daily_active_users(self, days: int = 7):
+        """Distinct active users per day, newest first"""
+
+    @abstractmethod
+    async def get_retention(self, offsets: list, cohort_days: int = 30):
+        """Share of users active N days after joining, over cohorts from the last cohort_days days"""
+
+    @abstractmethod
+    async def get_statistics(self):
+        """The statistics row, kept up to date on every write"""
+
+    @abstractmethod
+    async def reconcile_statistics(self, conn=None):
+        """Recount the statistics from scratch"""
+
+    # Messages
+
+    @abstractmethod
+    async def set_message(self, message_type: str, text: str, image_id: str = None):
+        """Store a start/help message and update the cache"""
+
+    @abstractmethod
+    async def load_messages(self):
+        """(Re)load every message into the cache"""
+
+    # FSM states
+
+    @abstractmethod
+    async def get_fsm_record(self, chat_id: int, user_id: int):
+        """State and data of a conversation, or None"""
+
+    @abstractmethod
+    async def set_fsm_state(self, chat_id: int, user_id: int, state: str, notify: str = None):
+        """Replace the conversation state"""
+
+    @abstractmethod
+    async def set_fsm_data(self, chat_id: int, user_id: int, data: dict, notify: str = None):
+        """Replace the conversation data"""
+
+    @abstractmethod
+    async def update_fsm_data(self, chat_id: int, user_id: int, data: dict, notify: str = None) -> dict:
+        """Shallow-merge data into the stored dict, returns the result"""
+
+    @abstractmethod
+    async def append_fsm_data(self, chat_id: int, user_id: int, items: dict, notify: str = None) -> dict:
+        """Append items[key] to the list stored under each key, returns the result"""
+
+    @abstractmethod
+    async def delete_fsm_record(self, chat_id: int, user_id: int, notify: str = None):
+        """Forget a conversation"""
+
+    @abstractmethod
+    async def expire_fsm_records(self, max_age_seconds: int, batch_size: int = 1000) -> int:
+        """Delete conversations untouched for max_age_seconds, returns the rows deleted"""
+
+    # Upload sessions
+
+    @abstractmethod
+    async def create_upload_session(self, session_id: str, owner_id: int, files: list, protect_content: bool,
+                                  auto_delete_minutes: int, delivery_mode: str = 'single', expires_at: datetime = None):
+        """files are dicts with file_id, file_unique_id, file_type and caption, in delivery order"""
+
+    @abstractmethod
+    async def next_upload_session_number(self) -> int:
+        """Next value of the session number sequence"""
+
+    @abstractmethod
+    async def expire_upload_sessions(self, unused_before: datetime = None, batch_size: int = 500) -> int:
+        """Delete expired sessions, and never opened ones created before unused_before; returns the sessions deleted"""
+
+    @abstractmethod
+    async def get_top_sessions(self, hours: int, limit: int):
+        """Most opened sessions over the last `hours` hours that still exist"""
+
+    @abstractmethod
+    async def delete_access_events(self, before: datetime, batch_size: int = 500) -> int:
+        """Delete access events older than before, returns the events deleted"""
+
+    # Auto-delete queue
+
+    @abstractmethod
+    async def add_pending_deletion(self, chat_id: int, message_ids: list, delay_minutes: int):
+        """Queue messages to delete after delay_minutes"""
+
+    @abstractmethod
+    async def claim_due_deletions(self, limit: int, claim_seconds: int, worker: int = 0, workers: int = 1):
+        """Claim due deletions of the worker's chats for claim_seconds, rows of id, chat_id and message_ids"""
+
+    @abstractmethod
+    async def remove_pending_deletions(self, deletion_ids: list):
+        """Drop deletions that were carried out"""
+
+    @abstractmethod
+    async def count_pending_deletions(self):
+        """Deletions waiting, claimed or not"""
+
+    @abstractmethod
+    async def get_next_deletion_delay(self, worker: int = 0, workers: int = 1):
+        """Seconds until the next unclaimed deletion of the worker's chats is due, or None if there is none"""
+
+    # Export and import
+
+    @abstractmethod
+    async def export_table(self, table: str, write) -> int:
+        """Stream a table of EXPORT_TABLES as CSV with a header into write, returns the rows exported"""
+
+    @abstractmethod
+    async def import_users(self, records: list) -> int:
+        """Bulk-load USER_COLUMNS tuples, users that already exist are left alone; returns how many were added"""
+
+    @abstractmethod
+    async def import_sessions(self, sessions: list, files: list) -> int:
+        """Bulk-load SESSION_COLUMNS and SESSION_FILE_COLUMNS tuples, returns how many sessions were added"""
+
+class Database(BaseDatabase):
+    """Storage on Postgres through an asyncpg pool"""
+
+    def __init__(self):
+        super().__init__()
+        self.invalidation_handlers['messages_changed'] = (self._on_messages_changed, self.load_messages)
+        self._listen_task = None
+        self._listen_conn = None
+        self._legacy_task = None
+
+    async def init(self, timer=None):
+        self.pool = await asyncpg.create_pool(
+            config.DATABASE_URL,
+            min_size=config.DB_POOL_MIN_SIZE,
+            max_size=config.DB_POOL_MAX_SIZE,
+            statement_cache_size=config.DB_STATEMENT_CACHE_SIZE,
+            command_timeout=config.DB_COMMAND_TIMEOUT,
+            max_queries=config.DB_MAX_QUERIES,
+            max_inactive_connection_lifetime=config.DB_MAX_INACTIVE_LIFETIME
+        )
+        if timer:
+            timer.mark('db pool')
+        applied = await self.migrate()
+        if timer:
+            timer.mark(f'db migrations ({len(applied)} applied)' if applied else 'db schema check')
+        await self.load_messages()
+        if timer:
+            timer.mark('db messages')
+        self._start_flush_loop()
+        self._listen_task = asyncio.create_task(self._listen_loop())
+        # No update needs it first (see has_legacy_session), so it runs after startup
+        self._legacy_task = asyncio.create_task(self._load_legacy_session_ids_later())
+
+    async def _load_legacy_session_ids_later(self):
+        try:
+            await self.load_legacy_session_ids()
+        except Exception as e:
+            logger.error(f"Failed to load legacy session ids, checking them against the database: {e}")
+
+    async def close(self):
+        """Stop background writers, flush what is buffered and close the pool"""
+        await self._stop_flush_loop()
+        if self._legacy_task:
+            self._legacy_task.cancel()
+            self._legacy_task = None
+        if self._listen_task:
+            self._listen_task.cancel()
+            try:
+                await self._listen_task
+            except asyncio.CancelledError:
+                pass
+            self._listen_task = None
+        if self._listen_conn:
+            await self._listen_conn.close()
+            self._listen_conn = None
+        if self.pool:
+            await self.flush_activity()
+            await self.flush_access_counts()
+            await self.flush_access_events()
+            await self.pool.close()
+
+    @asynccontextmanager
+    async def _acquire(self, name: str):
+        """pool.acquire() that records pool wait and query time under name"""
+        started = time.perf_counter()
         async with self.pool.acquire() as conn:
-            await conn.execute('''
-                CREATE TABLE IF NOT EXISTS users (
-                    id BIGINT PRIMARY KEY,
-                    username VARCHAR(255),
-                    first_name VARCHAR(255),
-                    last_name VARCHAR(255),
-                    join_date TIMESTAMP DEFAULT NOW(),
-                    last_active TIMESTAMP DEFAULT NOW(),
-                    is_banned BOOLEAN DEFAULT FALSE
-                )
-            ''')
+            acquired = time.perf_counter()
+            try:
+                yield conn
+            finally:
+                finished = time.perf_counter()
+                self.timings.record(name, acquired - started, finished - acquired)
+                DB_POOL_WAIT_SECONDS.observe(acquired - started, name)
+                DB_QUERY_SECONDS.observe(finished - acquired, name)
+                record_await('db', finished - started)
+
+    async def ping(self):
+        """Round-trip to the database, used by the readiness check"""
+        async with self._acquire('ping') as conn:
+            return await conn.fetchval('SELECT 1')
+
+    # Schema changes in order, each applied once in its own transaction and recorded in
+    # schema_migrations. Append new steps at the end, never change one that has shipped.
+    # The early steps are idempotent so databases from before versioning replay them safely.
+    MIGRATIONS = (
+        (1, 'base tables', '_migrate_base_tables'),
+        (2, 'session files', '_migrate_session_files_table'),
+        (3, 'broadcast jobs and pending deletions', '_migrate_background_jobs'),
+        (4, 'activity rollups and fsm states', '_migrate_activity_and_fsm'),
+        (5, 'statistics triggers', '_migrate_statistics'),
+        (6, 'default messages', 'initialize_default_messages'),
+        (7, 'session files out of JSONB arrays', 'migrate_session_files'),
+        (8, 'session access events and hourly rollups', '_migrate_access_events'),
+        (9, 'session expiry', '_migrate_session_expiry'),
+        (10, 'drop activity_hourly', '_migrate_drop_activity_hourly'),
+        (11, 'never opened session index', '_migrate_never_opened_sessions'),
+        (12, 'legacy session ids', '_migrate_legacy_sessions'),
+        (13, 'drop access_count index', '_migrate_drop_access_count_index')
+    )
+    # Run outside a transaction, for CREATE INDEX CONCURRENTLY. Every statement commits on its own,
+    # so these must be safe to run again after failing halfway
+    NON_TRANSACTIONAL_MIGRATIONS = {9, 11, 13}
+
+    async def migrate(self) -> list:
+        """Apply pending MIGRATIONS, returns the versions applied"""
+        latest = self.MIGRATIONS[-1][0]
+        async with self._acquire('migrate') as conn:
+            # The common case on boot: one query and nothing to do
+            if await self._schema_version(conn) >= latest:
+                return []
             
-            await conn.execute('''
-                CREATE TABLE IF NOT EXISTS messages (
-                    id SERIAL PRIMARY KEY,
-                    message_type VARCHAR(50) UNIQUE,
-                    text TEXT,
-                    image_id VARCHAR(500),
-                    updated_at TIMESTAMP DEFAULT NOW()
-                )
-            ''')
+            # Replicas starting together queue up here and find the work already done
+            await conn.execute('SELECT pg_advisory_lock($1)', MIGRATION_LOCK_ID)
+            try:
+                await conn.execute('''
+                    CREATE TABLE IF NOT EXISTS schema_migrations (
+                        version INTEGER PRIMARY KEY,
+                        name TEXT,
+                        applied_at TIMESTAMP DEFAULT NOW()
+                    )
+                ''')
+                current = await self._schema_version(conn)
+                applied = []
+                for version, name, method in self.MIGRATIONS:
+                    if version <= current:
+                        continue
+                    started = time.perf_counter()
+                    if version in self.NON_TRANSACTIONAL_MIGRATIONS:
+                        await getattr(self, method)(conn)
+                        await conn.execute(
+                            'INSERT INTO schema_migrations (version, name) VALUES ($1, $2)', version, name
+                        )
+                    else:
+                        async with conn.transaction():
+                            await getattr(self, method)(conn)
+                            await conn.execute(
+                                'INSERT INTO schema_migrations (version, name) VALUES ($1, $2)', version, name
+                            )
+                    logger.info(f"Applied migration {version} ({name}) in {(time.perf_counter() - started) * 1000:.0f} ms")
+                    applied.append(version)
+                return applied
+            finally:
+                await conn.execute('SELECT pg_advisory_unlock($1)', MIGRATION_LOCK_ID)
+
+    @staticmethod
+    async def _create_index_concurrently(conn, name: str, definition: str):
+        """CREATE INDEX CONCURRENTLY name definition, without blocking writes to the table.
+        A build that failed before leaves an invalid index behind, which is dropped and built again"""
+        invalid = await conn.fetchval('''
+            SELECT EXISTS (
+                SELECT 1 FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid
+                WHERE c.relname = $1 AND NOT i.indisvalid
+            )
+        ''', name)
+        if invalid:
+            await conn.execute(f'DROP INDEX CONCURRENTLY IF EXISTS {name}')
+        await conn.execute(f'CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} {definition}')
+
+    @staticmethod
+    async def _schema_version(conn) -> int:
+        try:
+            return await conn.fetchval('SELECT COALESCE(MAX(version), 0) FROM schema_migrations')
+        except asyncpg.UndefinedTableError:
+            return 0
+
+    async def _migrate_base_tables(self, conn):
+        await conn.execute('''
+            CREATE TABLE IF NOT EXISTS users (
+                id BIGINT PRIMARY KEY,
+                username VARCHAR(255),
+                first_name VARCHAR(255),
+                last_name VARCHAR(255),
+                join_date TIMESTAMP DEFAULT NOW(),
+                last_active TIMESTAMP DEFAULT NOW(),
+                is_banned BOOLEAN DEFAULT FALSE
+            )
+        ''')
+        
+        await conn.execute('''
+            CREATE TABLE IF NOT EXISTS messages (
+                id SERIAL PRIMARY KEY,
+                message_type VARCHAR(50) UNIQUE,
+                text TEXT,
+                image_id VARCHAR(500),
+                updated_at TIMESTAMP DEFAULT NOW()
+            )
+        ''')
+        
+        await conn.execute('''
+            CREATE TABLE IF NOT EXISTS upload_sessions (
+                session_id VARCHAR(100) PRIMARY KEY,
+                owner_id BIGINT,
+                file_ids JSONB,
+                captions JSONB,
+                protect_content BOOLEAN DEFAULT TRUE,
+                auto_delete_minutes INTEGER DEFAULT 0,
+                created_at TIMESTAMP DEFAULT NOW(),
+                access_count INTEGER DEFAULT 0
+            )
+        ''')
+        
+        await conn.execute('''
+            CREATE TABLE IF NOT EXISTS statistics (
+                id SERIAL PRIMARY KEY,
+                total_users INTEGER DEFAULT 0,
+                total_uploads INTEGER DEFAULT 0,
+                total_sessions INTEGER DEFAULT 0,
+                last_updated TIMESTAMP DEFAULT NOW()
+            )
+        ''')
+        
+        await conn.execute('''
+            ALTER TABLE users ADD COLUMN IF NOT EXISTS is_blocked BOOLEAN DEFAULT FALSE
+        ''')
+        
+        await conn.execute('''
+            ALTER TABLE upload_sessions ADD COLUMN IF NOT EXISTS file_types JSONB
+        ''')
+        
+        await conn.execute('''
+            ALTER TABLE upload_sessions ADD COLUMN IF NOT EXISTS delivery_mode VARCHAR(10) DEFAULT 'single'
+        ''')
+        
+        await conn.execute('''
+            ALTER TABLE statistics ADD COLUMN IF NOT EXISTS reconciled_at TIMESTAMP
+        ''')
+        
+        await conn.execute('''
+            CREATE INDEX IF NOT EXISTS users_last_active_idx ON users (last_active) WHERE is_banned = FALSE
+        ''')
+
+    async def _migrate_session_files_table(self, conn):
+        # One row per file, replacing the parallel file_ids/captions/file_types arrays
+        await conn.execute('''
+            ALTER TABLE upload_sessions ADD COLUMN IF NOT EXISTS file_count INTEGER
+        ''')
+        
+        await conn.execute('''
+            CREATE TABLE IF NOT EXISTS session_files (
+                session_id VARCHAR(100) REFERENCES upload_sessions (session_id) ON DELETE CASCADE,
+                position INTEGER,
+                file_id TEXT NOT NULL,
+                file_unique_id TEXT,
+                file_type VARCHAR(20),
+                caption TEXT,
+                PRIMARY KEY (session_id, position)
+            )
+        ''')
+        
+        await conn.execute('''
+            CREATE INDEX IF NOT EXISTS session_files_file_unique_id_idx ON session_files (file_unique_id)
+        ''')
+        
+        # Numbers behind signed session tokens
+        await conn.execute('''
+            CREATE SEQUENCE IF NOT EXISTS upload_session_seq
+        ''')
+
+    async def _migrate_background_jobs(self, conn):
+        await conn.execute('''
+            CREATE TABLE IF NOT EXISTS broadcast_jobs (
+                id SERIAL PRIMARY KEY,
+                owner_id BIGINT,
+                from_chat_id BIGINT,
+                message_id BIGINT,
+                progress_chat_id BIGINT,
+                progress_message_id BIGINT,
+                status VARCHAR(20) DEFAULT 'running',
+                last_user_id BIGINT DEFAULT 0,
+                total_count INTEGER DEFAULT 0,
+                sent_count INTEGER DEFAULT 0,
+                failed_count INTEGER DEFAULT 0,
+                blocked_count INTEGER DEFAULT 0,
+                created_at TIMESTAMP DEFAULT NOW(),
+                updated_at TIMESTAMP DEFAULT NOW(),
+                finished_at TIMESTAMP
+            )
+        ''')
+        
+        await conn.execute('''
+            CREATE TABLE IF NOT EXISTS pending_deletions (
+                id BIGSERIAL PRIMARY KEY,
+                chat_id BIGINT,
+                message_ids BIGINT[],
+                delete_at TIMESTAMP,
+                claimed_until TIMESTAMP
+            )
+        ''')
+        
+        await conn.execute('''
+            CREATE INDEX IF NOT EXISTS pending_deletions_delete_at_idx ON pending_deletions (delete_at)
+        ''')
+
+    async def _migrate_activity_and_fsm(self, conn):
+        # Distinct active users per hour, unused and dropped again by migration 10
+        await conn.execute('''
+            CREATE TABLE IF NOT EXISTS activity_hourly (
+                hour TIMESTAMP PRIMARY KEY,
+                active_users INTEGER DEFAULT 0
+            )
+        ''')
+        
+        # Distinct active users per day and join-day cohort, for daily actives and retention
+        await conn.execute('''
+            CREATE TABLE IF NOT EXISTS activity_daily (
+                day DATE,
+                join_day DATE,
+                active_users INTEGER DEFAULT 0,
+                PRIMARY KEY (day, join_day)
+            )
+        ''')
+        
+        # Compact FSM rows, deleted again when a conversation finishes
+        await conn.execute('''
+            CREATE TABLE IF NOT EXISTS fsm_states (
+                chat_id BIGINT,
+                user_id BIGINT,
+                state VARCHAR(100),
+                data JSONB DEFAULT '{}',
+                updated_at TIMESTAMP DEFAULT NOW(),
+                PRIMARY KEY (chat_id, user_id)
+            )
+        ''')
+        
+        await conn.execute('''
+            CREATE INDEX IF NOT EXISTS fsm_states_updated_at_idx ON fsm_states (updated_at)
+        ''')
+
+    async def _migrate_access_events(self, conn):
+        # Append-only, one row per delivered deep-link page, written with COPY
+        await conn.execute('''
+            CREATE TABLE IF NOT EXISTS session_access_events (
+                session_id VARCHAR(100),
+                user_id BIGINT,
+                accessed_at TIMESTAMP,
+                first_file INTEGER,
+                files_delivered INTEGER,
+                latency_ms INTEGER
+            )
+        ''')
+        
+        # Rows arrive in time order, a BRIN index covers time ranges at a fraction of a B-tree's size
+        await conn.execute('''
+            CREATE INDEX IF NOT EXISTS session_access_events_accessed_at_idx
+            ON session_access_events USING BRIN (accessed_at)
+        ''')
+        
+        # Per session and hour, fed by the same flush, /top reads only this
+        await conn.execute('''
+            CREATE TABLE IF NOT EXISTS session_access_hourly (
+                hour TIMESTAMP,
+                session_id VARCHAR(100),
+                opens INTEGER DEFAULT 0,
+                pages INTEGER DEFAULT 0,
+                files INTEGER DEFAULT 0,
+                latency_ms BIGINT DEFAULT 0,
+                PRIMARY KEY (hour, session_id)
+            )
+        ''')
+
+    async def _migrate_session_expiry(self, conn):
+        await conn.execute('''
+            ALTER TABLE upload_sessions ADD COLUMN IF NOT EXISTS expires_at TIMESTAMP
+        ''')
+        
+        # Lets the sweeper find expired sessions without scanning the ones that never expire
+        await self._create_index_concurrently(
+            conn, 'upload_sessions_expires_at_idx', 'ON upload_sessions (expires_at) WHERE expires_at IS NOT NULL'
+        )
+        
+        # The created_at order of /export
+        await self._create_index_concurrently(
+            conn, 'upload_sessions_created_at_idx', 'ON upload_sessions (created_at, session_id)'
+        )
+
+    async def _migrate_never_opened_sessions(self, conn):
+        # Set on the first open and never changed again. Indexing the access_count counter instead
+        # would make every access count flush a non-HOT update that rewrites all the table's indexes
+        await conn.execute('''
+            ALTER TABLE upload_sessions ADD COLUMN IF NOT EXISTS first_accessed_at TIMESTAMP
+        ''')
+        # Opened before the column existed, when exactly is not known
+        await conn.execute('''
+            UPDATE upload_sessions SET first_accessed_at = created_at
+            WHERE first_accessed_at IS NULL AND access_count > 0
+        ''')
+        
+        # Never opened sessions by age for the sweeper
+        await self._create_index_concurrently(
+            conn, 'upload_sessions_never_opened_idx', 'ON upload_sessions (created_at) WHERE first_accessed_at IS NULL'
+        )
+
+    async def _migrate_drop_access_count_index(self, conn):
+        # Databases that applied the first version of migration 11 have a partial index on access_count
+        await conn.execute('DROP INDEX CONCURRENTLY IF EXISTS upload_sessions_unused_idx')
+        await self._migrate_never_opened_sessions(conn)
+
+    async def _migrate_drop_activity_hourly(self, conn):
+        # Hourly counts cannot be summed into distinct users per window, nothing read them
+        await conn.execute('DROP TABLE IF EXISTS activity_hourly')
+
+    async def _migrate_legacy_sessions(self, conn):
+        # Sessions are created with signed tokens now, so the legacy ids only grow through /import.
+        # The regex scan of upload_sessions runs once here, every boot reads just this table
+        await conn.execute('''
+            CREATE TABLE IF NOT EXISTS legacy_sessions (
+                session_id VARCHAR(100) PRIMARY KEY REFERENCES upload_sessions (session_id) ON DELETE CASCADE
+            )
+        ''')
+        await conn.execute('''
+            INSERT INTO legacy_sessions (session_id)
+            SELECT session_id FROM upload_sessions WHERE session_id ~ $1
+            ON CONFLICT DO NOTHING
+        ''', f'^{LEGACY_SESSION_ID.pattern}$')
+
+    async def _migrate_statistics(self, conn):
+        await self.create_statistics_triggers(conn)
+        # The counters are only maintained incrementally once row 1 has been reconciled
+        if not await conn.fetchval('SELECT EXISTS (SELECT 1 FROM statistics WHERE id = 1 AND reconciled_at IS NOT NULL)'):
+            await self.reconcile_statistics(conn)
+
+    async def create_statistics_triggers(self, conn):
+        """Keep the single statistics row (id = 1) up to date on every write"""
+        await conn.execute('''
+            CREATE OR REPLACE FUNCTION statistics_users_insert() RETURNS TRIGGER AS $$
+            DECLARE delta INTEGER;
+            BEGIN
+                SELECT COUNT(*) INTO delta FROM new_rows WHERE NOT COALESCE(is_banned, FALSE);
+                IF delta <> 0 THEN
+                    UPDATE statistics SET total_users = total_users + delta, last_updated = NOW() WHERE id = 1;
+                END IF;
+                RETURN NULL;
+            END;
+            $$ LANGUAGE plpgsql;
             
-            await conn.execute('''
-                CREATE TABLE IF NOT EXISTS upload_sessions (
-                    session_id VARCHAR(100) PRIMARY KEY,
-                    owner_id BIGINT,
-                    file_ids JSONB,
-                    captions JSONB,
-                    protect_content BOOLEAN DEFAULT TRUE,
-                    auto_delete_minutes INTEGER DEFAULT 0,
-                    created_at TIMESTAMP DEFAULT NOW(),
-                    access_count INTEGER DEFAULT 0
-                )
-            ''')
+            CREATE OR REPLACE FUNCTION statistics_users_delete() RETURNS TRIGGER AS $$
+            DECLARE delta INTEGER;
+            BEGIN
+                SELECT COUNT(*) INTO delta FROM old_rows WHERE NOT COALESCE(is_banned, FALSE);
+                IF delta <> 0 THEN
+                    UPDATE statistics SET total_users = total_users - delta, last_updated = NOW() WHERE id = 1;
+                END IF;
+                RETURN NULL;
+            END;
+            $$ LANGUAGE plpgsql;
             
-            await conn.execute('''
-                CREATE TABLE IF NOT EXISTS statistics (
-                    id SERIAL PRIMARY KEY,
-                    total_users INTEGER DEFAULT 0,
-                    total_uploads INTEGER DEFAULT 0,
-                    total_sessions INTEGER DEFAULT 0,
-                    last_updated TIMESTAMP DEFAULT NOW()
-                )
-            ''')
+            CREATE OR REPLACE FUNCTION statistics_users_ban() RETURNS TRIGGER AS $$
+            BEGIN
+                UPDATE statistics SET
+                    total_users = total_users + CASE WHEN NEW.is_banned THEN -1 ELSE 1 END,
+                    last_updated = NOW()
+                WHERE id = 1;
+                RETURN NULL;
+            END;
+            $$ LANGUAGE plpgsql;
+            
+            CREATE OR REPLACE FUNCTION statistics_sessions_insert() RETURNS TRIGGER AS $$
+            DECLARE sessions INTEGER; files BIGINT;
+            BEGIN
+                SELECT COUNT(*), COALESCE(SUM(COALESCE(file_count, jsonb_array_length(file_ids))), 0) INTO sessions, files FROM new_rows;
+                IF sessions <> 0 THEN
+                    UPDATE statistics SET
+                        total_sessions = total_sessions + sessions,
+                        total_uploads = total_uploads + files,
+                        last_updated = NOW()
+                    WHERE id = 1;
+                END IF;
+                RETURN NULL;
+            END;
+            $$ LANGUAGE plpgsql;
+            
+            CREATE OR REPLACE FUNCTION statistics_sessions_delete() RETURNS TRIGGER AS $$
+            DECLARE sessions INTEGER; files BIGINT;
+            BEGIN
+                SELECT COUNT(*), COALESCE(SUM(COALESCE(file_count, jsonb_array_length(file_ids))), 0) INTO sessions, files FROM old_rows;
+                IF sessions <> 0 THEN
+                    UPDATE statistics SET
+                        total_sessions = total_sessions - sessions,
+                        total_uploads = total_uploads - files,
+                        last_updated = NOW()
+                    WHERE id = 1;
+                END IF;
+                RETURN NULL;
+            END;
+            $$ LANGUAGE plpgsql;
+            
+            DROP TRIGGER IF EXISTS statistics_users_insert ON users;
+            CREATE TRIGGER statistics_users_insert AFTER INSERT ON users
+                REFERENCING NEW TABLE AS new_rows
+                FOR EACH STATEMENT EXECUTE FUNCTION statistics_users_insert();
+            
+            DROP TRIGGER IF EXISTS statistics_users_delete ON users;
+            CREATE TRIGGER statistics_users_delete AFTER DELETE ON users
+                REFERENCING OLD TABLE AS old_rows
+                FOR EACH STATEMENT EXECUTE FUNCTION statistics_users_delete();
+            
+            DROP TRIGGER IF EXISTS statistics_users_ban ON users;
+            CREATE TRIGGER statistics_users_ban AFTER UPDATE OF is_banned ON users
+                FOR EACH ROW WHEN (OLD.is_banned IS DISTINCT FROM NEW.is_banned)
+                EXECUTE FUNCTION statistics_users_ban();
             
-            await self.initialize_default_messages(conn)
+            DROP TRIGGER IF EXISTS statistics_sessions_insert ON upload_sessions;
+            CREATE TRIGGER statistics_sessions_insert AFTER INSERT ON upload_sessions
+                REFERENCING NEW TABLE AS new_rows
+                FOR EACH STATEMENT EXECUTE FUNCTION statistics_sessions_insert();
+            
+            DROP TRIGGER IF EXISTS statistics_sessions_delete ON upload_sessions;
+            CREATE TRIGGER statistics_sessions_delete AFTER DELETE ON upload_sessions
+                REFERENCING OLD TABLE AS old_rows
+                FOR EACH STATEMENT EXECUTE FUNCTION statistics_sessions_delete();
+        ''')
+
+    async def migrate_session_files(self, conn, batch_size: int = 200):
+        """Move files of sessions stored as JSONB arrays into session_files"""
+        while True:
+            rows = await conn.fetch('''
+                SELECT session_id, file_ids, captions, file_types FROM upload_sessions
+                WHERE file_count IS NULL
+                LIMIT $1
+            ''', batch_size)
+            if not rows:
+                break
+            
+            columns = ([], [], [], [], [])
+            for row in rows:
+                file_ids = json.loads(row['file_ids'] or '[]')
+                captions = json.loads(row['captions'] or '[]')
+                # Sessions older than the file_types column get the type decoded from the file_id
+                file_types = json.loads(row['file_types'] or 'null') or [
+                    FileHandler.get_file_type_from_id(file_id) for file_id in file_ids
+                ]
+                for position, file_id in enumerate(file_ids):
+                    columns[0].append(row['session_id'])
+                    columns[1].append(position)
+                    columns[2].append(file_id)
+                    columns[3].append(file_types[position] if position < len(file_types) else 'document')
+                    columns[4].append(captions[position] if position < len(captions) else '')
+            
+            async with conn.transaction():
+                await conn.execute('''
+                    INSERT INTO session_files (session_id, position, file_id, file_type, caption)
+                    SELECT * FROM UNNEST($1::VARCHAR[], $2::INTEGER[], $3::TEXT[], $4::VARCHAR[], $5::TEXT[])
+                    ON CONFLICT DO NOTHING
+                ''', *columns)
+                await conn.execute('''
+                    UPDATE upload_sessions SET file_count = COALESCE(jsonb_array_length(file_ids), 0)
+                    WHERE session_id = ANY($1::VARCHAR[])
+                ''', [row['session_id'] for row in rows])
+            logger.info(f"Moved files of {len(rows)} upload sessions to session_files")
 
     async def initialize_default_messages(self, conn):
-        default_messages = [
-            ('start_message', '👋 Welcome to File Sharing Bot!\n\nUse /help to learn how to use this bot.', None),
-            ('help_message', '📖 **Help Guide**\n\n• Use deep links to access files\n• Contact owner for support', None)
-        ]
-        
-        for msg_type, text, image_id in default_messages:
+        for msg_type, text, image_id in DEFAULT_MESSAGES:
             await conn.execute('''
                 INSERT INTO messages (message_type, text, image_id)
                 VALUES ($1, $2, $3)
@@ -74,7 +1062,7 @@ class Database:
             ''', msg_type, text, image_id)
 
     async def add_user(self, user_id: int, username: str, first_name: str, last_name: str = None):
-        async with self.pool.acquire() as conn:
+        async with self._acquire('add_user') as conn:
             await conn.execute('''
                 INSERT INTO users (id, username, first_name, last_name, join_date, last_active)
                 VALUES ($1, $2, $3, $4, NOW(), NOW())
@@ -85,80 +1073,646 @@ class Database:
                 last_active = NOW()
             ''', user_id, username, first_name, last_name)
 
-    async def update_user_activity(self, user_id: int):
-        async with self.pool.acquire() as conn:
+    async def flush_activity(self) -> int:
+        """Write all buffered activity in one transaction, returns the number of users flushed"""
+        pending = self.activity.drain()
+        if not pending:
+            return 0
+        
+        registered = [(user_id, profile) for user_id, profile in pending.items() if profile is not None]
+        touched = [user_id for user_id, profile in pending.items() if profile is None]
+        
+        try:
+            async with self._acquire('flush_activity') as conn:
+                async with conn.transaction():
+                    await self._update_activity_rollups(conn, pending)
+                    
+                    if registered:
+                        await conn.execute('''
+                            INSERT INTO users (id, username, first_name, last_name, join_date, last_active)
+                            SELECT u.id, u.username, u.first_name, u.last_name, NOW(), NOW()
+                            FROM UNNEST($1::BIGINT[], $2::VARCHAR[], $3::VARCHAR[], $4::VARCHAR[])
+                                AS u(id, username, first_name, last_name)
+                            ON CONFLICT (id) DO UPDATE SET
+                            username = EXCLUDED.username,
+                            first_name = EXCLUDED.first_name,
+                            last_name = EXCLUDED.last_name,
+                            last_active = NOW(),
+                            is_blocked = FALSE
+                        ''', [user_id for user_id, _ in registered],
+                           [profile[0] for _, profile in registered],
+                           [profile[1] for _, profile in registered],
+                           [profile[2] for _, profile in registered])
+                    
+                    if touched:
+                        await conn.execute('''
+                            UPDATE users SET last_active = NOW(), is_blocked = FALSE
+                            FROM UNNEST($1::BIGINT[]) AS t(id)
+                            WHERE users.id = t.id
+                        ''', touched)
+        except Exception:
+            self.activity.requeue(pending)
+            raise
+        
+        self.activity.flushed_count += len(pending)
+        self.activity.flush_count += 1
+        return len(pending)
+
+    async def _update_activity_rollups(self, conn, pending: dict):
+        """Count users touching the bot for the first time today, before last_active moves"""
+        rows = await conn.fetch('''
+            SELECT id, join_date::DATE AS join_day,
+                   last_active IS NULL OR last_active < date_trunc('day', NOW()) AS new_day
+            FROM users
+            WHERE id = ANY($1::BIGINT[])
+            ORDER BY id
+            FOR UPDATE
+        ''', list(pending))
+        
+        existing = {row['id'] for row in rows}
+        new_users = sum(1 for user_id, profile in pending.items() if profile is not None and user_id not in existing)
+        
+        # join_day None stands for users created by this flush, i.e. today's cohort
+        daily = defaultdict(int)
+        for row in rows:
+            if row['new_day']:
+                daily[row['join_day']] += 1
+        if new_users:
+            daily[None] += new_users
+        
+        if daily:
             await conn.execute('''
-                UPDATE users SET last_active = NOW() WHERE id = $1
-            ''', user_id)
+                INSERT INTO activity_daily (day, join_day, active_users)
+                SELECT CURRENT_DATE, COALESCE(t.join_day, CURRENT_DATE), SUM(t.users)
+                FROM UNNEST($1::DATE[], $2::INTEGER[]) AS t(join_day, users)
+                GROUP BY 2
+                ON CONFLICT (day, join_day) DO UPDATE SET
+                active_users = activity_daily.active_users + EXCLUDED.active_users
+            ''', list(daily.keys()), list(daily.values()))
 
     async def get_all_users(self):
-        async with self.pool.acquire() as conn:
-            return await conn.fetch('SELECT * FROM users WHERE is_banned = FALSE')
+        async with self._acquire('get_all_users') as conn:
+            return await conn.fetch('SELECT * FROM users WHERE is_banned = FALSE AND is_blocked = FALSE')
 
-    async def get_active_users_count(self, hours: int = 48):
-        async with self.pool.acquire() as conn:
+    async def count_broadcast_recipients(self):
+        async with self._acquire('count_broadcast_recipients') as conn:
+            return await conn.fetchval('SELECT COUNT(*) FROM users WHERE is_banned = FALSE AND is_blocked = FALSE')
+
+    async def get_broadcast_recipients(self, after_user_id: int, limit: int):
+        """Return the next page of recipient ids after after_user_id (keyset pagination)"""
+        async with self._acquire('get_broadcast_recipients') as conn:
+            rows = await conn.fetch('''
+                SELECT id FROM users
+                WHERE id > $1 AND is_banned = FALSE AND is_blocked = FALSE
+                ORDER BY id
+                LIMIT $2
+            ''', after_user_id, limit)
+            return [row['id'] for row in rows]
+
+    async def mark_users_blocked(self, user_ids: list):
+        async with self._acquire('mark_users_blocked') as conn:
+            await conn.execute('''
+                UPDATE users SET is_blocked = TRUE WHERE id = ANY($1::BIGINT[])
+            ''', user_ids)
+
+    async def create_broadcast_job(self, owner_id: int, from_chat_id: int, message_id: int,
+                                   progress_chat_id: int, progress_message_id: int, total_count: int):
+        async with self._acquire('create_broadcast_job') as conn:
+            return await conn.fetchrow('''
+                INSERT INTO broadcast_jobs
+                (owner_id, from_chat_id, message_id, progress_chat_id, progress_message_id, total_count)
+                VALUES ($1, $2, $3, $4, $5, $6)
+                RETURNING *
+            ''', owner_id, from_chat_id, message_id, progress_chat_id, progress_message_id, total_count)
+
+    async def get_running_broadcast_jobs(self):
+        async with self._acquire('get_running_broadcast_jobs') as conn:
+            return await conn.fetch("SELECT * FROM broadcast_jobs WHERE status = 'running' ORDER BY id")
+
+    async def update_broadcast_progress(self, job_id: int, last_user_id: int, sent_count: int,
+                                        failed_count: int, blocked_count: int):
+        """Advance the job cursor and return the job status, which may have been cancelled meanwhile"""
+        async with self._acquire('update_broadcast_progress') as conn:
             return await conn.fetchval('''
-                SELECT COUNT(*) FROM users 
-                WHERE last_active > NOW() - INTERVAL '1 hour' * $1 
-                AND is_banned = FALSE
-            ''', hours)
+                UPDATE broadcast_jobs SET
+                last_user_id = $2,
+                sent_count = $3,
+                failed_count = $4,
+                blocked_count = $5,
+                updated_at = NOW()
+                WHERE id = $1
+                RETURNING status
+            ''', job_id, last_user_id, sent_count, failed_count, blocked_count)
 
-    async def set_message(self, message_type: str, text: str, image_id: str = None):
-        async with self.pool.acquire() as conn:
+    async def finish_broadcast_job(self, job_id: int, status: str):
+        async with self._acquire('finish_broadcast_job') as conn:
             await conn.execute('''
+                UPDATE broadcast_jobs SET status = $2, updated_at = NOW(), finished_at = NOW()
+                WHERE id = $1 AND status = 'running'
+            ''', job_id, status)
+
+    async def cancel_broadcast_jobs(self):
+        """Cancel every running broadcast job and return their ids"""
+        async with self._acquire('cancel_broadcast_jobs') as conn:
+            rows = await conn.fetch('''
+                UPDATE broadcast_jobs SET status = 'cancelled', updated_at = NOW(), finished_at = NOW()
+                WHERE status = 'running'
+                RETURNING id
+            ''')
+            return [row['id'] for row in rows]
+
+    async def get_active_users_counts(self):
+        """Active users over the last 1h/24h/48h/7d/30d in one range scan of users_last_active_idx"""
+        async with self._acquire('get_active_users_counts') as conn:
+            row = await conn.fetchrow('''
+                SELECT
+                    COUNT(*) FILTER (WHERE last_active > NOW() - INTERVAL '1 hour') AS "1h",
+                    COUNT(*) FILTER (WHERE last_active > NOW() - INTERVAL '24 hours') AS "24h",
+                    COUNT(*) FILTER (WHERE last_active > NOW() - INTERVAL '48 hours') AS "48h",
+                    COUNT(*) FILTER (WHERE last_active > NOW() - INTERVAL '7 days') AS "7d",
+                    COUNT(*) AS "30d"
+                FROM users
+                WHERE last_active > NOW() - INTERVAL '30 days' AND is_banned = FALSE
+            ''')
+            return dict(row)
+
+    async def get_daily_active_users(self, days: int = 7):
+        """Distinct active users per day from the activity_daily rollup, newest first"""
+        async with self._acquire('get_daily_active_users') as conn:
+            return await conn.fetch('''
+                SELECT day, SUM(active_users) AS active_users
+                FROM activity_daily
+                WHERE day > CURRENT_DATE - $1::INTEGER
+                GROUP BY day
+                ORDER BY day DESC
+            ''', days)
+
+    async def get_retention(self, offsets: list, cohort_days: int = 30):
+        """Share of users active N days after joining, over cohorts from the last cohort_days days"""
+        async with self._acquire('get_retention') as conn:
+            return await conn.fetch('''
+                SELECT k.offset_days,
+                       COALESCE(SUM(a.active_users), 0) AS retained,
+                       COALESCE(SUM(c.active_users), 0) AS cohort
+                FROM UNNEST($1::INTEGER[]) AS k(offset_days)
+                LEFT JOIN activity_daily c
+                    ON c.day = c.join_day
+                    AND c.join_day BETWEEN CURRENT_DATE - $2::INTEGER AND CURRENT_DATE - k.offset_days
+                LEFT JOIN activity_daily a
+                    ON a.join_day = c.join_day AND a.day = c.join_day + k.offset_days
+                GROUP BY k.offset_days
+                ORDER BY k.offset_days
+            ''', offsets, cohort_days)
+
+    async def set_message(self, message_type: str, text: str, image_id: str = None):
+        async with self._acquire('set_message') as conn:
+            row = await conn.fetchrow('''
                 INSERT INTO messages (message_type, text, image_id, updated_at)
                 VALUES ($1, $2, $3, NOW())
                 ON CONFLICT (message_type) DO UPDATE SET
                 text = EXCLUDED.text,
                 image_id = EXCLUDED.image_id,
                 updated_at = NOW()
+                RETURNING *
             ''', message_type, text, image_id)
+            self.messages[message_type] = row
+            # Let other instances drop their cached copy
+            await conn.execute("SELECT pg_notify('messages_changed', $1)", message_type)
 
-    async def get_message(self, message_type: str):
-        async with self.pool.acquire() as conn:
+    async def _load_message(self, message_type: str):
+        async with self._acquire('get_message') as conn:
             return await conn.fetchrow('SELECT * FROM messages WHERE message_type = $1', message_type)
 
-    async def create_upload_session(self, session_id: str, owner_id: int, file_ids: list, 
-                                  captions: list, protect_content: bool, auto_delete_minutes: int):
-        async with self.pool.acquire() as conn:
+    async def load_messages(self):
+        """(Re)load every message into the cache"""
+        async with self._acquire('load_messages') as conn:
+            rows = await conn.fetch('SELECT * FROM messages')
+        self.messages = {row['message_type']: row for row in rows}
+
+    async def _refresh_message(self, message_type: str):
+        try:
+            async with self._acquire('refresh_message') as conn:
+                row = await conn.fetchrow('SELECT * FROM messages WHERE message_type = $1', message_type)
+            self.messages[message_type] = row
+        except Exception as e:
+            # Drop the entry so the next get_message reads through
+            self.messages.pop(message_type, None)
+            logger.error(f"Failed to refresh cached message {message_type}: {e}")
+
+    def _on_messages_changed(self, conn, pid, channel, payload):
+        asyncio.create_task(self._refresh_message(payload))
+
+    async def _listen_loop(self):
+        """Keep a LISTEN connection open for cross-instance cache invalidation"""
+        while True:
+            lost = asyncio.Event()
+            try:
+                self._listen_conn = await asyncpg.connect(config.DATABASE_URL)
+                self._listen_conn.add_termination_listener(lambda conn: lost.set())
+                for channel, (on_notify, on_reconnect) in self.invalidation_handlers.items():
+                    await self._listen_conn.add_listener(channel, on_notify)
+                    # Notifications sent while we were not listening are lost, so resync everything
+                    await on_reconnect()
+                await lost.wait()
+                logger.warning("LISTEN connection lost, reconnecting")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"LISTEN connection failed: {e}")
+            self._listen_conn = None
+            await asyncio.sleep(5)
+
+    async def get_fsm_record(self, chat_id: int, user_id: int):
+        async with self._acquire('get_fsm_record') as conn:
+            return await conn.fetchrow(
+                'SELECT state, data FROM fsm_states WHERE chat_id = $1 AND user_id = $2',
+                chat_id, user_id
+            )
+
+    async def set_fsm_state(self, chat_id: int, user_id: int, state: str, notify: str = None):
+        async with self._acquire('set_fsm_state') as conn:
             await conn.execute('''
-                INSERT INTO upload_sessions 
-                (session_id, owner_id, file_ids, captions, protect_content, auto_delete_minutes)
-                VALUES ($1, $2, $3, $4, $5, $6)
-            ''', session_id, owner_id, json.dumps(file_ids), json.dumps(captions), 
-               protect_content, auto_delete_minutes)
+                INSERT INTO fsm_states (chat_id, user_id, state, updated_at)
+                VALUES ($1, $2, $3, NOW())
+                ON CONFLICT (chat_id, user_id) DO UPDATE SET
+                state = EXCLUDED.state,
+                updated_at = NOW()
+            ''', chat_id, user_id, state)
+            await self._notify_fsm(conn, notify)
 
-    async def get_upload_session(self, session_id: str):
-        async with self.pool.acquire() as conn:
-            session = await conn.fetchrow('SELECT * FROM upload_sessions WHERE session_id = $1', session_id)
-            if session:
+    async def set_fsm_data(self, chat_id: int, user_id: int, data: dict, notify: str = None):
+        async with self._acquire('set_fsm_data') as conn:
+            await conn.execute('''
+                INSERT INTO fsm_states (chat_id, user_id, data, updated_at)
+                VALUES ($1, $2, $3, NOW())
+                ON CONFLICT (chat_id, user_id) DO UPDATE SET
+                data = EXCLUDED.data,
+                updated_at = NOW()
+            ''', chat_id, user_id, json.dumps(data))
+            await self._notify_fsm(conn, notify)
+
+    async def update_fsm_data(self, chat_id: int, user_id: int, data: dict, notify: str = None) -> dict:
+        """Shallow-merge data into the stored dict, returns the result"""
+        async with self._acquire('update_fsm_data') as conn:
+            merged = await conn.fetchval('''
+                INSERT INTO fsm_states (chat_id, user_id, data, updated_at)
+                VALUES ($1, $2, $3, NOW())
+                ON CONFLICT (chat_id, user_id) DO UPDATE SET
+                data = fsm_states.data || EXCLUDED.data,
+                updated_at = NOW()
+                RETURNING data
+            ''', chat_id, user_id, json.dumps(data))
+            await self._notify_fsm(conn, notify)
+            return json.loads(merged)
+
+    async def append_fsm_data(self, chat_id: int, user_id: int, items: dict, notify: str = None) -> dict:
+        """Append items[key] to the list stored under each key, returns the result"""
+        async with self._acquire('append_fsm_data') as conn:
+            merged = await conn.fetchval('''
+                INSERT INTO fsm_states (chat_id, user_id, data, updated_at)
+                VALUES ($1, $2, $3, NOW())
+                ON CONFLICT (chat_id, user_id) DO UPDATE SET
+                data = fsm_states.data || (
+                    SELECT jsonb_object_agg(item.key, COALESCE(fsm_states.data -> item.key, '[]'::JSONB) || item.value)
+                    FROM jsonb_each(EXCLUDED.data) AS item
+                ),
+                updated_at = NOW()
+                RETURNING data
+            ''', chat_id, user_id, json.dumps(items))
+            await self._notify_fsm(conn, notify)
+            return json.loads(merged)
+
+    async def delete_fsm_record(self, chat_id: int, user_id: int, notify: str = None):
+        async with self._acquire('delete_fsm_record') as conn:
+            await conn.execute('DELETE FROM fsm_states WHERE chat_id = $1 AND user_id = $2', chat_id, user_id)
+            await self._notify_fsm(conn, notify)
+
+    async def expire_fsm_records(self, max_age_seconds: int, batch_size: int = 1000) -> int:
+        """Delete conversations untouched for max_age_seconds in small batches, returns the rows deleted"""
+        deleted = 0
+        async with self._acquire('expire_fsm_records') as conn:
+            while True:
+                result = await conn.execute('''
+                    DELETE FROM fsm_states WHERE ctid IN (
+                        SELECT ctid FROM fsm_states
+                        WHERE updated_at < NOW() - INTERVAL '1 second' * $1
+                        LIMIT $2
+                    )
+                ''', max_age_seconds, batch_size)
+                count = int(result.split()[-1])
+                deleted += count
+                if count < batch_size:
+                    return deleted
+
+    async def _notify_fsm(self, conn, payload: str):
+        if payload:
+            await conn.execute("SELECT pg_notify('fsm_changed', $1)", payload)
+
+    async def create_upload_session(self, session_id: str, owner_id: int, files: list, protect_content: bool,
+                                  auto_delete_minutes: int, delivery_mode: str = 'single', expires_at: datetime = None):
+        """files are dicts with file_id, file_unique_id, file_type and caption, in delivery order.
+        Without expires_at the session never expires"""
+        async with self._acquire('create_upload_session') as conn:
+            async with conn.transaction():
+                await conn.execute('''
+                    INSERT INTO upload_sessions 
+                    (session_id, owner_id, file_count, protect_content, auto_delete_minutes, delivery_mode, expires_at)
+                    VALUES ($1, $2, $3, $4, $5, $6, $7)
+                ''', session_id, owner_id, len(files), protect_content, auto_delete_minutes, delivery_mode, expires_at)
                 await conn.execute('''
-                    UPDATE upload_sessions SET access_count = access_count + 1 WHERE session_id = $1
-                ''', session_id)
-            return session
+                    INSERT INTO session_files (session_id, position, file_id, file_unique_id, file_type, caption)
+                    SELECT $1, t.position - 1, t.file_id, t.file_unique_id, t.file_type, t.caption
+                    FROM UNNEST($2::TEXT[], $3::TEXT[], $4::VARCHAR[], $5::TEXT[])
+                        WITH ORDINALITY AS t(file_id, file_unique_id, file_type, caption, position)
+                ''', session_id,
+                   [file['file_id'] for file in files],
+                   [file.get('file_unique_id') for file in files],
+                   [file['file_type'] for file in files],
+                   [file.get('caption') or '' for file in files])
 
-    async def update_statistics(self):
-        async with self.pool.acquire() as conn:
+    async def next_upload_session_number(self) -> int:
+        async with self._acquire('next_upload_session_number') as conn:
+            return await conn.fetchval("SELECT nextval('upload_session_seq')")
+
+    async def load_legacy_session_ids(self):
+        """Remember the random 12-character ids of sessions created before signed tokens"""
+        async with self._acquire('load_legacy_session_ids') as conn:
+            rows = await conn.fetch('SELECT session_id FROM legacy_sessions')
+        self.legacy_session_ids = {row['session_id'] for row in rows}
+
+    async def _load_upload_session(self, session_id: str):
+        async with self._acquire('get_upload_session') as conn:
+            row = await conn.fetchrow('SELECT * FROM upload_sessions WHERE session_id = $1', session_id)
+        return self._decode_session(row) if row else None
+
+    async def _load_session_files(self, session_id: str, offset: int, limit: int) -> list:
+        async with self._acquire('get_session_files') as conn:
+            rows = await conn.fetch('''
+                SELECT file_id, file_type, caption FROM session_files
+                WHERE session_id = $1 AND position >= $2 AND position < $2 + $3
+                ORDER BY position
+            ''', session_id, offset, limit)
+        return [dict(row) for row in rows]
+
+    @staticmethod
+    def _decode_session(row) -> dict:
+        return {
+            'session_id': row['session_id'],
+            'owner_id': row['owner_id'],
+            'file_count': row['file_count'],
+            'protect_content': row['protect_content'],
+            'auto_delete_minutes': row['auto_delete_minutes'],
+            'delivery_mode': row['delivery_mode'] or 'single',
+            'created_at': row['created_at'],
+            'expires_at': row['expires_at']
+        }
+
+    async def expire_upload_sessions(self, unused_before: datetime = None, batch_size: int = 500) -> int:
+        """Delete expired sessions, and never opened ones created before unused_before, in small
+        batches; returns the sessions deleted. Their files go with them (ON DELETE CASCADE)"""
+        conditions = [('expires_at < $1', datetime.now())]
+        if unused_before:
+            # access_count guards against instances still running without first_accessed_at
+            conditions.append(('first_accessed_at IS NULL AND access_count = 0 AND created_at < $1', unused_before))
+        
+        deleted = 0
+        async with self._acquire('expire_upload_sessions') as conn:
+            for condition, value in conditions:
+                while True:
+                    # Each batch commits on its own, rows another instance is deleting are skipped
+                    result = await conn.execute(f'''
+                        DELETE FROM upload_sessions WHERE session_id IN (
+                            SELECT session_id FROM upload_sessions
+                            WHERE {condition}
+                            LIMIT $2
+                            FOR UPDATE SKIP LOCKED
+                        )
+                    ''', value, batch_size)
+                    count = int(result.split()[-1])
+                    deleted += count
+                    if count < batch_size:
+                        break
+        return deleted
+
+    async def flush_access_counts(self) -> int:
+        """Add buffered deep-link hits to access_count in one statement, returns the sessions updated"""
+        if not self.access_counts:
+            return 0
+        counts, self.access_counts = self.access_counts, {}
+        
+        try:
+            async with self._acquire('flush_access_counts') as conn:
+                await conn.execute('''
+                    UPDATE upload_sessions SET access_count = access_count + t.hits,
+                        first_accessed_at = COALESCE(first_accessed_at, NOW())
+                    FROM UNNEST($1::VARCHAR[], $2::INTEGER[]) AS t(session_id, hits)
+                    WHERE upload_sessions.session_id = t.session_id
+                ''', list(counts.keys()), list(counts.values()))
+        except Exception:
+            for session_id, hits in counts.items():
+                self.access_counts[session_id] = self.access_counts.get(session_id, 0) + hits
+            raise
+        
+        self.access_flushed_count += len(counts)
+        self.access_flush_count += 1
+        return len(counts)
+
+    async def flush_access_events(self) -> int:
+        """COPY buffered access events into session_access_events and add them to the hourly rollup"""
+        if not self.access_events:
+            return 0
+        events, self.access_events = self.access_events, []
+        # Sorted so concurrent flushes from other instances lock rollup rows in the same order
+        rollups = sorted(self._access_rollups(events).items())
+        
+        try:
+            async with self._acquire('flush_access_events') as conn:
+                async with conn.transaction():
+                    await conn.copy_records_to_table(
+                        'session_access_events', records=events, columns=ACCESS_EVENT_COLUMNS
+                    )
+                    await conn.execute('''
+                        INSERT INTO session_access_hourly (hour, session_id, opens, pages, files, latency_ms)
+                        SELECT * FROM UNNEST($1::TIMESTAMP[], $2::VARCHAR[], $3::INTEGER[],
+                                             $4::INTEGER[], $5::INTEGER[], $6::BIGINT[])
+                        ON CONFLICT (hour, session_id) DO UPDATE SET
+                        opens = session_access_hourly.opens + EXCLUDED.opens,
+                        pages = session_access_hourly.pages + EXCLUDED.pages,
+                        files = session_access_hourly.files + EXCLUDED.files,
+                        latency_ms = session_access_hourly.latency_ms + EXCLUDED.latency_ms
+                    ''', [hour for (hour, _), _ in rollups], [session_id for (_, session_id), _ in rollups],
+                       *([totals[i] for _, totals in rollups] for i in range(4)))
+        except Exception:
+            self._requeue_access_events(events)
+            raise
+        
+        self.access_events_flushed += len(events)
+        return len(events)
+
+    async def get_top_sessions(self, hours: int, limit: int):
+        """Most opened sessions over the last `hours` hours that still exist, from the hourly rollup"""
+        async with self._acquire('get_top_sessions') as conn:
+            return await conn.fetch('''
+                SELECT h.session_id, SUM(h.opens) AS opens, SUM(h.pages) AS pages, SUM(h.files) AS files,
+                       (SUM(h.latency_ms) / NULLIF(SUM(h.pages), 0))::INTEGER AS avg_latency_ms
+                FROM session_access_hourly h
+                JOIN upload_sessions s ON s.session_id = h.session_id
+                WHERE h.hour >= $1
+                GROUP BY h.session_id
+                ORDER BY opens DESC, files DESC
+                LIMIT $2
+            ''', self._hours_ago(hours), limit)
+
+    async def delete_access_events(self, before: datetime, batch_size: int = 500) -> int:
+        """Delete access events older than before in small batches, returns the events deleted"""
+        deleted = 0
+        async with self._acquire('delete_access_events') as conn:
+            while True:
+                # The table has no key, rows are picked by ctid through the BRIN index on accessed_at
+                result = await conn.execute('''
+                    DELETE FROM session_access_events WHERE ctid = ANY(ARRAY(
+                        SELECT ctid FROM session_access_events WHERE accessed_at < $1 LIMIT $2
+                    ))
+                ''', before, batch_size)
+                count = int(result.split()[-1])
+                deleted += count
+                if count < batch_size:
+                    break
+        return deleted
+
+    async def add_pending_deletion(self, chat_id: int, message_ids: list, delay_minutes: int):
+        async with self._acquire('add_pending_deletion') as conn:
+            await conn.execute('''
+                INSERT INTO pending_deletions (chat_id, message_ids, delete_at)
+                VALUES ($1, $2, NOW() + INTERVAL '1 minute' * $3)
+            ''', chat_id, message_ids, delay_minutes)
+
+    async def claim_due_deletions(self, limit: int, claim_seconds: int, worker: int = 0, workers: int = 1):
+        """Claim due deletions of the worker's chats, skipping rows claimed or locked by another instance"""
+        async with self._acquire('claim_due_deletions') as conn:
+            return await conn.fetch('''
+                UPDATE pending_deletions SET claimed_until = NOW() + INTERVAL '1 second' * $2
+                WHERE id IN (
+                    SELECT id FROM pending_deletions
+                    WHERE delete_at <= NOW() AND (claimed_until IS NULL OR claimed_until < NOW())
+                        AND ((chat_id % $4) + $4) % $4 = $3
+                    ORDER BY delete_at
+                    LIMIT $1
+                    FOR UPDATE SKIP LOCKED
+                )
+                RETURNING id, chat_id, message_ids
+            ''', limit, claim_seconds, worker, workers)
+
+    async def remove_pending_deletions(self, deletion_ids: list):
+        async with self._acquire('remove_pending_deletions') as conn:
+            await conn.execute('DELETE FROM pending_deletions WHERE id = ANY($1::BIGINT[])', deletion_ids)
+
+    async def count_pending_deletions(self):
+        async with self._acquire('count_pending_deletions') as conn:
+            return await conn.fetchval('SELECT COUNT(*) FROM pending_deletions')
+
+    async def get_next_deletion_delay(self, worker: int = 0, workers: int = 1):
+        """Seconds until the next unclaimed deletion of the worker's chats is due, or None if there is none"""
+        async with self._acquire('get_next_deletion_delay') as conn:
+            return await conn.fetchval('''
+                SELECT EXTRACT(EPOCH FROM MIN(delete_at) - NOW())::FLOAT FROM pending_deletions
+                WHERE (claimed_until IS NULL OR claimed_until < NOW()) AND ((chat_id % $2) + $2) % $2 = $1
+            ''', worker, workers)
+
+    async def reconcile_statistics(self, conn=None):
+        """Recount the statistics row from scratch, writes are blocked while counting"""
+        if conn is None:
+            async with self._acquire('reconcile_statistics') as conn:
+                return await self.reconcile_statistics(conn)
+        
+        async with conn.transaction():
+            await conn.execute('LOCK TABLE users, upload_sessions IN SHARE MODE')
             total_users = await conn.fetchval('SELECT COUNT(*) FROM users WHERE is_banned = FALSE')
             total_sessions = await conn.fetchval('SELECT COUNT(*) FROM upload_sessions')
-            total_uploads = await conn.fetchval('SELECT SUM(jsonb_array_length(file_ids)) FROM upload_sessions')
+            total_uploads = await conn.fetchval('SELECT COALESCE(SUM(COALESCE(file_count, jsonb_array_length(file_ids))), 0) FROM upload_sessions')
             
+            # Older versions appended a row per update, keep only the singleton
+            await conn.execute('DELETE FROM statistics WHERE id <> 1')
             await conn.execute('''
-                INSERT INTO statistics (total_users, total_uploads, total_sessions, last_updated)
-                VALUES ($1, $2, $3, NOW())
+                INSERT INTO statistics (id, total_users, total_uploads, total_sessions, last_updated, reconciled_at)
+                VALUES (1, $1, $2, $3, NOW(), NOW())
                 ON CONFLICT (id) DO UPDATE SET
                 total_users = EXCLUDED.total_users,
                 total_uploads = EXCLUDED.total_uploads,
                 total_sessions = EXCLUDED.total_sessions,
-                last_updated = NOW()
+                last_updated = NOW(),
+                reconciled_at = NOW()
             ''', total_users, total_uploads, total_sessions)
 
     async def get_statistics(self):
-        async with self.pool.acquire() as conn:
-            stats = await conn.fetchrow('SELECT * FROM statistics ORDER BY last_updated DESC LIMIT 1')
-            if not stats:
-                await self.update_statistics()
-                return await conn.fetchrow('SELECT * FROM statistics ORDER BY last_updated DESC LIMIT 1')
-            return stats
+        async with self._acquire('get_statistics') as conn:
+            return await conn.fetchrow('SELECT * FROM statistics WHERE id = 1')
+
+    # Export and import
+
+    async def export_table(self, table: str, write) -> int:
+        """Stream EXPORT_QUERIES[table] as CSV with a header into write, an async callable taking bytes.
+        
+        COPY hands over the rows chunk by chunk, so memory stays flat however large the table is.
+        Returns the number of rows exported.
+        """
+        async with self._acquire(f'export_{table}') as conn:
+            status = await conn.copy_from_query(EXPORT_QUERIES[table], output=write, format='csv', header=True)
+        return int(status.split()[-1])
+
+    async def import_users(self, records: list) -> int:
+        """Bulk-load USER_COLUMNS tuples, users that already exist are left alone; returns how many were added"""
+        columns = ', '.join(USER_COLUMNS)
+        async with self._acquire('import_users') as conn:
+            async with conn.transaction():
+                await conn.execute('CREATE TEMP TABLE import_users (LIKE users) ON COMMIT DROP')
+                await conn.copy_records_to_table('import_users', records=records, columns=USER_COLUMNS)
+                status = await conn.execute(f'''
+                    INSERT INTO users ({columns}) SELECT {columns} FROM import_users
+                    ON CONFLICT (id) DO NOTHING
+                ''')
+        return int(status.split()[-1])
+
+    async def import_sessions(self, sessions: list, files: list) -> int:
+        """Bulk-load SESSION_COLUMNS and SESSION_FILE_COLUMNS tuples, sessions that already exist are
+        left alone together with their files; returns how many sessions were added"""
+        session_columns = ', '.join(SESSION_COLUMNS)
+        file_columns = ', '.join(SESSION_FILE_COLUMNS)
+        async with self._acquire('import_sessions') as conn:
+            async with conn.transaction():
+                await conn.execute('CREATE TEMP TABLE import_sessions (LIKE upload_sessions) ON COMMIT DROP')
+                await conn.execute('CREATE TEMP TABLE import_session_files (LIKE session_files) ON COMMIT DROP')
+                await conn.copy_records_to_table('import_sessions', records=sessions, columns=SESSION_COLUMNS)
+                await conn.copy_records_to_table('import_session_files', records=files, columns=SESSION_FILE_COLUMNS)
+                # Sessions opened before the export are not swept as never opened
+                rows = await conn.fetch(f'''
+                    INSERT INTO upload_sessions ({session_columns}, first_accessed_at)
+                    SELECT {session_columns}, CASE WHEN access_count > 0 THEN created_at END FROM import_sessions
+                    ON CONFLICT (session_id) DO NOTHING
+                    RETURNING session_id
+                ''')
+                added = [row['session_id'] for row in rows]
+                await conn.execute(f'''
+                    INSERT INTO session_files ({file_columns}) SELECT {file_columns} FROM import_session_files
+                    WHERE session_id = ANY($1::VARCHAR[])
+                ''', added)
+                await conn.execute('''
+                    INSERT INTO legacy_sessions (session_id) SELECT UNNEST($1::VARCHAR[]) ON CONFLICT DO NOTHING
+                ''', [session_id for session_id in added if LEGACY_SESSION_ID.fullmatch(session_id)])
+                
+                # Tokens signed with this instance's secret must not be issued a second time
+                numbers = [SessionTokens.number(session_id) for session_id in added]
+                highest = max((number for number in numbers if number is not None), default=None)
+                if highest is not None:
+                    await conn.execute('''
+                        SELECT setval('upload_session_seq', GREATEST($1, (SELECT last_value FROM upload_session_seq)))
+                    ''', highest)
+        self._remember_imported_sessions(added)
+        return len(added)
 
-db = Database()
+def create_database() -> BaseDatabase:
+    """Storage backend selected by DATABASE_BACKEND, the bot creates its one instance at startup"""
+    if config.DATABASE_BACKEND == 'memory':
+        from memory_database import MemoryDatabase
+        return MemoryDatabase()
+    return Database()
@@ -0,0 +1,129 @@
+import asyncio
+import logging
+import time
+from aiogram import types
+from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
+
+from config import config
+from outbound import send_priority
+from utils import BotUtils, FileHandler
+
+logger = logging.getLogger(__name__)
+
+class SessionDelivery:
+    """Send upload sessions to users page by page in background tasks.
+
+    A deep link starts the first DELIVERY_PAGE_SIZE files and returns, so
+    the handler finishes right away and the user sees files as soon as the
+    first send completes. Larger sessions end each page with a "Next"
+    button that starts the following page the same way. Every page sent
+    is logged as an access event with its file count and latency.
+    """
+
+    def __init__(self, bot, db, deleter):
+        self.bot = bot
+        self.db = db
+        self.deleter = deleter
+        # (chat_id, session_id, offset) -> asyncio.Task
+        self.tasks = {}
+
+    def start(self, chat_id: int, user_id: int, session: dict, offset: int, is_owner: bool) -> bool:
+        """Start sending the page at offset to the chat user_id requested it from,
+        False if that page is already being sent to the chat"""
+        key = (chat_id, session['session_id'], offset)
+        if key in self.tasks:
+            return False
+        task = asyncio.create_task(self._run(chat_id, user_id, session, offset, is_owner, time.perf_counter()))
+        self.tasks[key] = task
+        task.add_done_callback(lambda t: self.tasks.pop(key, None))
+        return True
+
+    async def close(self):
+        tasks = list(self.tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _run(self, chat_id: int, user_id: int, session: dict, offset: int, is_owner: bool, started: float):
+        # Sends are paced by the bot's outbound scheduler, behind interactive replies
+        send_priority.set('delivery')
+        try:
+            await self._deliver_page(chat_id, user_id, session, offset, is_owner, started)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Delivery of session {session['session_id']} from file {offset} to {chat_id} failed: {e}")
+
+    async def _deliver_page(self, chat_id: int, user_id: int, session: dict, offset: int, is_owner: bool,
+                            started: float):
+        files = await self.db.get_session_files(session['session_id'], offset, config.DELIVERY_PAGE_SIZE)
+        protect_content = session['protect_content'] and not is_owner
+
+        if session['delivery_mode'] == 'album':
+            batches = FileHandler.group_for_album([file['file_type'] for file in files])
+        else:
+            batches = [[i] for i in range(len(files))]
+
+        sent_messages = []
+        for batch in batches:
+            if len(batch) > 1:
+                try:
+                    msgs = await self.send_album(chat_id, [files[i] for i in batch], protect_content)
+                    sent_messages.extend(msg.message_id for msg in msgs)
+                    continue
+                except Exception as e:
+                    logger.error(f"Error sending album of files {offset + batch[0]}-{offset + batch[-1]}, sending one by one: {e}")
+
+            for i in batch:
+                try:
+                    msg = await self.send_file(chat_id, files[i], protect_content)
+                    sent_messages.append(msg.message_id)
+                except Exception as e:
+                    logger.error(f"Error sending file {offset + i}: {e}")
+                    await self.bot.send_message(chat_id, f"❌ Error sending file {offset + i + 1}")
+
+        self.db.record_access(session['session_id'], user_id, offset, len(sent_messages), time.perf_counter() - started)
+
+        # Handle auto-delete for non-owners, every page is scheduled on its own
+        if not is_owner and session['auto_delete_minutes'] > 0:
+            await self.deleter.schedule(chat_id, sent_messages, session['auto_delete_minutes'])
+            if offset == 0:
+                await self.bot.send_message(
+                    chat_id,
+                    f"⚠️ These files will be automatically deleted in {BotUtils.format_time(session['auto_delete_minutes'])}."
+                )
+
+        sent = offset + len(files)
+        if sent < session['file_count']:
+            remaining = min(config.DELIVERY_PAGE_SIZE, session['file_count'] - sent)
+            keyboard = InlineKeyboardMarkup().add(
+                InlineKeyboardButton(f"▶️ Next {remaining}", callback_data=f"next:{session['session_id']}:{sent}")
+            )
+            await self.bot.send_message(chat_id, f"📦 Sent {sent} of {session['file_count']} files.", reply_markup=keyboard)
+
+    async def send_file(self, chat_id: int, file: dict, protect_content: bool):
+        """Send a stored file with the Bot API method matching its type"""
+        file_id, file_type, caption = file['file_id'], file['file_type'], file['caption']
+        if file_type == 'photo':
+            return await self.bot.send_photo(chat_id, photo=file_id, caption=caption, protect_content=protect_content)
+        elif file_type == 'video':
+            return await self.bot.send_video(chat_id, video=file_id, caption=caption, protect_content=protect_content)
+        elif file_type == 'audio':
+            return await self.bot.send_audio(chat_id, audio=file_id, caption=caption, protect_content=protect_content)
+        else:
+            return await self.bot.send_document(chat_id, document=file_id, caption=caption, protect_content=protect_content)
+
+    async def send_album(self, chat_id: int, files: list, protect_content: bool):
+        """Send stored files as one media group, returns the sent messages"""
+        media = types.MediaGroup()
+        for file in files:
+            file_id, file_type, caption = file['file_id'], file['file_type'], file['caption'] or None
+            if file_type == 'photo':
+                media.attach(types.InputMediaPhoto(media=file_id, caption=caption))
+            elif file_type == 'video':
+                media.attach(types.InputMediaVideo(media=file_id, caption=caption))
+            elif file_type == 'audio':
+                media.attach(types.InputMediaAudio(media=file_id, caption=caption))
+            else:
+                media.attach(types.InputMediaDocument(media=file_id, caption=caption))
+        return await self.bot.send_media_group(chat_id, media, protect_content=protect_content)
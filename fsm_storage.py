@@ -0,0 +1,151 @@
+import asyncio
+import copy
+import json
+import logging
+import time
+import uuid
+from collections import OrderedDict
+from aiogram.dispatcher.storage import BaseStorage
+
+from config import config
+
+logger = logging.getLogger(__name__)
+
+class PostgresStorage(BaseStorage):
+    """aiogram FSM storage on the bot's asyncpg pool.
+
+    Each conversation is one fsm_states row, removed when it finishes and
+    expired after FSM_STATE_TTL seconds without activity. Reads go through
+    a local cache; every write notifies other instances on the
+    fsm_changed channel so they drop their cached copy.
+    """
+
+    def __init__(self, db):
+        self.db = db
+        self.instance_id = uuid.uuid4().hex
+        # (chat, user) -> (expires_at, state, data)
+        self.cache = OrderedDict()
+        self._sweep_task = None
+        db.invalidation_handlers['fsm_changed'] = (self._on_fsm_changed, self._on_reconnect)
+
+    def start(self):
+        self._sweep_task = asyncio.create_task(self._sweep_loop())
+
+    async def close(self):
+        if self._sweep_task:
+            self._sweep_task.cancel()
+            try:
+                await self._sweep_task
+            except asyncio.CancelledError:
+                pass
+            self._sweep_task = None
+
+    async def wait_closed(self):
+        pass
+
+    async def get_state(self, *, chat=None, user=None, default=None):
+        chat, user = self.check_address(chat=chat, user=user)
+        state, data = await self._load(chat, user)
+        return state if state is not None else self.resolve_state(default)
+
+    async def get_data(self, *, chat=None, user=None, default=None):
+        chat, user = self.check_address(chat=chat, user=user)
+        state, data = await self._load(chat, user)
+        return copy.deepcopy(data) if data else copy.deepcopy(default or {})
+
+    async def set_state(self, *, chat=None, user=None, state=None):
+        chat, user = self.check_address(chat=chat, user=user)
+        state = self.resolve_state(state)
+        cached = self._cached(chat, user)
+        await self.db.set_fsm_state(chat, user, state, notify=self._payload(chat, user))
+        if cached is not None:
+            self._put(chat, user, state, cached[1])
+        else:
+            self.cache.pop((chat, user), None)
+
+    async def set_data(self, *, chat=None, user=None, data=None):
+        chat, user = self.check_address(chat=chat, user=user)
+        data = copy.deepcopy(data or {})
+        cached = self._cached(chat, user)
+        await self.db.set_fsm_data(chat, user, data, notify=self._payload(chat, user))
+        if cached is not None:
+            self._put(chat, user, cached[0], data)
+        else:
+            self.cache.pop((chat, user), None)
+
+    async def update_data(self, *, chat=None, user=None, data=None, **kwargs):
+        chat, user = self.check_address(chat=chat, user=user)
+        changes = dict(data or {}, **kwargs)
+        cached = self._cached(chat, user)
+        merged = await self.db.update_fsm_data(chat, user, changes, notify=self._payload(chat, user))
+        if cached is not None:
+            self._put(chat, user, cached[0], merged)
+
+    async def append_data(self, *, chat=None, user=None, **items):
+        """Append to list values without rewriting the rest of the data, returns the updated data"""
+        chat, user = self.check_address(chat=chat, user=user)
+        cached = self._cached(chat, user)
+        merged = await self.db.append_fsm_data(chat, user, items, notify=self._payload(chat, user))
+        if cached is not None:
+            self._put(chat, user, cached[0], merged)
+        return copy.deepcopy(merged)
+
+    async def reset_state(self, *, chat=None, user=None, with_data=True):
+        chat, user = self.check_address(chat=chat, user=user)
+        if with_data:
+            # A finished conversation leaves no row behind
+            await self.db.delete_fsm_record(chat, user, notify=self._payload(chat, user))
+            self._put(chat, user, None, {})
+        else:
+            await self.set_state(chat=chat, user=user, state=None)
+
+    async def _load(self, chat, user):
+        cached = self._cached(chat, user)
+        if cached is not None:
+            return cached
+
+        record = await self.db.get_fsm_record(chat, user)
+        if record:
+            state, data = record['state'], json.loads(record['data'] or '{}')
+        else:
+            state, data = None, {}
+        self._put(chat, user, state, data)
+        return state, data
+
+    def _cached(self, chat, user):
+        entry = self.cache.get((chat, user))
+        if entry is None:
+            return None
+        if entry[0] < time.monotonic():
+            del self.cache[(chat, user)]
+            return None
+        self.cache.move_to_end((chat, user))
+        return entry[1], entry[2]
+
+    def _put(self, chat, user, state, data):
+        self.cache[(chat, user)] = (time.monotonic() + config.FSM_CACHE_TTL, state, data)
+        self.cache.move_to_end((chat, user))
+        while len(self.cache) > config.FSM_CACHE_SIZE:
+            self.cache.popitem(last=False)
+
+    def _payload(self, chat, user) -> str:
+        return f"{self.instance_id}:{chat}:{user}"
+
+    def _on_fsm_changed(self, conn, pid, channel, payload):
+        instance_id, chat, user = payload.split(':')
+        if instance_id != self.instance_id:
+            self.cache.pop((int(chat), int(user)), None)
+
+    async def _on_reconnect(self):
+        self.cache.clear()
+
+    async def _sweep_loop(self):
+        """Expire abandoned conversations, e.g. uploads that were never finished"""
+        while True:
+            await asyncio.sleep(config.FSM_SWEEP_INTERVAL)
+            try:
+                deleted = await self.db.expire_fsm_records(config.FSM_STATE_TTL)
+                if deleted:
+                    logger.info(f"Expired {deleted} abandoned FSM states")
+            except Exception as e:
+                logger.error(f"Failed to expire FSM states: {e}")
@@ -0,0 +1,216 @@
+import asyncio
+import logging
+from collections import OrderedDict, deque
+from aiogram import Bot, Dispatcher, types
+
+from config import config
+from metrics import UPDATE_WAIT_SECONDS
+
+logger = logging.getLogger(__name__)
+
+def get_chat_id(update: types.Update) -> int:
+    """Chat an update belongs to, used to keep per-chat ordering"""
+    for obj in (update.message, update.edited_message, update.channel_post, update.edited_channel_post,
+                update.my_chat_member, update.chat_member, update.chat_join_request):
+        if obj:
+            return obj.chat.id
+    if update.callback_query:
+        if update.callback_query.message:
+            return update.callback_query.message.chat.id
+        return update.callback_query.from_user.id
+    for obj in (update.inline_query, update.chosen_inline_result, update.shipping_query,
+                update.pre_checkout_query, update.poll_answer):
+        if obj:
+            return obj.from_user.id if hasattr(obj, 'from_user') else obj.user.id
+    return 0
+
+class UpdateQueue:
+    """Process webhook updates in the background with a bounded worker pool.
+
+    Updates of one chat are handled strictly in order by one worker at a
+    time, different chats run concurrently. Updates already seen are
+    dropped, and when UPDATE_QUEUE_SIZE updates are pending new ones are
+    refused so Telegram redelivers them later.
+    """
+
+    def __init__(self, dp: Dispatcher):
+        self.dp = dp
+        # chat_id -> deque of (enqueued_at, update), present while the chat has work or is being processed
+        self.pending = {}
+        self.ready = asyncio.Queue()
+        self.size = 0
+        self.seen = OrderedDict()
+        self.workers = []
+        self.received_count = 0
+        self.processed_count = 0
+        self.duplicate_count = 0
+        self.shed_count = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def start(self):
+        for _ in range(config.UPDATE_WORKERS):
+            self.workers.append(asyncio.create_task(self._worker()))
+
+    async def close(self):
+        """Give pending updates UPDATE_DRAIN_TIMEOUT seconds to finish, then stop the workers"""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + config.UPDATE_DRAIN_TIMEOUT
+        while self.pending and loop.time() < deadline:
+            await asyncio.sleep(0.1)
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
+
+    def put(self, update: types.Update) -> bool:
+        """Queue an update, returns False when it was shed because the queue is full"""
+        if update.update_id in self.seen:
+            self.duplicate_count += 1
+            return True
+        if self.size >= config.UPDATE_QUEUE_SIZE:
+            self.shed_count += 1
+            return False
+
+        self.seen[update.update_id] = None
+        if len(self.seen) > config.UPDATE_DEDUP_SIZE:
+            self.seen.popitem(last=False)
+
+        chat_id = get_chat_id(update)
+        if chat_id not in self.pending:
+            self.pending[chat_id] = deque()
+            self.ready.put_nowait(chat_id)
+        self.pending[chat_id].append((asyncio.get_running_loop().time(), update))
+        self.size += 1
+        self.received_count += 1
+        return True
+
+    def stats(self) -> dict:
+        return {
+            'depth': self.size,
+            'chats': len(self.pending),
+            'received': self.received_count,
+            'processed': self.processed_count,
+            'duplicates': self.duplicate_count,
+            'shed': self.shed_count,
+            'wait_avg': self.wait_total / self.processed_count if self.processed_count else 0.0,
+            'wait_max': self.wait_max
+        }
+
+    async def _worker(self):
+        # Handlers resolve the bot and dispatcher through context variables
+        Bot.set_current(self.dp.bot)
+        Dispatcher.set_current(self.dp)
+        loop = asyncio.get_running_loop()
+
+        while True:
+            chat_id = await self.ready.get()
+            updates = self.pending[chat_id]
+            while updates:
+                enqueued_at, update = updates.popleft()
+                self.size -= 1
+
+                wait = loop.time() - enqueued_at
+                self.wait_total += wait
+                self.wait_max = max(self.wait_max, wait)
+                UPDATE_WAIT_SECONDS.observe(wait)
+
+                try:
+                    # Own task per update: aiogram caches the FSM state in context variables,
+                    # reusing the worker's context would leak it into the chat's next update
+                    await asyncio.create_task(self.dp.process_update(update))
+                except Exception as e:
+                    logger.error(f"Update {update.update_id} caused error {e}")
+                self.processed_count += 1
+            del self.pending[chat_id]
+
+class MediaGroupCollector:
+    """Buffer the items of a media group (album) and hand them over together.
+
+    Telegram delivers an album as one update per item with no marker for
+    the last one, so items are collected per chat and media group until
+    none arrived for `window` seconds or `max_size` are in, then
+    on_batch(messages) runs once for the whole group. Batches of one chat
+    run one after another in the order they were handed over, add() and
+    submit() are the only ways in, so a chat's uploads keep their order.
+    """
+
+    def __init__(self, window: float, max_size: int, on_batch):
+        self.window = window
+        self.max_size = max_size
+        self.on_batch = on_batch
+        # (chat_id, media_group_id) -> [messages, debounce timer]
+        self.groups = {}
+        # chat_id -> task running the chat's most recent batch, each batch waits for the one before
+        self.tails = {}
+
+    def add(self, message: types.Message):
+        key = (message.chat.id, message.media_group_id)
+        group = self.groups.get(key)
+        if group is None:
+            group = self.groups[key] = [[], None]
+        group[0].append(message)
+        if group[1]:
+            group[1].cancel()
+
+        if len(group[0]) >= self.max_size:
+            self._flush(key)
+        else:
+            group[1] = asyncio.get_running_loop().call_later(self.window, self._flush, key)
+
+    async def submit(self, messages: list):
+        """Hand over messages that are not part of an album behind the chat's pending groups, and wait for them"""
+        chat_id = messages[0].chat.id
+        for key in [key for key in self.groups if key[0] == chat_id]:
+            self._flush(key)
+        await self._enqueue(chat_id, messages)
+
+    async def flush_chat(self, chat_id: int):
+        """Hand over the chat's pending groups now and wait until they are processed"""
+        for key in [key for key in self.groups if key[0] == chat_id]:
+            self._flush(key)
+        tail = self.tails.get(chat_id)
+        if tail:
+            await asyncio.wait({tail})
+
+    def discard_chat(self, chat_id: int):
+        for key in [key for key in self.groups if key[0] == chat_id]:
+            messages, timer = self.groups.pop(key)
+            if timer:
+                timer.cancel()
+
+    async def close(self):
+        for key in list(self.groups):
+            self._flush(key)
+        await asyncio.gather(*self.tails.values(), return_exceptions=True)
+
+    def _flush(self, key):
+        if key not in self.groups:
+            return
+        # Albums of the chat started earlier go first, even when this one filled up before their window passed
+        for earlier in [earlier for earlier in self.groups if earlier[0] == key[0]]:
+            if earlier == key:
+                break
+            self._flush(earlier)
+        group = self.groups.pop(key)
+        if group[1]:
+            group[1].cancel()
+        self._enqueue(key[0], group[0])
+
+    def _enqueue(self, chat_id: int, messages: list) -> asyncio.Task:
+        task = asyncio.create_task(self._run_batch(chat_id, messages, self.tails.get(chat_id)))
+        self.tails[chat_id] = task
+        task.add_done_callback(lambda t: self._release(chat_id, t))
+        return task
+
+    def _release(self, chat_id: int, task: asyncio.Task):
+        if self.tails.get(chat_id) is task:
+            del self.tails[chat_id]
+
+    async def _run_batch(self, chat_id: int, messages: list, previous):
+        if previous:
+            await asyncio.wait({previous})
+        try:
+            await self.on_batch(messages)
+        except Exception as e:
+            logger.error(f"Failed to process upload batch in chat {chat_id}: {e}")
@@ -0,0 +1,547 @@
+import copy
+import csv
+import io
+import itertools
+import json
+import time
+from collections import defaultdict
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta
+
+from database import BaseDatabase, DEFAULT_MESSAGES, SESSION_COLUMNS, SESSION_FILE_COLUMNS, USER_COLUMNS
+from metrics import DB_QUERY_SECONDS
+from profiler import record_await
+from utils import SessionTokens
+
+class MemoryDatabase(BaseDatabase):
+    """Storage in process memory, selected with DATABASE_BACKEND=memory.
+
+    Mirrors Database method by method, including the statistics row the
+    Postgres triggers maintain and the activity rollups, so every handler
+    runs unchanged without a server. Nothing survives a restart and other
+    instances see nothing, use it for benchmarks, tests and local runs.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.users = {}
+        self.message_rows = {}
+        self.upload_sessions = {}
+        # session_id -> [{'file_id', 'file_unique_id', 'file_type', 'caption'}] in delivery order
+        self.session_files = {}
+        self.statistics = None
+        self.broadcast_jobs = {}
+        self.pending_deletions = {}
+        # (day, join_day) -> active users
+        self.activity_daily = defaultdict(int)
+        self.session_access_events = []
+        # (hour, session_id) -> [opens, pages, files, latency_ms]
+        self.session_access_hourly = defaultdict(lambda: [0, 0, 0, 0])
+        # (chat_id, user_id) -> {'state', 'data', 'updated_at'}
+        self.fsm_states = {}
+        self._ids = itertools.count(1)
+
+    async def init(self, timer=None):
+        now = datetime.now()
+        for message_type, text, image_id in DEFAULT_MESSAGES:
+            self.message_rows.setdefault(message_type, {
+                'id': next(self._ids), 'message_type': message_type, 'text': text,
+                'image_id': image_id, 'updated_at': now
+            })
+        await self.reconcile_statistics()
+        await self.load_messages()
+        # Every session in memory is signed
+        self.legacy_session_ids = set()
+        self._start_flush_loop()
+        if timer:
+            timer.mark('db memory')
+
+    async def close(self):
+        await self._stop_flush_loop()
+        await self.flush_activity()
+        await self.flush_access_counts()
+        await self.flush_access_events()
+
+    @asynccontextmanager
+    async def _timed(self, name: str):
+        """Record calls like Database._acquire does, with no pool wait"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            self.timings.record(name, 0.0, elapsed)
+            DB_QUERY_SECONDS.observe(elapsed, name)
+            record_await('db', elapsed)
+
+    async def ping(self):
+        pass
+
+    # Users and activity
+
+    def _upsert_user(self, user_id: int, profile: tuple, now: datetime):
+        user = self.users.get(user_id)
+        if user is None:
+            self.users[user_id] = {
+                'id': user_id, 'username': profile[0], 'first_name': profile[1], 'last_name': profile[2],
+                'join_date': now, 'last_active': now, 'is_banned': False, 'is_blocked': False
+            }
+            self._bump_statistics(total_users=1)
+        else:
+            user.update(username=profile[0], first_name=profile[1], last_name=profile[2],
+                        last_active=now, is_blocked=False)
+
+    async def add_user(self, user_id: int, username: str, first_name: str, last_name: str = None):
+        async with self._timed('add_user'):
+            self._upsert_user(user_id, (username, first_name, last_name), datetime.now())
+
+    async def flush_activity(self) -> int:
+        pending = self.activity.drain()
+        if not pending:
+            return 0
+
+        async with self._timed('flush_activity'):
+            now = datetime.now()
+            self._update_activity_rollups(pending, now)
+            for user_id, profile in pending.items():
+                if profile is not None:
+                    self._upsert_user(user_id, profile, now)
+                elif user_id in self.users:
+                    self.users[user_id].update(last_active=now, is_blocked=False)
+
+        self.activity.flushed_count += len(pending)
+        self.activity.flush_count += 1
+        return len(pending)
+
+    def _update_activity_rollups(self, pending: dict, now: datetime):
+        """Same counting as Database._update_activity_rollups"""
+        today = now.date()
+        for user_id, profile in pending.items():
+            user = self.users.get(user_id)
+            if user is None:
+                if profile is not None:
+                    self.activity_daily[(today, today)] += 1
+                continue
+            if user['last_active'] is None or user['last_active'].date() < today:
+                self.activity_daily[(today, user['join_date'].date())] += 1
+
+    # Broadcasts
+
+    def _recipients(self):
+        return (user for user in self.users.values() if not user['is_banned'] and not user['is_blocked'])
+
+    async def get_all_users(self):
+        async with self._timed('get_all_users'):
+            return [dict(user) for user in self._recipients()]
+
+    async def count_broadcast_recipients(self):
+        async with self._timed('count_broadcast_recipients'):
+            return sum(1 for _ in self._recipients())
+
+    async def get_broadcast_recipients(self, after_user_id: int, limit: int):
+        async with self._timed('get_broadcast_recipients'):
+            return sorted(user['id'] for user in self._recipients() if user['id'] > after_user_id)[:limit]
+
+    async def mark_users_blocked(self, user_ids: list):
+        async with self._timed('mark_users_blocked'):
+            for user_id in user_ids:
+                if user_id in self.users:
+                    self.users[user_id]['is_blocked'] = True
+
+    async def create_broadcast_job(self, owner_id: int, from_chat_id: int, message_id: int,
+                                   progress_chat_id: int, progress_message_id: int, total_count: int):
+        async with self._timed('create_broadcast_job'):
+            now = datetime.now()
+            job = {
+                'id': next(self._ids), 'owner_id': owner_id, 'from_chat_id': from_chat_id,
+                'message_id': message_id, 'progress_chat_id': progress_chat_id,
+                'progress_message_id': progress_message_id, 'status': 'running', 'last_user_id': 0,
+                'total_count': total_count, 'sent_count': 0, 'failed_count': 0, 'blocked_count': 0,
+                'created_at': now, 'updated_at': now, 'finished_at': None
+            }
+            self.broadcast_jobs[job['id']] = job
+            return dict(job)
+
+    async def get_running_broadcast_jobs(self):
+        async with self._timed('get_running_broadcast_jobs'):
+            return [dict(job) for job_id, job in sorted(self.broadcast_jobs.items()) if job['status'] == 'running']
+
+    async def update_broadcast_progress(self, job_id: int, last_user_id: int, sent_count: int,
+                                        failed_count: int, blocked_count: int):
+        async with self._timed('update_broadcast_progress'):
+            job = self.broadcast_jobs.get(job_id)
+            if job is None:
+                return None
+            job.update(last_user_id=last_user_id, sent_count=sent_count, failed_count=failed_count,
+                       blocked_count=blocked_count, updated_at=datetime.now())
+            return job['status']
+
+    async def finish_broadcast_job(self, job_id: int, status: str):
+        async with self._timed('finish_broadcast_job'):
+            job = self.broadcast_jobs.get(job_id)
+            if job and job['status'] == 'running':
+                now = datetime.now()
+                job.update(status=status, updated_at=now, finished_at=now)
+
+    async def cancel_broadcast_jobs(self):
+        async with self._timed('cancel_broadcast_jobs'):
+            now = datetime.now()
+            job_ids = []
+            for job in self.broadcast_jobs.values():
+                if job['status'] == 'running':
+                    job.update(status='cancelled', updated_at=now, finished_at=now)
+                    job_ids.append(job['id'])
+            return job_ids
+
+    # Activity statistics
+
+    async def get_active_users_counts(self):
+        async with self._timed('get_active_users_counts'):
+            now = datetime.now()
+            windows = {'1h': timedelta(hours=1), '24h': timedelta(hours=24), '48h': timedelta(hours=48),
+                       '7d': timedelta(days=7), '30d': timedelta(days=30)}
+            return {
+                name: sum(1 for user in self.users.values()
+                          if not user['is_banned'] and user['last_active'] > now - window)
+                for name, window in windows.items()
+            }
+
+    async def get_daily_active_users(self, days: int = 7):
+        async with self._timed('get_daily_active_users'):
+            since = datetime.now().date() - timedelta(days=days)
+            totals = defaultdict(int)
+            for (day, join_day), active_users in self.activity_daily.items():
+                if day > since:
+                    totals[day] += active_users
+            return [{'day': day, 'active_users': totals[day]} for day in sorted(totals, reverse=True)]
+
+    async def get_retention(self, offsets: list, cohort_days: int = 30):
+        async with self._timed('get_retention'):
+            today = datetime.now().date()
+            rows = []
+            for offset in offsets:
+                retained = cohort = 0
+                for (day, join_day), active_users in self.activity_daily.items():
+                    if day == join_day and today - timedelta(days=cohort_days) <= join_day <= today - timedelta(days=offset):
+                        cohort += active_users
+                        retained += self.activity_daily.get((join_day + timedelta(days=offset), join_day), 0)
+                rows.append({'offset_days': offset, 'retained': retained, 'cohort': cohort})
+            return rows
+
+    # Start and help messages
+
+    async def set_message(self, message_type: str, text: str, image_id: str = None):
+        async with self._timed('set_message'):
+            row = self.message_rows.get(message_type) or {'id': next(self._ids), 'message_type': message_type}
+            row.update(text=text, image_id=image_id, updated_at=datetime.now())
+            self.message_rows[message_type] = row
+            self.messages[message_type] = dict(row)
+
+    async def _load_message(self, message_type: str):
+        async with self._timed('get_message'):
+            row = self.message_rows.get(message_type)
+            return dict(row) if row else None
+
+    async def load_messages(self):
+        async with self._timed('load_messages'):
+            self.messages = {message_type: dict(row) for message_type, row in self.message_rows.items()}
+
+    # FSM storage, notify is accepted for compatibility: there are no other instances to tell
+
+    async def get_fsm_record(self, chat_id: int, user_id: int):
+        async with self._timed('get_fsm_record'):
+            record = self.fsm_states.get((chat_id, user_id))
+            if record is None:
+                return None
+            # Data comes back JSON encoded, like the JSONB column does
+            return {'state': record['state'], 'data': json.dumps(record['data'])}
+
+    def _fsm_record(self, chat_id: int, user_id: int) -> dict:
+        record = self.fsm_states.setdefault((chat_id, user_id), {'state': None, 'data': {}})
+        record['updated_at'] = datetime.now()
+        return record
+
+    async def set_fsm_state(self, chat_id: int, user_id: int, state: str, notify: str = None):
+        async with self._timed('set_fsm_state'):
+            self._fsm_record(chat_id, user_id)['state'] = state
+
+    async def set_fsm_data(self, chat_id: int, user_id: int, data: dict, notify: str = None):
+        async with self._timed('set_fsm_data'):
+            self._fsm_record(chat_id, user_id)['data'] = copy.deepcopy(data)
+
+    async def update_fsm_data(self, chat_id: int, user_id: int, data: dict, notify: str = None) -> dict:
+        async with self._timed('update_fsm_data'):
+            record = self._fsm_record(chat_id, user_id)
+            record['data'].update(copy.deepcopy(data))
+            return copy.deepcopy(record['data'])
+
+    async def append_fsm_data(self, chat_id: int, user_id: int, items: dict, notify: str = None) -> dict:
+        async with self._timed('append_fsm_data'):
+            record = self._fsm_record(chat_id, user_id)
+            for key, values in items.items():
+                record['data'][key] = record['data'].get(key, []) + copy.deepcopy(values)
+            return copy.deepcopy(record['data'])
+
+    async def delete_fsm_record(self, chat_id: int, user_id: int, notify: str = None):
+        async with self._timed('delete_fsm_record'):
+            self.fsm_states.pop((chat_id, user_id), None)
+
+    async def expire_fsm_records(self, max_age_seconds: int, batch_size: int = 1000) -> int:
+        async with self._timed('expire_fsm_records'):
+            cutoff = datetime.now() - timedelta(seconds=max_age_seconds)
+            expired = [key for key, record in self.fsm_states.items() if record['updated_at'] < cutoff]
+            for key in expired:
+                del self.fsm_states[key]
+            return len(expired)
+
+    # Upload sessions
+
+    async def create_upload_session(self, session_id: str, owner_id: int, files: list, protect_content: bool,
+                                  auto_delete_minutes: int, delivery_mode: str = 'single', expires_at: datetime = None):
+        async with self._timed('create_upload_session'):
+            if session_id in self.upload_sessions:
+                raise ValueError(f"Upload session {session_id} already exists")
+            self.upload_sessions[session_id] = {
+                'session_id': session_id,
+                'owner_id': owner_id,
+                'file_count': len(files),
+                'protect_content': protect_content,
+                'auto_delete_minutes': auto_delete_minutes,
+                'delivery_mode': delivery_mode or 'single',
+                'created_at': datetime.now(),
+                'access_count': 0,
+                'expires_at': expires_at
+            }
+            self.session_files[session_id] = [{
+                'file_id': file['file_id'],
+                'file_unique_id': file.get('file_unique_id'),
+                'file_type': file['file_type'],
+                'caption': file.get('caption') or ''
+            } for file in files]
+            self._bump_statistics(total_sessions=1, total_uploads=len(files))
+
+    async def next_upload_session_number(self) -> int:
+        async with self._timed('next_upload_session_number'):
+            return next(self._ids)
+
+    async def _load_upload_session(self, session_id: str):
+        async with self._timed('get_upload_session'):
+            row = self.upload_sessions.get(session_id)
+            if row is None:
+                return None
+            session = copy.deepcopy(row)
+            del session['access_count']
+            return session
+
+    async def _load_session_files(self, session_id: str, offset: int, limit: int) -> list:
+        async with self._timed('get_session_files'):
+            return [
+                {'file_id': file['file_id'], 'file_type': file['file_type'], 'caption': file['caption']}
+                for file in self.session_files.get(session_id, [])[offset:offset + limit]
+            ]
+
+    async def expire_upload_sessions(self, unused_before: datetime = None, batch_size: int = 500) -> int:
+        async with self._timed('expire_upload_sessions'):
+            now = datetime.now()
+            expired = [
+                session_id for session_id, row in self.upload_sessions.items()
+                if (row['expires_at'] and row['expires_at'] < now)
+                or (unused_before and row['access_count'] == 0 and row['created_at'] < unused_before)
+            ]
+            for session_id in expired:
+                row = self.upload_sessions.pop(session_id)
+                self.session_files.pop(session_id, None)
+                self._bump_statistics(total_sessions=-1, total_uploads=-row['file_count'])
+            return len(expired)
+
+    async def flush_access_counts(self) -> int:
+        if not self.access_counts:
+            return 0
+        counts, self.access_counts = self.access_counts, {}
+
+        async with self._timed('flush_access_counts'):
+            for session_id, hits in counts.items():
+                if session_id in self.upload_sessions:
+                    self.upload_sessions[session_id]['access_count'] += hits
+
+        self.access_flushed_count += len(counts)
+        self.access_flush_count += 1
+        return len(counts)
+
+    async def flush_access_events(self) -> int:
+        if not self.access_events:
+            return 0
+        events, self.access_events = self.access_events, []
+
+        async with self._timed('flush_access_events'):
+            self.session_access_events.extend(events)
+            for key, totals in self._access_rollups(events).items():
+                self.session_access_hourly[key] = [a + b for a, b in zip(self.session_access_hourly[key], totals)]
+
+        self.access_events_flushed += len(events)
+        return len(events)
+
+    async def get_top_sessions(self, hours: int, limit: int):
+        async with self._timed('get_top_sessions'):
+            since = self._hours_ago(hours)
+            sessions = defaultdict(lambda: [0, 0, 0, 0])
+            for (hour, session_id), totals in self.session_access_hourly.items():
+                if hour >= since and session_id in self.upload_sessions:
+                    sessions[session_id] = [a + b for a, b in zip(sessions[session_id], totals)]
+            top = sorted(sessions.items(), key=lambda item: (item[1][0], item[1][2]), reverse=True)[:limit]
+            return [
+                {'session_id': session_id, 'opens': opens, 'pages': pages, 'files': files,
+                 'avg_latency_ms': latency_ms // pages if pages else None}
+                for session_id, (opens, pages, files, latency_ms) in top
+            ]
+
+    async def delete_access_events(self, before: datetime, batch_size: int = 500) -> int:
+        async with self._timed('delete_access_events'):
+            kept = [event for event in self.session_access_events if event[2] >= before]
+            deleted = len(self.session_access_events) - len(kept)
+            self.session_access_events = kept
+            return deleted
+
+    # Auto-delete queue
+
+    async def add_pending_deletion(self, chat_id: int, message_ids: list, delay_minutes: int):
+        async with self._timed('add_pending_deletion'):
+            deletion_id = next(self._ids)
+            self.pending_deletions[deletion_id] = {
+                'id': deletion_id,
+                'chat_id': chat_id,
+                'message_ids': list(message_ids),
+                'delete_at': datetime.now() + timedelta(minutes=delay_minutes),
+                'claimed_until': None
+            }
+
+    def _unclaimed(self, now: datetime, worker: int, workers: int):
+        return (row for row in self.pending_deletions.values()
+                if (row['claimed_until'] is None or row['claimed_until'] < now) and row['chat_id'] % workers == worker)
+
+    async def claim_due_deletions(self, limit: int, claim_seconds: int, worker: int = 0, workers: int = 1):
+        async with self._timed('claim_due_deletions'):
+            now = datetime.now()
+            due = sorted((row for row in self._unclaimed(now, worker, workers) if row['delete_at'] <= now),
+                         key=lambda row: row['delete_at'])[:limit]
+            for row in due:
+                row['claimed_until'] = now + timedelta(seconds=claim_seconds)
+            return [{'id': row['id'], 'chat_id': row['chat_id'], 'message_ids': list(row['message_ids'])} for row in due]
+
+    async def remove_pending_deletions(self, deletion_ids: list):
+        async with self._timed('remove_pending_deletions'):
+            for deletion_id in deletion_ids:
+                self.pending_deletions.pop(deletion_id, None)
+
+    async def count_pending_deletions(self):
+        async with self._timed('count_pending_deletions'):
+            return len(self.pending_deletions)
+
+    async def get_next_deletion_delay(self, worker: int = 0, workers: int = 1):
+        async with self._timed('get_next_deletion_delay'):
+            now = datetime.now()
+            delete_at = min((row['delete_at'] for row in self._unclaimed(now, worker, workers)), default=None)
+            return (delete_at - now).total_seconds() if delete_at else None
+
+    # Statistics, kept up to date on every write like the Postgres triggers do
+
+    def _bump_statistics(self, **deltas):
+        if self.statistics is None:
+            return
+        for key, delta in deltas.items():
+            self.statistics[key] += delta
+        self.statistics['last_updated'] = datetime.now()
+
+    async def reconcile_statistics(self, conn=None):
+        async with self._timed('reconcile_statistics'):
+            now = datetime.now()
+            self.statistics = {
+                'id': 1,
+                'total_users': sum(1 for user in self.users.values() if not user['is_banned']),
+                'total_uploads': sum(row['file_count'] for row in self.upload_sessions.values()),
+                'total_sessions': len(self.upload_sessions),
+                'last_updated': now,
+                'reconciled_at': now
+            }
+
+    async def get_statistics(self):
+        async with self._timed('get_statistics'):
+            return dict(self.statistics) if self.statistics else None
+
+    # Export and import
+
+    @staticmethod
+    def _csv_value(value):
+        # Same text Postgres writes in COPY ... CSV
+        if value is None:
+            return ''
+        if isinstance(value, bool):
+            return 't' if value else 'f'
+        return value
+
+    async def export_table(self, table: str, write, chunk_rows: int = 500) -> int:
+        if table == 'users':
+            header = USER_COLUMNS
+            rows = ([user[column] for column in USER_COLUMNS] for _, user in sorted(self.users.items()))
+        else:
+            header = SESSION_COLUMNS + ('files',)
+            sessions = sorted(self.upload_sessions.values(), key=lambda row: (row['created_at'], row['session_id']))
+            rows = (
+                [row[column] for column in SESSION_COLUMNS] + [json.dumps(self.session_files.get(row['session_id'], []))]
+                for row in sessions
+            )
+
+        buffer = io.StringIO()
+        writer = csv.writer(buffer, lineterminator='\n')
+        writer.writerow(header)
+        count = 0
+        async with self._timed(f'export_{table}'):
+            for row in rows:
+                writer.writerow([self._csv_value(value) for value in row])
+                count += 1
+                if count % chunk_rows == 0:
+                    await write(buffer.getvalue().encode())
+                    buffer.seek(0)
+                    buffer.truncate()
+            await write(buffer.getvalue().encode())
+        return count
+
+    async def import_users(self, records: list) -> int:
+        added = 0
+        async with self._timed('import_users'):
+            for record in records:
+                user = dict(zip(USER_COLUMNS, record))
+                if user['id'] in self.users:
+                    continue
+                self.users[user['id']] = user
+                added += 1
+                if not user['is_banned']:
+                    self._bump_statistics(total_users=1)
+        return added
+
+    async def import_sessions(self, sessions: list, files: list) -> int:
+        added = []
+        async with self._timed('import_sessions'):
+            for record in sessions:
+                row = dict(zip(SESSION_COLUMNS, record))
+                if row['session_id'] in self.upload_sessions:
+                    continue
+                self.upload_sessions[row['session_id']] = row
+                self.session_files[row['session_id']] = []
+                added.append(row['session_id'])
+                self._bump_statistics(total_sessions=1, total_uploads=row['file_count'])
+            
+            added_ids = set(added)
+            for record in sorted(files, key=lambda record: (record[0], record[1])):
+                file = dict(zip(SESSION_FILE_COLUMNS, record))
+                session_id = file.pop('session_id')
+                del file['position']
+                if session_id in added_ids:
+                    self.session_files[session_id].append(file)
+            
+            numbers = [SessionTokens.number(session_id) for session_id in added]
+            highest = max((number for number in numbers if number is not None), default=None)
+            if highest is not None:
+                self._ids = itertools.count(max(next(self._ids), highest + 1))
+        self._remember_imported_sessions(added)
+        return len(added)
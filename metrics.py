@@ -0,0 +1,156 @@
+import asyncio
+import time
+from bisect import bisect_left
+from aiogram import Bot
+from aiogram.dispatcher.handler import current_handler
+from aiogram.dispatcher.middlewares import BaseMiddleware
+
+from profiler import record_await
+
+# Seconds, covers fast cache hits up to slow multi-file deliveries
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+REGISTRY = []
+
+def _format_labels(names: tuple, values: tuple, extra: str = '') -> str:
+    parts = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return '{' + ','.join(parts) + '}' if parts else ''
+
+class Counter:
+    def __init__(self, name: str, documentation: str, labels: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.values = {}
+        REGISTRY.append(self)
+
+    def inc(self, *label_values, amount: float = 1):
+        self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def render(self) -> list:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} counter']
+        for label_values, value in self.values.items():
+            lines.append(f'{self.name}{_format_labels(self.labels, label_values)} {value}')
+        return lines
+
+class Histogram:
+    def __init__(self, name: str, documentation: str, labels: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.buckets = buckets
+        # label values -> [per-bucket counts (last one is +Inf), sum, count]
+        self.values = {}
+        REGISTRY.append(self)
+
+    def observe(self, value: float, *label_values):
+        entry = self.values.get(label_values)
+        if entry is None:
+            entry = self.values[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        entry[0][bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+        entry[2] += 1
+
+    def render(self) -> list:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        for label_values, (counts, total, count) in self.values.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += bucket_count
+                le = f'le="{bound}"'
+                lines.append(f'{self.name}_bucket{_format_labels(self.labels, label_values, le)} {cumulative}')
+            lines.append(f'{self.name}_sum{_format_labels(self.labels, label_values)} {total}')
+            lines.append(f'{self.name}_count{_format_labels(self.labels, label_values)} {count}')
+        return lines
+
+class Gauge:
+    """Value read at scrape time from collect(), which returns {label values: value} and may be async.
+
+    metric_type='counter' exposes totals that are already counted elsewhere.
+    """
+
+    def __init__(self, name: str, documentation: str, collect, labels: tuple = (), metric_type: str = 'gauge'):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.collect = collect
+        self.metric_type = metric_type
+        REGISTRY.append(self)
+
+    async def render_async(self) -> list:
+        values = self.collect()
+        if asyncio.iscoroutine(values):
+            values = await values
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.metric_type}']
+        for label_values, value in values.items():
+            lines.append(f'{self.name}{_format_labels(self.labels, label_values)} {value}')
+        return lines
+
+async def render() -> str:
+    """All registered metrics in the Prometheus text exposition format"""
+    lines = []
+    for metric in REGISTRY:
+        if isinstance(metric, Gauge):
+            lines.extend(await metric.render_async())
+        else:
+            lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+HANDLER_SECONDS = Histogram('bot_handler_seconds', 'Time spent in dispatcher handlers', ('handler',))
+HANDLER_ERRORS = Counter('bot_handler_errors_total', 'Exceptions raised by dispatcher handlers', ('error',))
+API_SECONDS = Histogram('bot_api_request_seconds', 'Latency of outbound Bot API calls', ('method',))
+API_ERRORS = Counter('bot_api_errors_total', 'Failed outbound Bot API calls', ('method', 'error'))
+DB_QUERY_SECONDS = Histogram('bot_db_query_seconds', 'Time spent running Database methods', ('method',))
+DB_POOL_WAIT_SECONDS = Histogram('bot_db_pool_wait_seconds', 'Time waiting for a pool connection', ('method',))
+UPDATE_WAIT_SECONDS = Histogram('bot_update_queue_wait_seconds', 'Time updates wait in the queue before processing')
+SEND_QUEUE_SECONDS = Histogram('bot_send_queue_wait_seconds', 'Time Bot API sends wait for a rate limit slot', ('priority',))
+SEND_RETRIES = Counter('bot_send_retries_total', 'Bot API sends retried after RetryAfter or a network error', ('priority', 'reason'))
+
+class StartupTimer:
+    """Wall time of the startup steps, each mark() ends the step running since the previous one"""
+
+    def __init__(self, started: float):
+        self.started = started
+        self.last = started
+        # (step, seconds) in order
+        self.steps = []
+
+    def mark(self, step: str):
+        now = time.perf_counter()
+        self.steps.append((step, now - self.last))
+        self.last = now
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.started
+
+    def summary(self) -> str:
+        return ', '.join(f"{step} {seconds * 1000:.0f} ms" for step, seconds in self.steps)
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """Time every dispatcher handler, keyed by the handler function name"""
+
+    async def trigger(self, action, args):
+        if action.startswith('process_'):
+            handler = current_handler.get(None)
+            args[-1]['_metrics'] = (handler.__name__ if handler else 'unknown', time.perf_counter())
+        elif action.startswith('post_process_'):
+            started = args[-1].pop('_metrics', None)
+            if started:
+                HANDLER_SECONDS.observe(time.perf_counter() - started[1], started[0])
+
+class InstrumentedBot(Bot):
+    """Bot that times every Bot API request, all API methods go through request()"""
+
+    async def request(self, method, data=None, files=None, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await super().request(method, data, files, **kwargs)
+        except Exception as e:
+            API_ERRORS.inc(method, type(e).__name__)
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            API_SECONDS.observe(elapsed, method)
+            record_await('api', elapsed)
@@ -0,0 +1,225 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from contextvars import ContextVar
+from aiogram.utils import exceptions
+
+from config import config
+from metrics import InstrumentedBot, SEND_QUEUE_SECONDS, SEND_RETRIES
+from profiler import record_await
+
+logger = logging.getLogger(__name__)
+
+# Highest first. Deletions go before broadcasts, they are few and the auto-delete promise is timed
+PRIORITIES = ('interactive', 'delivery', 'deletion', 'broadcast')
+
+# Priority of the sends made by the running task, background workers set their own
+send_priority = ContextVar('send_priority', default='interactive')
+
+# Chat buckets kept before idle (full) ones are dropped
+MAX_CHAT_BUCKETS = 10000
+
+# Methods that change nothing when repeated, safe to resend after any network error
+IDEMPOTENT_PREFIXES = ('get', 'answer', 'edit', 'delete', 'set')
+
+def is_unsent(error: Exception) -> bool:
+    """Whether the request failed before it reached Telegram, aiogram wraps aiohttp's connect errors in NetworkError"""
+    return isinstance(error, exceptions.NetworkError) and 'ClientConnector' in str(error)
+
+class TokenBucket:
+    """`rate` sends per second with bursts of up to `burst`"""
+
+    def __init__(self, rate: float, burst: int, now: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = now
+
+    def _refill(self, now: float):
+        if now > self.updated:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def ready_at(self, now: float) -> float:
+        """Loop time at which one token is available"""
+        self._refill(now)
+        if self.tokens >= 1:
+            return max(now, self.updated)
+        return self.updated + (1 - self.tokens) / self.rate
+
+    def take(self, now: float):
+        self._refill(now)
+        self.tokens -= 1
+
+    def pause(self, seconds: float, now: float):
+        """Empty the bucket and hold it for seconds, used when Telegram answers with RetryAfter"""
+        self._refill(now)
+        self.tokens = min(self.tokens, 0.0)
+        self.updated = max(self.updated, now + seconds)
+
+    def is_full(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.burst
+
+class OutboundScheduler:
+    """Hand out Bot API send slots by priority within Telegram's rate limits.
+
+    Every call that targets a chat waits for a token from the global bucket
+    and from the bucket of its chat. One dispatcher task grants slots to the
+    highest priority waiter whose chat has a token, so a chat that is out of
+    tokens does not hold up others. RetryAfter pauses the chat's bucket and
+    the call is retried. Only when several chats are rate limited within
+    SEND_GLOBAL_PAUSE_WINDOW seconds is the global bucket held back as well.
+    Network errors are retried with exponential backoff, for calls that are
+    not idempotent only when the connection failed, since a timed out
+    sendMessage may still have been delivered.
+    """
+
+    def __init__(self):
+        self.global_bucket = None
+        # chat_id -> TokenBucket
+        self.chat_buckets = {}
+        # priority -> deque of (chat_id, future)
+        self.queues = {priority: deque() for priority in PRIORITIES}
+        self.wakeup = asyncio.Event()
+        self._task = None
+        # chat_id -> loop time of its last RetryAfter within SEND_GLOBAL_PAUSE_WINDOW
+        self.rate_limited = {}
+
+    def depth(self) -> dict:
+        return {priority: len(queue) for priority, queue in self.queues.items()}
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def call(self, chat_id, send, idempotent: bool = False):
+        """Run send() in a slot for chat_id, retrying rate limited and network errors"""
+        priority = send_priority.get()
+        for attempt in range(config.SEND_MAX_RETRIES + 1):
+            started = time.perf_counter()
+            await self.acquire(chat_id, priority)
+            waited = time.perf_counter() - started
+            SEND_QUEUE_SECONDS.observe(waited, priority)
+            record_await('api', waited)
+
+            try:
+                return await send()
+            except exceptions.RetryAfter as e:
+                if attempt == config.SEND_MAX_RETRIES:
+                    raise
+                SEND_RETRIES.inc(priority, 'retry_after')
+                logger.warning(f"Rate limited sending to {chat_id}, pausing the chat for {e.timeout}s")
+                self.pause(chat_id, e.timeout)
+            except (exceptions.NetworkError, asyncio.TimeoutError) as e:
+                if attempt == config.SEND_MAX_RETRIES or not (idempotent or is_unsent(e)):
+                    raise
+                SEND_RETRIES.inc(priority, 'network')
+                delay = config.SEND_BACKOFF * 2 ** attempt
+                logger.warning(f"Network error sending to {chat_id}, retrying in {delay}s: {e}")
+                await asyncio.sleep(delay)
+
+    async def acquire(self, chat_id, priority: str):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+        future = asyncio.get_running_loop().create_future()
+        self.queues[priority].append((chat_id, future))
+        self.wakeup.set()
+        await future
+
+    def pause(self, chat_id, seconds: float):
+        now = asyncio.get_running_loop().time()
+        self._chat_bucket(chat_id, now).pause(seconds, now)
+        # One chat over its limit says nothing about the others. Several within a short time
+        # mean the bot as a whole is sending too fast
+        self.rate_limited = {
+            key: at for key, at in self.rate_limited.items() if now - at < config.SEND_GLOBAL_PAUSE_WINDOW
+        }
+        self.rate_limited[chat_id] = now
+        if len(self.rate_limited) >= config.SEND_GLOBAL_PAUSE_CHATS:
+            logger.warning(f"{len(self.rate_limited)} chats rate limited, pausing all sends for {seconds}s")
+            self._global_bucket(now).pause(seconds, now)
+        self.wakeup.set()
+
+    def _global_bucket(self, now: float) -> TokenBucket:
+        if self.global_bucket is None:
+            # Web workers send independently, each keeps to its share of the bot's limit.
+            # Broadcasts all run in the owner's worker, which gets SEND_BROADCAST_SHARE on top
+            share = 1.0
+            if config.WORKER_INDEX is not None and config.WEB_WORKERS > 1:
+                share = (1 - config.SEND_BROADCAST_SHARE) / config.WEB_WORKERS
+                if config.IS_OWNER_WORKER:
+                    share += config.SEND_BROADCAST_SHARE
+            self.global_bucket = TokenBucket(
+                config.SEND_GLOBAL_RATE * share, max(1, int(config.SEND_GLOBAL_BURST * share)), now
+            )
+        return self.global_bucket
+
+    def _chat_bucket(self, chat_id, now: float) -> TokenBucket:
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self.chat_buckets) >= MAX_CHAT_BUCKETS:
+                self.chat_buckets = {
+                    key: value for key, value in self.chat_buckets.items() if not value.is_full(now)
+                }
+            # Groups and channels have negative ids (or an @username) and a lower limit
+            is_group = str(chat_id).startswith(('-', '@'))
+            rate = config.SEND_GROUP_RATE if is_group else config.SEND_CHAT_RATE
+            bucket = self.chat_buckets[chat_id] = TokenBucket(rate, config.SEND_CHAT_BURST, now)
+        return bucket
+
+    def _grant(self, now: float):
+        """Grant one waiting slot, returns True or the loop time worth checking again (None when idle)"""
+        ready_at = self._global_bucket(now).ready_at(now)
+        if ready_at > now:
+            return ready_at
+
+        retry_at = None
+        for priority in PRIORITIES:
+            queue = self.queues[priority]
+            for i, (chat_id, future) in enumerate(queue):
+                if future.done():
+                    # Caller was cancelled while waiting
+                    del queue[i]
+                    return True
+                chat_ready_at = self._chat_bucket(chat_id, now).ready_at(now)
+                if chat_ready_at <= now:
+                    del queue[i]
+                    self.global_bucket.take(now)
+                    self.chat_buckets[chat_id].take(now)
+                    future.set_result(None)
+                    return True
+                retry_at = chat_ready_at if retry_at is None else min(retry_at, chat_ready_at)
+        return retry_at
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            self.wakeup.clear()
+            result = self._grant(loop.time())
+            if result is True:
+                continue
+            timeout = None if result is None else result - loop.time()
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+class ScheduledBot(InstrumentedBot):
+    """Bot whose calls to a chat go through an OutboundScheduler"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.outbound = OutboundScheduler()
+
+    async def request(self, method, data=None, files=None, **kwargs):
+        chat_id = (data or {}).get('chat_id')
+        if chat_id is None or method.startswith('get'):
+            return await super().request(method, data, files, **kwargs)
+        return await self.outbound.call(
+            str(chat_id), lambda: super(ScheduledBot, self).request(method, data, files, **kwargs),
+            idempotent=method.startswith(IDEMPOTENT_PREFIXES)
+        )
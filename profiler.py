@@ -0,0 +1,222 @@
+import asyncio
+import io
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+from contextvars import ContextVar
+from datetime import datetime
+from aiogram import types
+from aiogram.dispatcher.handler import current_handler
+from aiogram.dispatcher.middlewares import BaseMiddleware
+
+from config import config
+
+logger = logging.getLogger(__name__)
+
+# {'db': seconds, 'api': seconds} of the handler being profiled, None while the profiler is off
+current_sample = ContextVar('profile_sample', default=None)
+
+def record_await(kind: str, seconds: float):
+    """Add an awaited DB or Bot API call to the running handler's sample"""
+    sample = current_sample.get()
+    if sample is not None:
+        sample[kind] += seconds
+
+def parse_duration(text: str) -> int:
+    """'90', '90s', '5m', '24h', '7d' -> seconds, raises ValueError for anything else"""
+    units = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+    if text and text[-1] in units:
+        return int(text[:-1]) * units[text[-1]]
+    return int(text)
+
+class ProfilingMiddleware(BaseMiddleware):
+    """Time each handler and collect the DB and Bot API time it awaited"""
+
+    def __init__(self, profiler):
+        super().__init__()
+        self.profiler = profiler
+
+    async def trigger(self, action, args):
+        if action.startswith('process_'):
+            handler = current_handler.get(None)
+            sample = {'db': 0.0, 'api': 0.0}
+            current_sample.set(sample)
+            args[-1]['_profile'] = (handler.__name__ if handler else 'unknown', time.perf_counter(), sample)
+        elif action.startswith('post_process_'):
+            started = args[-1].pop('_profile', None)
+            if started:
+                current_sample.set(None)
+                name, started_at, sample = started
+                self.profiler.record_handler(name, time.perf_counter() - started_at, sample)
+
+class HandlerProfiler:
+    """Profile handlers for a bounded window, started with /profile on.
+
+    A middleware splits each handler's wall time into awaited DB calls,
+    awaited Bot API calls and the rest, while a sampling thread records
+    the event loop thread's stack every PROFILE_SAMPLE_INTERVAL seconds.
+    The report goes to the owner as a document. When no window is open
+    neither is installed, only record_await checks a context variable.
+    """
+
+    def __init__(self, bot, dp):
+        self.bot = bot
+        self.dp = dp
+        self.middleware = None
+        self.running = False
+        self.chat_id = None
+        self.started_at = None
+        self.seconds = 0
+        # handler name -> [calls, wall, db, api]
+        self.handlers = defaultdict(lambda: [0, 0.0, 0.0, 0.0])
+        # tuple of code objects, outermost first -> samples
+        self.stacks = Counter()
+        self.samples = 0
+        self.handler_codes = {}
+        self._stop_sampling = threading.Event()
+        self._thread = None
+        self._timer = None
+
+    def start(self, seconds: int, chat_id: int):
+        self.running = True
+        self.chat_id = chat_id
+        self.started_at = datetime.now()
+        self.seconds = seconds
+        self.handlers.clear()
+        self.stacks.clear()
+        self.samples = 0
+        self.handler_codes = self._collect_handler_codes()
+
+        # A middleware can only be set up once, so every window gets a new one
+        self.middleware = ProfilingMiddleware(self)
+        self.dp.middleware.setup(self.middleware)
+        self._stop_sampling.clear()
+        self._thread = threading.Thread(
+            target=self._sample_loop, args=(threading.get_ident(),), name='handler-profiler', daemon=True
+        )
+        self._thread.start()
+        self._timer = asyncio.create_task(self._finish_after(seconds))
+
+    async def stop(self):
+        """End the window now and send the report"""
+        if self._timer and self._timer is not asyncio.current_task():
+            self._timer.cancel()
+        self._timer = None
+        self._detach()
+        try:
+            await self._send_report()
+        except Exception as e:
+            logger.error(f"Failed to send profile report: {e}")
+
+    async def close(self):
+        if self.running:
+            if self._timer:
+                self._timer.cancel()
+                self._timer = None
+            self._detach()
+
+    def record_handler(self, name: str, wall: float, sample: dict):
+        entry = self.handlers[name]
+        entry[0] += 1
+        entry[1] += wall
+        entry[2] += sample['db']
+        entry[3] += sample['api']
+
+    async def _finish_after(self, seconds: int):
+        await asyncio.sleep(seconds)
+        await self.stop()
+
+    def _detach(self):
+        self.running = False
+        self._stop_sampling.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+        if self.middleware in self.dp.middleware.applications:
+            self.dp.middleware.applications.remove(self.middleware)
+
+    def _collect_handler_codes(self) -> dict:
+        codes = {}
+        for handlers in (self.dp.message_handlers, self.dp.callback_query_handlers):
+            for handler_obj in handlers.handlers:
+                func = handler_obj.handler
+                codes[func.__code__] = func.__name__
+        return codes
+
+    def _sample_loop(self, thread_id: int):
+        interval = config.PROFILE_SAMPLE_INTERVAL
+        while not self._stop_sampling.wait(interval):
+            frame = sys._current_frames().get(thread_id)
+            stack = []
+            while frame is not None:
+                stack.append(frame.f_code)
+                frame = frame.f_back
+            self.samples += 1
+            # The loop thread waiting in select() is idle, not running handler code
+            if not stack or (stack[0].co_name == 'select' and stack[0].co_filename.endswith('selectors.py')):
+                continue
+            stack.reverse()
+            self.stacks[tuple(stack)] += 1
+
+    @staticmethod
+    def _label(code) -> str:
+        return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+    def _task_frames(self, stack: tuple) -> tuple:
+        """Drop the event loop frames above the running task's coroutine"""
+        for i in range(len(stack) - 1, -1, -1):
+            if stack[i].co_name == '_run' and stack[i].co_filename.endswith(os.path.join('asyncio', 'events.py')):
+                return stack[i + 1:]
+        return stack
+
+    def report(self) -> str:
+        busy = sum(self.stacks.values())
+        lines = [
+            f"Handler profile from {self.started_at:%Y-%m-%d %H:%M:%S}, {self.seconds}s window",
+            f"{self.samples} samples every {config.PROFILE_SAMPLE_INTERVAL * 1000:g} ms, {busy} with the event loop busy",
+            "",
+            "Handlers (wall time split into awaited DB calls, awaited Bot API calls and everything else)",
+            f"{'handler':<32} {'calls':>7} {'total s':>9} {'avg ms':>9} {'db %':>6} {'api %':>6} {'other %':>8} {'samples':>8}"
+        ]
+
+        handler_samples = Counter()
+        for stack, count in self.stacks.items():
+            for code in stack:
+                if code in self.handler_codes:
+                    handler_samples[self.handler_codes[code]] += count
+                    break
+
+        for name, (calls, wall, db, api) in sorted(self.handlers.items(), key=lambda item: -item[1][1]):
+            other = max(wall - db - api, 0.0)
+            lines.append(
+                f"{name:<32} {calls:>7} {wall:>9.2f} {wall / calls * 1000:>9.1f} "
+                f"{db / wall * 100 if wall else 0:>6.1f} {api / wall * 100 if wall else 0:>6.1f} "
+                f"{other / wall * 100 if wall else 0:>8.1f} {handler_samples.get(name, 0):>8}"
+            )
+
+        folded = Counter()
+        for stack, count in self.stacks.items():
+            folded[';'.join(self._label(code) for code in self._task_frames(stack))] += count
+
+        lines += ["", "Hottest stacks (share of busy samples, innermost frame last)"]
+        for stack, count in folded.most_common(config.PROFILE_TOP_STACKS):
+            lines.append(f"{count:>7} {count * 100 / busy:5.1f}%  {stack.replace(';', ' > ')}")
+
+        lines += ["", "Folded stacks (flamegraph.pl / speedscope input)"]
+        lines += [f"{stack} {count}" for stack, count in folded.most_common()]
+        return '\n'.join(lines) + '\n'
+
+    async def _send_report(self):
+        handled = sum(entry[0] for entry in self.handlers.values())
+        document = types.InputFile(
+            io.BytesIO(self.report().encode()),
+            filename=f"profile-{self.started_at:%Y%m%d-%H%M%S}.txt"
+        )
+        await self.bot.send_document(
+            self.chat_id,
+            document,
+            caption=f"🔬 Profile done: {handled} handler calls, {sum(self.stacks.values())} busy samples"
+        )
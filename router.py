@@ -0,0 +1,165 @@
+import asyncio
+import json
+import logging
+import os
+import sys
+import aiohttp
+from aiohttp import web
+
+from config import config
+
+logger = logging.getLogger(__name__)
+
+# Headers passed on to the workers with the update
+FORWARDED_HEADERS = ('Content-Type', 'X-Telegram-Bot-Api-Secret-Token')
+
+def get_chat_id(update: dict) -> int:
+    """Chat a raw webhook update belongs to, the same rules as ingest.get_chat_id"""
+    for key in ('message', 'edited_message', 'channel_post', 'edited_channel_post',
+                'my_chat_member', 'chat_member', 'chat_join_request'):
+        if update.get(key):
+            return update[key]['chat']['id']
+    callback_query = update.get('callback_query')
+    if callback_query:
+        if callback_query.get('message'):
+            return callback_query['message']['chat']['id']
+        return callback_query['from']['id']
+    for key in ('inline_query', 'chosen_inline_result', 'shipping_query', 'pre_checkout_query', 'poll_answer'):
+        if update.get(key):
+            obj = update[key]
+            return obj['from']['id'] if 'from' in obj else obj['user']['id']
+    return 0
+
+class UpdateRouter:
+    """Front process of a bot running WEB_WORKERS webhook workers.
+
+    Starts every worker as a copy of the bot script with WORKER_INDEX set,
+    restarts the ones that exit, and forwards each webhook update to worker
+    chat_id % WEB_WORKERS. A chat is always served by the same worker, so its
+    updates stay in order and its FSM state and caches have a single owner.
+    """
+
+    def __init__(self, script: str, workers: int):
+        self.script = script
+        self.workers = workers
+        # worker index -> asyncio.subprocess.Process
+        self.processes = {}
+        self.supervisors = []
+        self.session = None
+        self.stopping = False
+
+    def worker_url(self, index: int, path: str) -> str:
+        return f"http://127.0.0.1:{config.WORKER_BASE_PORT + index}{path}"
+
+    async def start(self, app):
+        self.session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=10))
+        for index in range(self.workers):
+            self.supervisors.append(asyncio.create_task(self._supervise(index)))
+        logger.info(f"Routing updates to {self.workers} workers on ports "
+                    f"{config.WORKER_BASE_PORT}-{config.WORKER_BASE_PORT + self.workers - 1}")
+
+    async def close(self, app):
+        """Stop the workers, each drains its update queue before exiting"""
+        self.stopping = True
+        for process in self.processes.values():
+            if process.returncode is None:
+                process.terminate()
+        try:
+            await asyncio.wait_for(
+                asyncio.gather(*self.supervisors, return_exceptions=True),
+                config.UPDATE_DRAIN_TIMEOUT + 10
+            )
+        except asyncio.TimeoutError:
+            logger.warning("Workers did not stop in time, killing them")
+            for process in self.processes.values():
+                if process.returncode is None:
+                    process.kill()
+        await self.session.close()
+
+    async def _supervise(self, index: int):
+        env = dict(os.environ, WORKER_INDEX=str(index))
+        while not self.stopping:
+            process = await asyncio.create_subprocess_exec(sys.executable, self.script, env=env)
+            self.processes[index] = process
+            code = await process.wait()
+            if self.stopping:
+                return
+            logger.error(f"Worker {index} exited with code {code}, restarting")
+            await asyncio.sleep(1)
+
+    async def forward(self, index: int, method: str, path: str, **kwargs):
+        """Send a request to a worker, waiting for it while it is (re)starting"""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + config.STARTUP_BUDGET
+        while True:
+            try:
+                async with self.session.request(method, self.worker_url(index, path), **kwargs) as response:
+                    return response.status, dict(response.headers), await response.read()
+            except aiohttp.ClientConnectionError:
+                if self.stopping or loop.time() >= deadline:
+                    raise
+                await asyncio.sleep(0.05)
+
+    async def webhook_handler(self, request):
+        if config.WEBHOOK_SECRET and request.headers.get('X-Telegram-Bot-Api-Secret-Token') != config.WEBHOOK_SECRET:
+            return web.Response(status=403)
+
+        body = await request.read()
+        try:
+            index = get_chat_id(json.loads(body)) % self.workers
+        except Exception as e:
+            logger.warning(f"Rejected malformed webhook update: {e}")
+            return web.Response(status=400)
+
+        headers = {name: request.headers[name] for name in FORWARDED_HEADERS if name in request.headers}
+        try:
+            status, response_headers, _ = await self.forward(index, 'POST', config.WEBHOOK_PATH, data=body, headers=headers)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.error(f"Worker {index} unavailable: {e}")
+            return web.Response(status=503, headers={'Retry-After': '1'})
+        retry_after = response_headers.get('Retry-After')
+        return web.Response(status=status, headers={'Retry-After': retry_after} if retry_after else None)
+
+    # Health check of the router itself
+    async def health_check(self, request):
+        return web.Response(text="ok")
+
+    # Ready once every worker is
+    async def readiness_check(self, request):
+        for index in range(self.workers):
+            try:
+                status, _, body = await self.forward(index, 'GET', '/ready')
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                return web.Response(status=503, text=f"worker {index} unavailable: {e}")
+            if status != 200:
+                return web.Response(status=503, text=f"worker {index}: {body.decode()}")
+        return web.Response(text="ready")
+
+    # Metrics are per worker: /metrics?worker=N, worker 0 by default
+    async def metrics_handler(self, request):
+        try:
+            index = int(request.query.get('worker', 0))
+        except ValueError:
+            return web.Response(status=400)
+        if not 0 <= index < self.workers:
+            return web.Response(status=404, text=f"no worker {index}")
+        try:
+            status, _, body = await self.forward(index, 'GET', '/metrics')
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            return web.Response(status=503, text=f"worker {index} unavailable: {e}")
+        return web.Response(status=status, body=body, content_type='text/plain')
+
+def create_router_app(script: str) -> web.Application:
+    router = UpdateRouter(script, config.WEB_WORKERS)
+    app = web.Application()
+    app.router.add_get('/health', router.health_check)
+    app.router.add_get('/ready', router.readiness_check)
+    app.router.add_get('/metrics', router.metrics_handler)
+    app.router.add_post(config.WEBHOOK_PATH, router.webhook_handler)
+    app.on_startup.append(router.start)
+    app.on_shutdown.append(router.close)
+    return app
+
+def run_router(script: str):
+    """Serve the webhook on WEBAPP_PORT and run WEB_WORKERS copies of script behind it"""
+    web.run_app(create_router_app(script), host=config.WEBAPP_HOST, port=config.WEBAPP_PORT)
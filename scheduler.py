@@ -0,0 +1,130 @@
+import asyncio
+import json
+import logging
+from collections import defaultdict
+from aiogram.utils import exceptions
+
+from config import config
+from outbound import send_priority
+
+logger = logging.getLogger(__name__)
+
+# deleteMessages accepts at most 100 message ids per call
+DELETE_CHUNK_SIZE = 100
+
+class DeletionScheduler:
+    """Delete delivered files once their auto-delete timer expires.
+
+    Pending deletions live in the pending_deletions table, so they survive
+    restarts. A single loop sleeps until the earliest due row (the delete_at
+    index is the priority queue) and claims due rows before deleting them,
+    so replicas never process the same row twice. With several web workers
+    each one claims only the chats routed to it, which keeps every chat's
+    sends in the one rate limit bucket that knows about them.
+    """
+
+    def __init__(self, bot, db):
+        self.bot = bot
+        self.db = db
+        # (worker, workers) of the chats this process owns
+        self.shard = (config.WORKER_INDEX, config.WEB_WORKERS) if config.WORKER_INDEX is not None else (0, 1)
+        self.next_at = 0.0
+        self.wakeup = asyncio.Event()
+        self.stopping = False
+        self._task = None
+
+    def start(self):
+        # next_at starts in the past, so overdue deletions are processed right away
+        self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self._task:
+            self.stopping = True
+            self.wakeup.set()
+            await self._task
+            self._task = None
+
+    async def schedule(self, chat_id: int, message_ids: list, delay_minutes: int):
+        if not message_ids:
+            return
+        await self.db.add_pending_deletion(chat_id, message_ids, delay_minutes)
+
+        due_at = asyncio.get_running_loop().time() + delay_minutes * 60
+        if due_at < self.next_at:
+            self.next_at = due_at
+            self.wakeup.set()
+
+    async def _run(self):
+        send_priority.set('deletion')
+        loop = asyncio.get_running_loop()
+        while not self.stopping:
+            await self._sleep_until_due()
+            if self.stopping:
+                break
+
+            try:
+                await self._process_due()
+                delay = await self.db.get_next_deletion_delay(*self.shard)
+            except Exception as e:
+                logger.error(f"Error in auto-delete scheduler: {e}")
+                delay = None
+
+            # Also poll periodically for rows scheduled by other instances or released claims
+            if delay is None or delay > config.DELETION_POLL_INTERVAL:
+                delay = config.DELETION_POLL_INTERVAL
+            self.next_at = loop.time() + max(delay, 0)
+
+    async def _sleep_until_due(self):
+        loop = asyncio.get_running_loop()
+        while not self.stopping:
+            timeout = self.next_at - loop.time()
+            if timeout <= 0:
+                return
+            self.wakeup.clear()
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                return
+
+    async def _process_due(self):
+        while not self.stopping:
+            rows = await self.db.claim_due_deletions(
+                config.DELETION_BATCH_SIZE, config.DELETION_CLAIM_SECONDS, *self.shard
+            )
+            if not rows:
+                return
+
+            # chat_id -> [(row id, message_id)], to tell which rows a failed chunk belongs to
+            by_chat = defaultdict(list)
+            for row in rows:
+                by_chat[row['chat_id']].extend((row['id'], message_id) for message_id in row['message_ids'])
+
+            failed = set()
+            for chat_id, messages in by_chat.items():
+                for i in range(0, len(messages), DELETE_CHUNK_SIZE):
+                    chunk = messages[i:i + DELETE_CHUNK_SIZE]
+                    if not await self._delete(chat_id, [message_id for _, message_id in chunk]):
+                        failed.update(row_id for row_id, _ in chunk)
+
+            # Failed rows stay claimed and come back once claimed_until passes
+            done = [row['id'] for row in rows if row['id'] not in failed]
+            if done:
+                await self.db.remove_pending_deletions(done)
+            if len(rows) < config.DELETION_BATCH_SIZE or failed:
+                return
+
+    async def _delete(self, chat_id: int, message_ids: list) -> bool:
+        """Delete one chunk, returns False when it is worth trying again later"""
+        try:
+            # Messages that no longer exist are skipped by Telegram
+            await self.bot.request('deleteMessages', {
+                'chat_id': chat_id,
+                'message_ids': json.dumps(message_ids)
+            })
+        except (exceptions.BadRequest, exceptions.Unauthorized) as e:
+            # The chat is gone or the bot was blocked, a later attempt fails the same way
+            logger.warning(f"Cannot delete messages {message_ids} in {chat_id}: {e}")
+        except Exception as e:
+            logger.error(f"Error deleting messages {message_ids} in {chat_id}, retrying later: {e}")
+            return False
+        return True
@@ -0,0 +1,63 @@
+import asyncio
+import logging
+from datetime import datetime, timedelta
+
+from config import config
+
+logger = logging.getLogger(__name__)
+
+class SessionSweeper:
+    """Delete expired upload sessions and old access events in the background.
+
+    Runs every SESSION_SWEEP_INTERVAL seconds in every instance, deleting
+    SESSION_SWEEP_BATCH_SIZE rows per statement so no lock is held for
+    long. Concurrent sweepers skip each other's rows. Until a session is
+    swept, its expiry is enforced when the session is looked up.
+    """
+
+    def __init__(self, db):
+        self.db = db
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def sweep(self) -> int:
+        """Delete what is due now, returns the sessions deleted"""
+        unused_before = None
+        if config.SESSION_UNUSED_DAYS > 0:
+            unused_before = datetime.now() - timedelta(days=config.SESSION_UNUSED_DAYS)
+        return await self.db.expire_upload_sessions(unused_before, config.SESSION_SWEEP_BATCH_SIZE)
+
+    async def sweep_access_events(self) -> int:
+        """Delete access events past ACCESS_EVENT_RETENTION_DAYS, returns the events deleted"""
+        if config.ACCESS_EVENT_RETENTION_DAYS <= 0:
+            return 0
+        before = datetime.now() - timedelta(days=config.ACCESS_EVENT_RETENTION_DAYS)
+        return await self.db.delete_access_events(before, config.SESSION_SWEEP_BATCH_SIZE)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(config.SESSION_SWEEP_INTERVAL)
+            try:
+                deleted = await self.sweep()
+                if deleted:
+                    logger.info(f"Deleted {deleted} expired upload sessions")
+            except Exception as e:
+                logger.error(f"Failed to delete expired upload sessions: {e}")
+            
+            try:
+                deleted = await self.sweep_access_events()
+                if deleted:
+                    logger.info(f"Deleted {deleted} old access events")
+            except Exception as e:
+                logger.error(f"Failed to delete old access events: {e}")
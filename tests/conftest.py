@@ -0,0 +1,6 @@
+import os
+import sys
+
+# The bot modules live in the repository root, as bench/run.py expects too
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('BOT_TOKEN', '123456:TEST')
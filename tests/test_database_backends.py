@@ -0,0 +1,104 @@
+"""MemoryDatabase must stand in for Database: same interface, same answers.
+
+The parity scenario always runs on the memory backend and runs on Postgres
+as well when TEST_DATABASE_URL points to a throwaway database.
+"""
+import asyncio
+import inspect
+import json
+import os
+import uuid
+
+import pytest
+
+from config import config
+from database import BaseDatabase, Database
+from memory_database import MemoryDatabase
+
+def public_methods(cls) -> dict:
+    return {name: member for name, member in inspect.getmembers(cls, inspect.isfunction) if not name.startswith('_')}
+
+def test_backends_implement_the_whole_interface():
+    assert not MemoryDatabase.__abstractmethods__
+    assert not Database.__abstractmethods__
+
+def test_backends_match_the_declared_signatures():
+    for name in BaseDatabase.__abstractmethods__:
+        declared = inspect.signature(getattr(BaseDatabase, name))
+        for backend in (Database, MemoryDatabase):
+            parameters = list(inspect.signature(getattr(backend, name)).parameters.values())
+            # Backends may add trailing keyword arguments with defaults, nothing else
+            assert [p.name for p in parameters[:len(declared.parameters)]] == list(declared.parameters), (backend, name)
+            assert all(p.default is not p.empty for p in parameters[len(declared.parameters):]), (backend, name)
+
+async def run_scenario(db: BaseDatabase) -> dict:
+    """Exercise each part of the storage interface, returns what came back in a comparable shape"""
+    suffix = uuid.uuid4().hex[:8]
+    base_id = int(uuid.uuid4().int % 10 ** 9) * 100
+    results = {}
+
+    for i in range(5):
+        db.register_user(base_id + i, f'user{i}', f'User {i}')
+    await db.flush_activity()
+    await db.mark_users_blocked([base_id + 1])
+    recipients = await db.get_broadcast_recipients(base_id - 1, 100)
+    results['recipients'] = [user_id - base_id for user_id in recipients if user_id < base_id + 100]
+
+    session_id = f'parity{suffix}'
+    files = [
+        {'file_id': f'file{i}', 'file_unique_id': f'unique{i}', 'file_type': 'photo', 'caption': f'caption {i}'}
+        for i in range(7)
+    ]
+    await db.create_upload_session(session_id, base_id, files, True, 5, 'album')
+    session = await db.get_upload_session(session_id)
+    results['session'] = {key: session[key] for key in ('protect_content', 'auto_delete_minutes',
+                                                          'delivery_mode', 'file_count', 'expires_at')}
+    results['session']['owner'] = session['owner_id'] - base_id
+    results['page'] = await db.get_session_files(session_id, 5, 5)
+    results['missing_session'] = await db.get_upload_session(f'missing{suffix}')
+
+    db.record_access(session_id, base_id, 0, 5, 0.1)
+    db.record_access(session_id, base_id, 5, 2, 0.3)
+    await db.flush_access_counts()
+    await db.flush_access_events()
+    results['top'] = [
+        (row['opens'], row['pages'], row['files'], row['avg_latency_ms'])
+        for row in await db.get_top_sessions(1, 1000) if row['session_id'] == session_id
+    ]
+
+    chat_id = base_id
+    await db.set_fsm_state(chat_id, chat_id, 'UploadStates:waiting_for_files')
+    await db.set_fsm_data(chat_id, chat_id, {'file_ids': ['a']})
+    results['appended'] = await db.append_fsm_data(chat_id, chat_id, {'file_ids': ['b', 'c']})
+    results['updated'] = await db.update_fsm_data(chat_id, chat_id, {'protect': True})
+    record = await db.get_fsm_record(chat_id, chat_id)
+    results['fsm'] = (record['state'], json.loads(record['data']) if isinstance(record['data'], str) else record['data'])
+    await db.delete_fsm_record(chat_id, chat_id)
+    results['fsm_deleted'] = await db.get_fsm_record(chat_id, chat_id)
+
+    await db.add_pending_deletion(chat_id, [1, 2, 3], 0)
+    await asyncio.sleep(0.01)
+    claimed = [row for row in await db.claim_due_deletions(1000, 60) if row['chat_id'] == chat_id]
+    results['claimed'] = [list(row['message_ids']) for row in claimed]
+    results['claimed_again'] = [row for row in await db.claim_due_deletions(1000, 60) if row['chat_id'] == chat_id]
+    await db.remove_pending_deletions([row['id'] for row in claimed])
+    return results
+
+async def run_on(db: BaseDatabase) -> dict:
+    await db.init()
+    try:
+        return await run_scenario(db)
+    finally:
+        await db.close()
+
+def test_memory_backend_runs_the_scenario():
+    results = asyncio.run(run_on(MemoryDatabase()))
+    assert results['recipients'] == [0, 2, 3, 4]
+    assert [file['file_id'] for file in results['page']] == ['file5', 'file6']
+    assert results['fsm'] == ('UploadStates:waiting_for_files', {'file_ids': ['a', 'b', 'c'], 'protect': True})
+    assert results['claimed'] == [[1, 2, 3]] and results['claimed_again'] == []
+
+@pytest.mark.skipif(not os.getenv('TEST_DATABASE_URL'), reason='TEST_DATABASE_URL is not set')
+def test_backends_agree(monkeypatch):
+    monkeypatch.setattr(config, 'DATABASE_URL', os.environ['TEST_DATABASE_URL'])
+    assert asyncio.run(run_on(Database())) == asyncio.run(run_on(MemoryDatabase()))
@@ -0,0 +1,34 @@
+"""/export files must load back with /import, however large a session is"""
+import asyncio
+
+from memory_database import MemoryDatabase
+from transfer import export_table, import_file
+
+async def round_trip(file_count: int) -> tuple:
+    source = MemoryDatabase()
+    await source.init()
+    files = [
+        {'file_id': f'file{i}' * 8, 'file_unique_id': f'unique{i}', 'file_type': 'document', 'caption': f'caption "{i}", part'}
+        for i in range(file_count)
+    ]
+    await source.create_upload_session('LargeSession', 1, files, False, 0)
+    file, count = await export_table(source, 'sessions')
+    await source.close()
+
+    target = MemoryDatabase()
+    await target.init()
+    try:
+        with file:
+            result = await import_file(target, file)
+        imported = await target.get_session_files('LargeSession', 0, file_count)
+    finally:
+        await target.close()
+    return count, result, imported, files
+
+def test_large_session_round_trip():
+    count, result, imported, files = asyncio.run(round_trip(5000))
+    assert count == 1
+    assert result == ('sessions', 1, 1)
+    assert [(file['file_id'], file['file_type'], file['caption']) for file in imported] == [
+        (file['file_id'], file['file_type'], file['caption']) for file in files
+    ]
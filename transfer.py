@@ -0,0 +1,107 @@
+import csv
+import gzip
+import io
+import json
+import tempfile
+from datetime import datetime
+
+from config import config
+from database import SESSION_COLUMNS, USER_COLUMNS
+
+EXPORT_TABLES = ('users', 'sessions')
+
+# The files column of a session holds all of its files as JSON, about 150 bytes each,
+# far beyond csv's default field limit of 128 KiB for large sessions
+MAX_FIELD_SIZE = 256 * 1024 * 1024
+
+async def export_table(db, table: str):
+    """Write table as gzip'd CSV to a temporary file.
+
+    Rows are compressed as COPY hands them over, so only the current chunk
+    is ever held in memory. Returns the file, rewound, and the row count.
+    """
+    file = tempfile.TemporaryFile()
+    compressed = gzip.GzipFile(fileobj=file, mode='wb')
+
+    async def write(chunk: bytes):
+        compressed.write(chunk)
+
+    try:
+        count = await db.export_table(table, write)
+        compressed.close()
+    except BaseException:
+        file.close()
+        raise
+    file.seek(0)
+    return file, count
+
+async def import_file(db, file):
+    """Load a file written by export_table in batches of IMPORT_BATCH_SIZE rows.
+
+    Returns (table, rows read, rows added), rows whose user or session
+    already exists are skipped. Raises ValueError for anything that is not
+    an export file.
+    """
+    csv.field_size_limit(max(csv.field_size_limit(), MAX_FIELD_SIZE))
+    try:
+        with io.TextIOWrapper(gzip.GzipFile(fileobj=file, mode='rb'), encoding='utf-8', newline='') as text:
+            reader = csv.reader(text)
+            header = tuple(next(reader, ()))
+            if header == USER_COLUMNS:
+                table, load = 'users', _load_users
+            # Files exported before sessions could expire have no expires_at column
+            elif header in (SESSION_COLUMNS + ('files',), SESSION_COLUMNS[:-1] + ('files',)):
+                table, load = 'sessions', _load_sessions
+            else:
+                raise ValueError("unknown columns, expected a file made by /export")
+
+            read = added = 0
+            batch = []
+            for row in reader:
+                batch.append(row)
+                if len(batch) >= config.IMPORT_BATCH_SIZE:
+                    added += await load(db, batch)
+                    read += len(batch)
+                    batch = []
+            if batch:
+                added += await load(db, batch)
+                read += len(batch)
+    except (OSError, EOFError, KeyError, csv.Error, UnicodeDecodeError) as e:
+        raise ValueError(f"unreadable file: {e}")
+    return table, read, added
+
+# COPY ... CSV writes NULL as an empty field, so empty text comes back as NULL
+
+def _text(value: str):
+    return value or None
+
+def _time(value: str):
+    return datetime.fromisoformat(value) if value else None
+
+def _bool(value: str) -> bool:
+    return value == 't'
+
+async def _load_users(db, rows: list) -> int:
+    return await db.import_users([
+        (int(user_id), _text(username), _text(first_name), _text(last_name),
+         _time(join_date), _time(last_active), _bool(is_banned), _bool(is_blocked))
+        for user_id, username, first_name, last_name, join_date, last_active, is_banned, is_blocked in rows
+    ])
+
+async def _load_sessions(db, rows: list) -> int:
+    sessions = []
+    files = []
+    for row in rows:
+        session = dict(zip(SESSION_COLUMNS, row[:-1]))
+        session_id, session_files = session['session_id'], row[-1]
+        sessions.append((
+            session_id, int(session['owner_id']), int(session['file_count']), _bool(session['protect_content']),
+            int(session['auto_delete_minutes']), session['delivery_mode'] or 'single', _time(session['created_at']),
+            int(session['access_count'] or 0), _time(session.get('expires_at', ''))
+        ))
+        for position, file in enumerate(json.loads(session_files)):
+            files.append((
+                session_id, position, file['file_id'], file.get('file_unique_id'),
+                file['file_type'], file.get('caption') or ''
+            ))
+    return await db.import_sessions(sessions, files)
@@ -1,15 +1,12 @@
-import random
+import base64
+import binascii
+import hashlib
+import hmac
 import string
 from datetime import datetime
 import asyncio
 
 class BotUtils:
-    @staticmethod
-    def generate_session_id(length: int = 12) -> str:
-        """Generate random session ID with letters and digits"""
-        characters = string.ascii_letters + string.digits
-        return ''.join(random.choices(characters, k=length))
-
     @staticmethod
     def format_time(minutes: int) -> str:
         """Format minutes into human readable time"""
@@ -26,19 +23,117 @@ class BotUtils:
             return f"{days} day{'s' if days > 1 else ''}"
 
 class FileHandler:
+    # Media type ids stored in the first int32 of a decoded Bot API file_id
+    FILE_ID_TYPES = {2: 'photo', 4: 'video', 9: 'audio'}
+
     @staticmethod
     def get_file_id(message):
         """Get file ID and file type from message"""
+        file_id, _, file_type = FileHandler.get_file(message)
+        return file_id, file_type
+
+    @staticmethod
+    def get_file(message):
+        """Get file ID, file unique ID and file type from message"""
         if message.photo:
-            return message.photo[-1].file_id, 'photo'
+            media, file_type = message.photo[-1], 'photo'
         elif message.video:
-            return message.video.file_id, 'video'
+            media, file_type = message.video, 'video'
         elif message.document:
-            return message.document.file_id, 'document'
+            media, file_type = message.document, 'document'
         elif message.audio:
-            return message.audio.file_id, 'audio'
+            media, file_type = message.audio, 'audio'
         else:
-            return None, 'unknown'
+            return None, None, 'unknown'
+        return media.file_id, media.file_unique_id, file_type
+
+    # Telegram only mixes photos and videos within one album
+    ALBUM_GROUPS = {'photo': 'visual', 'video': 'visual', 'document': 'document', 'audio': 'audio'}
+    ALBUM_SIZE = 10
+
+    @staticmethod
+    def group_for_album(file_types: list) -> list:
+        """Split file indexes into consecutive media-group compatible batches of up to 10"""
+        batches = []
+        current_group = None
+        for i, file_type in enumerate(file_types):
+            group = FileHandler.ALBUM_GROUPS.get(file_type, 'document')
+            if not batches or group != current_group or len(batches[-1]) >= FileHandler.ALBUM_SIZE:
+                batches.append([])
+                current_group = group
+            batches[-1].append(i)
+        return batches
+
+    @staticmethod
+    def get_file_type_from_id(file_id: str) -> str:
+        """Decode the file type embedded in a file_id, defaulting to document"""
+        try:
+            raw = base64.urlsafe_b64decode(file_id + '=' * (-len(file_id) % 4))
+        except (binascii.Error, ValueError):
+            return 'document'
+        
+        # Zero bytes are run-length encoded as 0x00 followed by the repeat count
+        decoded = bytearray()
+        zero = False
+        for byte in raw:
+            if zero:
+                decoded.extend(b'\x00' * byte)
+                zero = False
+            elif byte == 0:
+                zero = True
+            else:
+                decoded.append(byte)
+        
+        if len(decoded) < 4:
+            return 'document'
+        # Bits 24 and 25 flag web locations and file references, not the type
+        type_id = int.from_bytes(decoded[:4], 'little') & ~((1 << 24) | (1 << 25))
+        return FileHandler.FILE_ID_TYPES.get(type_id, 'document')
+
+class SessionTokens:
+    """Deep-link session ids: base36 sequence number, '_' and a truncated HMAC-SHA256 tag.
+
+    Numbers come from a database sequence, so tokens never collide, and the
+    tag lets a link be checked without a database lookup. Sessions created
+    before these tokens use 12 random letters and digits (no '_').
+    """
+    TAG_BYTES = 9
+    TAG_LENGTH = 12
+    BASE36 = string.digits + string.ascii_lowercase
+
+    @staticmethod
+    def issue(number: int) -> str:
+        digits = ''
+        while True:
+            number, digit = divmod(number, 36)
+            digits = SessionTokens.BASE36[digit] + digits
+            if not number:
+                break
+        return f"{digits}_{SessionTokens._tag(digits)}"
+
+    @staticmethod
+    def verify(token: str) -> bool:
+        """True for a well-formed token carrying a valid tag"""
+        digits, separator, tag = token.partition('_')
+        if not separator or not 0 < len(digits) <= 13 or len(tag) != SessionTokens.TAG_LENGTH:
+            return False
+        if any(char not in SessionTokens.BASE36 for char in digits):
+            return False
+        return hmac.compare_digest(tag, SessionTokens._tag(digits))
+
+    @staticmethod
+    def number(token: str):
+        """Sequence number of a valid token, None for anything else"""
+        if not SessionTokens.verify(token):
+            return None
+        return int(token.partition('_')[0], 36)
+
+    @staticmethod
+    def _tag(digits: str) -> str:
+        from config import config
+        key = (config.SESSION_SECRET or config.BOT_TOKEN or '').encode()
+        digest = hmac.new(key, f'upload_session:{digits}'.encode(), hashlib.sha256).digest()
+        return base64.urlsafe_b64encode(digest[:SessionTokens.TAG_BYTES]).decode()
 
 class Validation:
     @staticmethod